@@ -1,10 +1,123 @@
+import array
+import collections
+import functools
+import logging
+import random
 import sys
+import time
+
+from six.moves import reprlib
+
+
+LOG = logging.getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Fields of the counters of a profiled method
+CALLS = 0
+# calls raising an exception
+ERRORS = 1
+# seconds
+TOTAL_TIME = 2
+MIN_TIME = 3
+MAX_TIME = 4
+# the first of HISTOGRAM_BUCKETS counters, bucket i counting calls taking
+# less than 2 ** i microseconds, the last one the rest
+HISTOGRAM = 5
+HISTOGRAM_BUCKETS = 28
+PROFILE_FIELDS = HISTOGRAM + HISTOGRAM_BUCKETS
+
+# dotted path -> (parent, attribute name), see locate()
+_located = {}
 
 
 def empty_func(*args, **kwargs):
     return None
 
 
+def _find_imported(path):
+    """The module of the longest prefix of path already imported, and the
+    names after it. None if no prefix is imported."""
+
+    middle_paths = []
+    while path:
+        if path in sys.modules:
+            middle_paths.reverse()
+            return sys.modules[path], middle_paths
+        path, _sep, token = path.rpartition('.')
+        middle_paths.append(token)
+    return None
+
+
+def _import_parent(path):
+    """The module of the longest importable prefix of path, and the names
+    after it"""
+
+    # middle paths between module path and method name
+    middle_paths = []
+
+    # locate module path
+    while True:
+        try:
+            __import__(path)
+            break
+        except ImportError:
+            pass
+        path, _sep, token = path.rpartition('.')
+        middle_paths.append(token)
+    # import module
+    __import__(path)
+
+    middle_paths.reverse()
+    return sys.modules[path], middle_paths
+
+
+def locate(path):
+    """(parent, attribute name) of a dotted path like
+    ``module_path.class_name.method_name``, parent being a module or a
+    (nested) class.
+
+    Modules already imported are found in sys.modules, others are imported.
+    Results are cached, see clear_located().
+    """
+    located = _located.get(path)
+    if located is not None:
+        return located
+
+    parent_path, _sep, method_name = path.rpartition('.')
+    parent = None
+    # an imported module needs no import, nor failed imports of longer paths
+    imported = _find_imported(parent_path)
+    if imported is not None:
+        parent, middle_paths = imported
+        try:
+            for token in middle_paths:
+                parent = getattr(parent, token)
+        except AttributeError:
+            # e.g. a submodule not imported yet
+            parent = None
+    if parent is None:
+        parent, middle_paths = _import_parent(parent_path)
+        for token in middle_paths:
+            parent = getattr(parent, token)
+
+    if not hasattr(parent, method_name):
+        raise AttributeError("Parent %(parent)s doesn't have method "
+                             "%(method_name)s" % {
+                                 'parent': parent.__name__,
+                                 'method_name': method_name,
+                             })
+
+    # parent can be either module or class, or nested class
+    _located[path] = (parent, method_name)
+    return parent, method_name
+
+
+def clear_located():
+    """Forget paths located, e.g. after reloading modules"""
+    _located.clear()
+
+
 class Patch(object):
     """Monkey patch specified class method to call arguments and return value.
 
@@ -53,37 +166,7 @@ class Patch(object):
 
     @staticmethod
     def _locate_method(path):
-        path, _sep, method_name = path.rpartition('.')
-
-        # middle paths between module path and method name
-        middle_paths = []
-
-        # locate module path
-        while True:
-            try:
-                __import__(path)
-                break
-            except ImportError:
-                pass
-            path, _sep, token = path.rpartition('.')
-            middle_paths.append(token)
-        # import module
-        __import__(path)
-
-        middle_paths.reverse()
-        parent = sys.modules[path]
-        for token in middle_paths:
-            parent = getattr(parent, token)
-
-        if not hasattr(parent, method_name):
-            raise AttributeError("Parent %(parent)s doesn't have method "
-                                 "%(method_name)s" % {
-                                     'parent': parent.__name__,
-                                     'method_name': method_name,
-                                 })
-
-        # parent can be either module or class, or nested class
-        return parent, method_name
+        return locate(path)
 
     @staticmethod
     def _replace_method(parent, method_name, new_method):
@@ -92,6 +175,13 @@ class Patch(object):
         return original_method
 
     def _patch(self):
+        self._resolve()
+        return self._apply()
+
+    def _resolve(self):
+        self.parent, self.method_name = self._locate_method(self.path)
+
+    def _apply(self):
         trace = {
             'run': 0,  # my invoke count
             'args': None,
@@ -109,7 +199,6 @@ class Patch(object):
                 trace['return_value'] = self.return_value
             return trace['return_value']
 
-        self.parent, self.method_name = self._locate_method(self.path)
         self.original_method = self._replace_method(
             self.parent, self.method_name, _decorator)
         return trace
@@ -124,3 +213,217 @@ class Patch(object):
         self._patch_back()
 
 
+class PatchSet(object):
+    """Apply many patches together, reverting them all together.
+
+    Example::
+
+        patches = ['module_path.class_name.method_name',
+                   Patch('module_path.function_name', decorate=False)]
+        with PatchSet(patches) as mocks:
+            # something that invokes them
+            ...
+            print mocks['module_path.class_name.method_name']['args']
+
+    Items are Patch objects, or paths patched with the defaults of Patch. Every
+    path is located before any is patched, so a path that can't be located
+    leaves everything unpatched. Patches are reverted in reverse order, also
+    the ones applied when applying another one fails.
+    """
+
+    def __init__(self, patches):
+        self.patches = [patch if isinstance(patch, Patch) else Patch(patch)
+                        for patch in patches]
+        self._applied = []
+
+    def apply(self):
+        """Patch everything, returns {path: trace of its patch}"""
+
+        for patch in self.patches:
+            patch._resolve()
+        traces = {}
+        try:
+            for patch in self.patches:
+                traces[patch.path] = patch._apply()
+                self._applied.append(patch)
+        except Exception:
+            self.revert()
+            raise
+        return traces
+
+    def revert(self):
+        while self._applied:
+            self._applied.pop()._patch_back()
+
+    def __enter__(self):
+        return self.apply()
+
+    def __exit__(self, type, value, traceback):
+        self.revert()
+
+
+class Profiler(object):
+    """Times methods in a running process, for as long as it is attached.
+
+    Example::
+
+        profiler = Profiler(['pyacc.server.routing.RouteTable.match',
+                             'module_path.function_name'], sample_rate=0.01)
+        profiler.attach()
+        # requests served...
+        profiler.dump()
+        profiler.detach()
+
+    Each method, located like Patch does, is replaced by a wrapper counting
+    calls, errors, total, min and max time, and a histogram of call times in
+    power of two microseconds, all kept in an array of PROFILE_FIELDS floats.
+    The wrapper adds a couple of microseconds to each call. A ``sample_rate``
+    fraction of calls also records reprs of the arguments and return value, the
+    last ``max_samples`` of each method kept.
+
+    Times are wall clock, a method yielding to other greenthreads is timed
+    until it returns. attach() and detach() can be called any time, e.g. from
+    an admin request, counters are kept until reset(). Profiler is also a
+    context manager, attached within the block.
+    """
+
+    def __init__(self, paths, sample_rate=0.0, max_samples=16):
+        self.paths = list(paths)
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        # path -> counters array
+        self.counters = dict((path, self._new_counters())
+                             for path in self.paths)
+        # path -> deque of (args, kwargs, return value or error, seconds)
+        self.samples = dict(
+            (path, collections.deque(maxlen=max_samples))
+            for path in self.paths)
+        # path -> (parent, method name, original attribute)
+        self._originals = {}
+
+    @staticmethod
+    def _new_counters():
+        counters = array.array('d', [0.0] * PROFILE_FIELDS)
+        counters[MIN_TIME] = float('inf')
+        return counters
+
+    @property
+    def attached(self):
+        return bool(self._originals)
+
+    def attach(self):
+        for path in self.paths:
+            if path in self._originals:
+                continue
+            parent, method_name = Patch._locate_method(path)
+            # staticmethod and classmethod are wrapped as they are, not as
+            # getattr() returns them
+            original = vars(parent).get(method_name) if isinstance(
+                parent, type) else None
+            if original is None:
+                original = getattr(parent, method_name)
+            setattr(parent, method_name, self._wrap(path, original))
+            self._originals[path] = (parent, method_name, original)
+        LOG.info("Profiler attached to %d methods", len(self._originals))
+
+    def detach(self):
+        for parent, method_name, original in self._originals.values():
+            setattr(parent, method_name, original)
+        self._originals = {}
+
+    def reset(self):
+        for path in self.paths:
+            self.counters[path][:] = self._new_counters()
+            self.samples[path].clear()
+
+    def _wrap(self, path, original):
+        if isinstance(original, (staticmethod, classmethod)):
+            return type(original)(self._wrap(path, original.__func__))
+
+        func = original
+        counters = self.counters[path]
+        samples = self.samples[path]
+        sample_rate = self.sample_rate
+
+        def _record(start, args, kwargs, outcome):
+            duration = _clock() - start
+            counters[CALLS] += 1
+            counters[TOTAL_TIME] += duration
+            if duration < counters[MIN_TIME]:
+                counters[MIN_TIME] = duration
+            if duration > counters[MAX_TIME]:
+                counters[MAX_TIME] = duration
+            bucket = int(duration * 1000000).bit_length()
+            counters[HISTOGRAM + min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+            if sample_rate and random.random() < sample_rate:
+                samples.append((reprlib.repr(args), reprlib.repr(kwargs),
+                                reprlib.repr(outcome), duration))
+
+        @functools.wraps(func)
+        def _profiled(*args, **kwargs):
+            start = _clock()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as exc:
+                counters[ERRORS] += 1
+                _record(start, args, kwargs, exc)
+                raise
+            _record(start, args, kwargs, result)
+            return result
+
+        return _profiled
+
+    @staticmethod
+    def _percentile(counters, pct):
+        """Upper bound in seconds of the histogram bucket holding pct"""
+
+        rank = counters[CALLS] * pct / 100.0
+        seen = 0
+        for index in range(HISTOGRAM_BUCKETS):
+            seen += counters[HISTOGRAM + index]
+            if seen and seen >= rank:
+                return min((2 ** index) / 1000000.0, counters[MAX_TIME])
+        return counters[MAX_TIME]
+
+    def stats(self):
+        """{path: dict of its numbers}, in seconds"""
+
+        stats = {}
+        for path in self.paths:
+            counters = self.counters[path]
+            calls = int(counters[CALLS])
+            stats[path] = {
+                'calls': calls,
+                'errors': int(counters[ERRORS]),
+                'total': counters[TOTAL_TIME],
+                'mean': counters[TOTAL_TIME] / calls if calls else 0.0,
+                'min': counters[MIN_TIME] if calls else 0.0,
+                'max': counters[MAX_TIME],
+                'p50': self._percentile(counters, 50),
+                'p99': self._percentile(counters, 99),
+                'histogram': [int(count) for count in counters[HISTOGRAM:]],
+                'samples': list(self.samples[path]),
+            }
+        return stats
+
+    def dump(self, log=LOG.info):
+        """Log the numbers of every method, most total time first"""
+
+        stats = sorted(self.stats().items(),
+                       key=lambda item: item[1]['total'], reverse=True)
+        for path, numbers in stats:
+            log("%s: %d calls, %d errors, total %.6fs, mean %.6fs, "
+                "min %.6fs, max %.6fs, p50 %.6fs, p99 %.6fs",
+                path, numbers['calls'], numbers['errors'], numbers['total'],
+                numbers['mean'], numbers['min'], numbers['max'],
+                numbers['p50'], numbers['p99'])
+            for args, kwargs, outcome, duration in numbers['samples']:
+                log("  %s %s -> %s in %.6fs", args, kwargs, outcome,
+                    duration)
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.detach()
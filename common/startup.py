@@ -0,0 +1,117 @@
+"""Where the startup time of processes goes, and imports deferred until used.
+
+Code timed with ``phase()`` is recorded, phases nested in others included in
+the time of those::
+
+    with startup.phase('load app main'):
+        app = loader.load_app('main')
+
+A module imported by ``lazy_import()`` is only imported on first use of one of
+its attributes, which is recorded as an ``import`` phase. Submodules not
+imported by their package are imported as attributes::
+
+    webob = startup.lazy_import('webob')
+    webob.exc.HTTPNotFound()    # imports webob, then webob.exc
+
+Children inherit the phases recorded by the parent before they were forked.
+report() logs all of them, with the pid of the process each was recorded in.
+"""
+
+import contextlib
+import importlib
+import logging
+import os
+import sys
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# (name, seconds, nesting depth, pid), in the order phases started
+_phases = []
+_depth = [0]
+
+
+def record(name, seconds, depth=0):
+    _phases.append((name, seconds, depth, os.getpid()))
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the block as a phase called name"""
+
+    index = len(_phases)
+    record(name, 0.0, _depth[0])
+    _depth[0] += 1
+    start = _clock()
+    try:
+        yield
+    finally:
+        _depth[0] -= 1
+        _phases[index] = (name, _clock() - start) + _phases[index][2:]
+
+
+def phases():
+    """[(name, seconds, depth, pid)] recorded so far"""
+    return list(_phases)
+
+
+def report(log=LOG.info):
+    """Log the phases recorded, and the time of top level phases of this
+    process"""
+
+    pid = os.getpid()
+    total = 0.0
+    for name, seconds, depth, phase_pid in _phases:
+        if depth == 0 and phase_pid == pid:
+            total += seconds
+        log("Startup %s%s: %.4fs (pid %d)", '  ' * depth, name, seconds,
+            phase_pid)
+    log("Startup phases of pid %d took %.4fs", pid, total)
+
+
+class _LazyModule(object):
+    """Stands for a module until one of its attributes is used"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            name = self.__dict__['_name']
+            module = sys.modules.get(name)
+            if module is None:
+                with phase('import %s' % name):
+                    module = importlib.import_module(name)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            submodule = '%s.%s' % (module.__name__, attr)
+            try:
+                with phase('import %s' % submodule):
+                    return importlib.import_module(submodule)
+            except ImportError:
+                raise AttributeError("Module %s has no attribute %s"
+                                     % (module.__name__, attr))
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %s>' % self.__dict__['_name']
+
+
+def lazy_import(name):
+    """The module called name, imported once it's used. Also when imported
+    already, so its submodules are imported as attributes still."""
+
+    return _LazyModule(name)
@@ -1,5 +1,8 @@
+import collections
 import logging
 import os
+import socket
+import struct
 import sys
 
 from pyacc.common import config
@@ -21,6 +24,99 @@ def normalize_config_path(config_path):
     raise IOError("Config file not found, path: %s" % config_path)
 
 
+def read_memory_usage(pid):
+    """Read memory usage of a process from /proc, in bytes.
+
+    Returns a dict with ``rss``, ``pss`` (proportional set size, shared pages
+    divided by the number of processes sharing them), ``shared`` and
+    ``private``. Only works on Linux.
+    """
+    fields = {
+        'Rss': 'rss',
+        'Pss': 'pss',
+        'Shared_Clean': 'shared',
+        'Shared_Dirty': 'shared',
+        'Private_Clean': 'private',
+        'Private_Dirty': 'private',
+    }
+    usage = dict.fromkeys(fields.values(), 0)
+
+    # smaps_rollup is pre-summed, fall back to smaps on kernels before 4.14
+    path = '/proc/%d/smaps_rollup' % pid
+    if not os.path.exists(path):
+        path = '/proc/%d/smaps' % pid
+    with open(path) as smaps:
+        for line in smaps:
+            key, _sep, value = line.partition(':')
+            if key in fields:
+                usage[fields[key]] += int(value.split()[0]) * 1024
+    return usage
+
+
+def read_accept_backlog(sock):
+    """Connections waiting to be accepted on a listening TCP socket, 0 if it
+    can't be told. Only works on Linux."""
+
+    if (not hasattr(socket, 'TCP_INFO') or
+            sock.family not in (socket.AF_INET, socket.AF_INET6)):
+        return 0
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except socket.error:
+        return 0
+    # tcpi_unacked of struct tcp_info, the accept queue length of a listening
+    # socket
+    return struct.unpack_from('I', info, 24)[0]
+
+
+class LRUCache(object):
+    """Mapping of at most ``maxsize`` items, evicting the least recently used.
+
+    ``on_evict``, if given, is called with the key and value of each item
+    evicted.
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert as the most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            evicted = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(*evicted)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 class WritableLogger(object):
     """Wrap the logger to be compatible with eventlet wsgi server needs"""
 
@@ -0,0 +1,144 @@
+"""Access log of wsgi.Server written in batches, off the hub.
+
+eventlet.wsgi logs a line per request, which through a logging handler is a
+blocking write per request in the greenthread serving it. Given an AccessLog,
+the server only appends the fields of each request to a bounded buffer. A
+thread of the child formats and writes them, a batch at a time::
+
+    server = wsgi.Server(app=app, access_log=AccessLog(json=True))
+
+A batch is written once ``batch_size`` requests are buffered, or every
+``flush_interval`` seconds, with a single write to ``stream``. Requests
+arriving while ``capacity`` are buffered are dropped and counted, the count
+written to the log along with the next batch. What's buffered is flushed when
+the child exits.
+
+Lines are formatted by ``log_format`` like eventlet.wsgi does, or with
+``json=True`` as JSON objects of the same fields plus ``pid``. Errors eventlet
+logs still go to ``logger`` right away.
+"""
+
+import atexit
+import collections
+import json as json_
+import logging
+import os
+import sys
+
+import eventlet.patcher
+import eventlet.wsgi
+
+
+LOG = logging.getLogger(__name__)
+
+# The flush thread would be monkey patched into a greenthread otherwise
+_threading = eventlet.patcher.original('threading')
+
+
+class _Fields(dict):
+    """Fields of a request, as logged by eventlet.wsgi"""
+
+
+class _FieldsFormat(object):
+    """Used as eventlet.wsgi's log_format, leaves formatting to the thread"""
+
+    def __mod__(self, fields):
+        return _Fields(fields)
+
+
+class AccessLog(object):
+    """Buffered access log of a wsgi.Server, see the module docstring"""
+
+    def __init__(self, stream=None, capacity=8192, batch_size=256,
+                 flush_interval=1.0, json=False,
+                 log_format=eventlet.wsgi.DEFAULT_LOG_FORMAT, logger=None):
+        if batch_size > capacity:
+            raise ValueError("Batch size %d should not be more than capacity "
+                             "%d" % (batch_size, capacity))
+        self.stream = stream
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.json = json
+        self.log_format = log_format
+        self.logger = logger or logging.getLogger("eventlet.wsgi.server")
+        # what eventlet.wsgi formats with, see _FieldsFormat
+        self.fields_format = _FieldsFormat()
+
+        self.dropped = 0
+        self._dropped_logged = 0
+        self._buffer = collections.deque()
+        self._pid = None
+        self._wakeup = None
+        self._flush_lock = None
+
+    def start(self):
+        """Called in the child process, before serving requests"""
+
+        self._pid = os.getpid()
+        self._wakeup = _threading.Event()
+        self._flush_lock = _threading.Lock()
+        thread = _threading.Thread(target=self._run, name='access-log')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
+
+    # What eventlet.wsgi calls, see eventlet.wsgi.get_logger()
+
+    def info(self, msg, *args, **kwargs):
+        if not isinstance(msg, _Fields):
+            self.logger.info(msg, *args, **kwargs)
+            return
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self._buffer.append(msg)
+        if len(self._buffer) == self.batch_size:
+            self._wakeup.set()
+
+    def debug(self, msg, *args, **kwargs):
+        self.logger.debug(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.logger.error(msg, *args, **kwargs)
+
+    def _format(self, fields):
+        if self.json:
+            fields['pid'] = self._pid
+            return json_.dumps(fields, sort_keys=True)
+        return self.log_format % fields
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Writing access log failed")
+
+    def flush(self):
+        """Write everything buffered, in batches"""
+
+        if self._flush_lock is None:
+            return
+        stream = self.stream or sys.stderr
+        with self._flush_lock:
+            while True:
+                lines = []
+                while self._buffer and len(lines) < self.batch_size:
+                    lines.append(self._format(self._buffer.popleft()))
+                dropped = self.dropped
+                if dropped != self._dropped_logged:
+                    lines.append(self._format_dropped(
+                        dropped - self._dropped_logged))
+                    self._dropped_logged = dropped
+                if not lines:
+                    break
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+
+    def _format_dropped(self, count):
+        if self.json:
+            return json_.dumps({'pid': self._pid, 'dropped': count})
+        return "%d access log lines dropped, buffer full" % count
@@ -0,0 +1,238 @@
+"""Admission control of wsgi.Server, failing fast once a child is overloaded.
+
+Without it a child whose greenthread pool is full stops accepting, and
+connections wait in the kernel's accept queue until clients time out. Given an
+Admission, the server keeps accepting::
+
+    server = wsgi.Server(app=app, pool_size=1024,
+                         admission=admission.Admission(max_waiting=256,
+                                                       wait_timeout=0.5))
+
+Connections accepted while the pool is full wait in a queue of up to
+``max_waiting``, and are served first come first served as greenthreads free
+up. A connection arriving to a full queue, or waiting longer than
+``wait_timeout`` seconds, is answered right away with 503 Service Unavailable
+and ``Retry-After``, then closed. So are connections still waiting when the
+child is drained, a new child serves their retry.
+
+Requests can also be limited per route and per client. ``route_limits`` maps
+path prefixes to how many requests under each, the longest matching prefix,
+are served at once. ``client_limit`` is how many requests of each client
+address are. Requests over a limit are answered 503 too. A request counts
+until its response is sent, or for file bodies (see the files module) until
+the app returned.
+
+Shed requests are counted by reason in ``stats()``, and given ``metrics`` in
+the child's metrics slot.
+"""
+
+import collections
+import logging
+import socket
+import time
+
+import eventlet
+from eventlet import greenio
+
+from pyacc.server import files
+from pyacc.server import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+# Why requests were shed, and the metrics field counting each
+QUEUE_FULL = 'queue_full'
+DEADLINE = 'deadline'
+ROUTE_LIMIT = 'route_limit'
+CLIENT_LIMIT = 'client_limit'
+_SHED_FIELDS = {
+    QUEUE_FULL: metrics.SHED_QUEUE_FULL,
+    DEADLINE: metrics.SHED_DEADLINE,
+    ROUTE_LIMIT: metrics.SHED_ROUTE_LIMIT,
+    CLIENT_LIMIT: metrics.SHED_CLIENT_LIMIT,
+}
+
+_BODY = b'Server overloaded, retry later\n'
+
+
+class Admission(object):
+    """Admission control of a wsgi.Server, see the module docstring"""
+
+    def __init__(self, max_waiting=128, wait_timeout=1.0, retry_after=1,
+                 route_limits=None, client_limit=None, metrics=None):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.route_limits = dict(route_limits or {})
+        self.client_limit = client_limit
+        self.metrics = metrics
+
+        self.shed = dict((reason, 0) for reason in _SHED_FIELDS)
+        self.admitted_late = 0
+
+        # (deadline, connection) in arrival order, so in deadline order too
+        self._waiting = collections.deque()
+        self._expiry = None
+        # longest first, the first matching one applies
+        self._prefixes = sorted(self.route_limits, key=len, reverse=True)
+        # (kind, key) -> requests being served
+        self._in_flight = collections.defaultdict(int)
+        self._response = (
+            'HTTP/1.1 503 Service Unavailable\r\n'
+            'Retry-After: %d\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: close\r\n\r\n'
+            % (self.retry_after, len(_BODY))).encode('latin-1') + _BODY
+
+    def stats(self):
+        stats = dict(self.shed)
+        stats['waiting'] = len(self._waiting)
+        stats['admitted_late'] = self.admitted_late
+        return stats
+
+    def _count(self, reason):
+        self.shed[reason] += 1
+        if self.metrics is not None:
+            self.metrics.count(_SHED_FIELDS[reason])
+
+    # Connections, called by the accept loop of wsgi.Server
+
+    def wait(self, connection):
+        """Queue a connection accepted while the pool is full, connection
+        being eventlet.wsgi's [address, socket, state, ...]"""
+
+        if len(self._waiting) >= self.max_waiting:
+            self._reject(connection[1], QUEUE_FULL)
+            return
+        self._waiting.append((time.time() + self.wait_timeout, connection))
+        if self._expiry is None:
+            self._expiry = eventlet.spawn_after(self.wait_timeout,
+                                                self._expire)
+
+    def pop(self):
+        """The connection to serve next, None if none waits"""
+
+        self._expire_waiting(time.time())
+        if not self._waiting:
+            return None
+        self.admitted_late += 1
+        return self._waiting.popleft()[1]
+
+    def reject_waiting(self):
+        """Answer every waiting connection 503, once the server drains"""
+
+        while self._waiting:
+            self._reject(self._waiting.popleft()[1][1], DEADLINE)
+
+    def _expire_waiting(self, now):
+        while self._waiting and self._waiting[0][0] <= now:
+            self._reject(self._waiting.popleft()[1][1], DEADLINE)
+
+    def _expire(self):
+        self._expiry = None
+        self._expire_waiting(time.time())
+        if self._waiting:
+            delay = max(self._waiting[0][0] - time.time(), 0)
+            self._expiry = eventlet.spawn_after(delay, self._expire)
+
+    def _reject(self, sock, reason):
+        self._count(reason)
+        try:
+            sock.sendall(self._response)
+            # Unread request bytes would make close() send a reset, which can
+            # discard the response before the client reads it
+            sock.fd.recv(65536, socket.MSG_DONTWAIT)
+        except (socket.error, AttributeError):
+            pass
+        greenio.shutdown_safe(sock)
+        sock.close()
+
+    # Requests
+
+    def middleware(self, app):
+        return Middleware(app, self)
+
+
+class _Release(object):
+    """Response iterable releasing its request's limits once closed"""
+
+    def __init__(self, result, release):
+        self._result = result
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._result)
+
+    def close(self):
+        try:
+            if hasattr(self._result, 'close'):
+                self._result.close()
+        finally:
+            self._release()
+
+
+class Middleware(object):
+    """Applies the route and client limits of an Admission"""
+
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    def _limits(self, environ):
+        admission = self.admission
+        limits = []
+        if admission._prefixes:
+            path = (environ.get('SCRIPT_NAME', '') +
+                    environ.get('PATH_INFO', ''))
+            for prefix in admission._prefixes:
+                if path.startswith(prefix):
+                    limits.append((ROUTE_LIMIT, prefix,
+                                   admission.route_limits[prefix]))
+                    break
+        if admission.client_limit:
+            limits.append((CLIENT_LIMIT, environ.get('REMOTE_ADDR'),
+                           admission.client_limit))
+        return limits
+
+    def __call__(self, environ, start_response):
+        limits = self._limits(environ)
+        if not limits:
+            return self.app(environ, start_response)
+
+        in_flight = self.admission._in_flight
+        for reason, key, limit in limits:
+            if in_flight[reason, key] >= limit:
+                self.admission._count(reason)
+                start_response('503 Service Unavailable', [
+                    ('Retry-After', str(self.admission.retry_after)),
+                    ('Content-Type', 'text/plain'),
+                    ('Content-Length', str(len(_BODY)))])
+                return [_BODY]
+
+        for reason, key, _limit in limits:
+            in_flight[reason, key] += 1
+        released = []
+
+        def _release():
+            # once, whether the app raised or the response was closed
+            if released:
+                return
+            released.append(True)
+            for reason, key, _limit in limits:
+                in_flight[reason, key] -= 1
+                if not in_flight[reason, key]:
+                    del in_flight[reason, key]
+
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            # eventlet.Timeout and GreenletExit aren't Exceptions
+            _release()
+            raise
+        if isinstance(result, (list, tuple, files.FileWrapper, files.Blob)):
+            # computed already, file bodies are sent by the server after it
+            # sees their type
+            _release()
+            return result
+        return _Release(result, _release)
@@ -0,0 +1,141 @@
+"""Run asyncio services in the children of a process.Parent. Python 3 only.
+
+An AsyncService is started and stopped by coroutines, in an event loop the
+child creates after fork. Neither eventlet's hub nor greenthreads run in the
+child, so nothing needs to be monkey patched and asyncio native libraries can
+be used. The parent is the same process.Parent, which gets AsyncChild from
+the service's ``child_class``::
+
+    parent = process.Parent(asgi.Server(app), count=4)
+    parent.wait()
+
+Like process.Child, an AsyncChild stops its service on SIGTERM or SIGINT and
+exits with return code 1, drains it on SIGHUP and exits with 0, and exits when
+the parent dies. It handles messages of the parent and sends heartbeats the
+same way too.
+"""
+
+import abc
+import asyncio
+import logging
+import signal
+import sys
+
+from pyacc.server import process
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncChild(process.Child):
+    """Child process running an AsyncService in a new asyncio event loop"""
+
+    def _run_service(self):
+        # the parent's handlers are inherited until the loop's are set up
+        process._setup_signal_handler(signal.SIG_DFL)
+        if self.watchdog is not None:
+            LOG.warning('The watchdog needs an eventlet hub, not started')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            code = loop.run_until_complete(self._main(loop))
+        finally:
+            loop.close()
+        sys.exit(code)
+
+    async def _main(self, loop):
+        # (method name, return code) once the service should finish
+        self._exit = None
+        self._exit_event = asyncio.Event()
+
+        signals = [signal.SIGINT, signal.SIGTERM]
+        if process._sighup_supported():
+            signals.append(signal.SIGHUP)
+        for signo in signals:
+            loop.add_signal_handler(signo, self._signal_handler, signo, None)
+
+        loop.add_reader(self.channel.fd, self._read_channel, loop)
+        if self.heartbeat_interval is not None:
+            loop.call_soon(self._heartbeat, loop)
+
+        try:
+            await self.service.start()
+        except Exception:
+            LOG.exception('Child service raised error when starting')
+            return 1
+        if not getattr(self.service, 'notifies_ready', False):
+            self.notify_ready()
+
+        await self._exit_event.wait()
+        method, code = self._exit
+        try:
+            await getattr(self.service, method)()
+        except Exception:
+            LOG.exception('Child service raised error when %s',
+                          'draining' if method == 'drain' else 'stopping')
+            return 1
+        return code
+
+    def _finish(self, method, code):
+        if self._exit is None:
+            self._exit = (method, code)
+            self._exit_event.set()
+
+    def _signal_handler(self, signo, frame):
+        LOG.info('Child %(pid)d signal caught: %(sig_name)s',
+                 {'pid': self.pid, 'sig_name': process._signo_to_name(signo)})
+        self.signal_caught = signo
+        if process._sighup_supported() and signo == signal.SIGHUP:
+            self._finish('drain', 0)
+            return
+        # a second signal kills the child
+        asyncio.get_event_loop().remove_signal_handler(signo)
+        self._finish('stop', 1)
+
+    def _read_channel(self, loop):
+        """Handle messages of the parent, and make sure child exits if parent
+        dies, closing the channel"""
+
+        messages = self.channel.receive()
+        if messages is None:
+            loop.remove_reader(self.channel.fd)
+            LOG.info('Parent process died unexpectedly. Child exiting.')
+            self._finish('stop', 1)
+            return
+        for message in messages:
+            self.handle_message(message)
+
+    def _heartbeat(self, loop):
+        self.heartbeat()
+        loop.call_later(self.heartbeat_interval, self._heartbeat, loop)
+
+
+class AsyncService(abc.ABC):
+    """Service to be run by AsyncChild processes.
+
+    start() returns once the service is ready, e.g. listening, then runs
+    in tasks of its own until stop() is awaited. A service may also provide a
+    drain() coroutine, which finishes in-flight work before returning. Without
+    it draining stops the service.
+    """
+
+    child_class = AsyncChild
+    # Whether the service calls process.notify_ready() by itself, otherwise
+    # the child does once start() returns
+    notifies_ready = False
+
+    @abc.abstractmethod
+    async def start(self):
+        return
+
+    @abc.abstractmethod
+    async def stop(self):
+        return
+
+    async def drain(self):
+        await self.stop()
+
+    def preload(self):
+        """Optional. Called once in the parent before forking children, see
+        process.Service.preload()."""
+        return
@@ -0,0 +1,393 @@
+"""HTTP/1.1 server running an ASGI application in asyncio. Python 3 only.
+
+The asyncio counterpart of wsgi.Server: the listening socket is opened in the
+parent and shared by all children, each serving connections in its own event
+loop (see aio.AsyncChild)::
+
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'hello'})
+
+    parent = process.Parent(asgi.Server(app), count=4)
+    parent.wait()
+
+Only the ``http`` scope of ASGI 3 is served, neither websockets nor lifespan
+events. Request bodies are read whole before the app is called.
+"""
+
+import asyncio
+import http.client
+import logging
+import random
+import socket
+import time
+import urllib.parse
+
+from pyacc.common import utils
+from pyacc.server import aio
+from pyacc.server import process
+
+
+LOG = logging.getLogger(__name__)
+
+# Idle connections get this long to send a request after the server starts
+# draining
+DRAIN_GRACE = 1.0
+
+# Seconds between load reports to metrics
+LOAD_REPORT_INTERVAL = 1.0
+
+MAX_HEADER_LINE = 8192
+MAX_HEADERS = 100
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class _Connection(object):
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.task = asyncio.current_task()
+        self.busy = False
+        self.served = 0
+
+    def pending_input(self):
+        """Whether the client sent a request not read yet. Such connections
+        aren't closed as idle on drain, their request is served, then the
+        connection closed for draining."""
+
+        # the transport reads ahead into the reader's buffer
+        if getattr(self.reader, '_buffer', None):
+            return True
+        transport_socket = self.writer.get_extra_info('socket')
+        if transport_socket is None:
+            return False
+        sock = transport_socket.dup()
+        try:
+            return bool(sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+
+class Server(aio.AsyncService):
+    """The server to run an ASGI application, see the module docstring.
+
+    ``metrics``, ``max_requests`` and ``max_requests_jitter`` work as for
+    wsgi.Server. There is no greenthread pool, so the load reported to
+    metrics only has the requests being served, the accept backlog and the
+    event loop lag.
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=1234, backlog=128,
+                 family=socket.AF_INET, client_socket_timeout=900,
+                 metrics=None, max_requests=None, max_requests_jitter=0):
+        self.app = app
+        self.client_socket_timeout = client_socket_timeout
+        self.metrics = metrics
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(backlog)
+        (self.host, self.port) = self._socket.getsockname()[0:2]
+
+        self._server = None
+        self._connections = set()
+        self._draining = False
+        self._requests = 0
+        self._max_requests = None
+        self._report_task = None
+
+    async def start(self):
+        if self.max_requests:
+            # children all inherit the parent's random state
+            self._max_requests = (
+                self.max_requests +
+                random.SystemRandom().randint(0, self.max_requests_jitter))
+        LOG.info("Starting ASGI server")
+        self._server = await asyncio.start_server(
+            self._handle_connection, sock=self._socket,
+            limit=MAX_HEADER_LINE)
+        if self.metrics is not None:
+            self._report_task = asyncio.ensure_future(self._report_load())
+
+    async def stop(self):
+        LOG.info("Stopping ASGI server")
+        self._close()
+        tasks = [connection.task for connection in self._connections]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def drain(self):
+        LOG.info("Draining ASGI server")
+        self._close()
+        # a request sent meanwhile is answered with Connection: close
+        loop = asyncio.get_event_loop()
+        loop.call_later(DRAIN_GRACE, self._close_idle)
+        tasks = [connection.task for connection in self._connections]
+        if tasks:
+            await asyncio.wait(tasks)
+        LOG.info("ASGI server exited")
+
+    def _close(self):
+        self._draining = True
+        if self._report_task is not None:
+            self._report_task.cancel()
+        if self._server is not None:
+            self._server.close()
+
+    def _close_idle(self):
+        for connection in list(self._connections):
+            if not connection.busy and not connection.pending_input():
+                connection.task.cancel()
+
+    async def _report_load(self):
+        accept_backlog = 0
+        while True:
+            start = time.time()
+            await asyncio.sleep(LOAD_REPORT_INTERVAL)
+            # a busy loop runs the timer late
+            loop_lag = max(time.time() - start - LOAD_REPORT_INTERVAL, 0)
+            if self._socket.fileno() != -1:
+                accept_backlog = utils.read_accept_backlog(self._socket)
+            busy = sum(1 for connection in self._connections
+                       if connection.busy)
+            self.metrics.set_load(busy, 0, accept_backlog, loop_lag)
+
+    async def _handle_connection(self, reader, writer):
+        connection = _Connection(reader, writer)
+        self._connections.add(connection)
+        try:
+            while not self._draining or connection.served == 0:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(connection),
+                        self.client_socket_timeout)
+                except _BadRequest as exc:
+                    LOG.info("Bad request from %s: %s",
+                             writer.get_extra_info('peername'), exc)
+                    writer.write(b'HTTP/1.1 400 Bad Request\r\n'
+                                 b'Content-Length: 0\r\nConnection: close\r\n'
+                                 b'\r\n')
+                    break
+                if request is None:
+                    break
+                connection.busy = True
+                keep_alive = await self._handle_request(connection, *request)
+                connection.busy = False
+                connection.served += 1
+                self._count_request()
+                if not keep_alive:
+                    break
+        except (asyncio.CancelledError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(connection)
+            writer.close()
+
+    def _count_request(self):
+        self._requests += 1
+        if self._requests == self._max_requests:
+            LOG.info("Served %d requests, asking to be recycled",
+                     self._requests)
+            process.request_recycle()
+
+    async def _read_line(self, reader):
+        try:
+            return await reader.readuntil(b'\r\n')
+        except asyncio.LimitOverrunError:
+            raise _BadRequest("Line too long")
+
+    async def _read_request(self, connection):
+        """(method, target, version, headers, body), None on EOF"""
+
+        reader = connection.reader
+        try:
+            line = await self._read_line(reader)
+        except asyncio.IncompleteReadError as exc:
+            if not exc.partial:
+                return None
+            raise
+        parts = line.decode('latin-1').rstrip('\r\n').split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise _BadRequest("Malformed request line %r" % line)
+        method, target, version = parts
+
+        headers = []
+        while True:
+            line = await self._read_line(reader)
+            if line == b'\r\n':
+                break
+            if len(headers) == MAX_HEADERS:
+                raise _BadRequest("Too many headers")
+            name, colon, value = line.partition(b':')
+            if not colon:
+                raise _BadRequest("Malformed header %r" % line)
+            headers.append((name.strip().lower(), value.strip()))
+
+        header_dict = dict(headers)
+        if header_dict.get(b'expect', b'').lower() == b'100-continue':
+            connection.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if header_dict.get(b'transfer-encoding', b'').lower() == b'chunked':
+            body = await self._read_chunked(reader)
+        else:
+            try:
+                length = int(header_dict.get(b'content-length', 0))
+            except ValueError:
+                raise _BadRequest("Invalid Content-Length")
+            body = await reader.readexactly(length) if length > 0 else b''
+        return method, target, version, headers, body
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            line = await self._read_line(reader)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise _BadRequest("Invalid chunk size")
+            if size == 0:
+                # trailers
+                while await self._read_line(reader) != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def _scope(self, connection, method, target, version, headers):
+        path, _, query = target.partition('?')
+        return {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': version[len('HTTP/'):],
+            'method': method,
+            'scheme': 'http',
+            'path': urllib.parse.unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'client': connection.writer.get_extra_info('peername')[0:2],
+            'server': (self.host, self.port),
+        }
+
+    async def _handle_request(self, connection, method, target, version,
+                              headers, body):
+        """Call the app and write its response, True to keep the connection"""
+
+        writer = connection.writer
+        connection_header = dict(headers).get(b'connection', b'').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection_header == b'keep-alive'
+        else:
+            keep_alive = connection_header != b'close'
+        if self._draining:
+            keep_alive = False
+
+        # status, headers, whether chunked, whether done
+        response = {'status': None, 'chunked': False, 'done': False}
+        done = asyncio.Event()
+        body_sent = [False]
+
+        async def receive():
+            if not body_sent[0]:
+                body_sent[0] = True
+                return {'type': 'http.request', 'body': body,
+                        'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        def write_head(status, response_headers, content_length):
+            names = set(name.lower() for name, _ in response_headers)
+            reason = http.client.responses.get(status, '')
+            lines = ['HTTP/1.1 %d %s' % (status, reason)]
+            lines.extend('%s: %s' % (name.decode('latin-1'),
+                                     value.decode('latin-1'))
+                         for name, value in response_headers)
+            if b'content-length' not in names:
+                if content_length is not None:
+                    lines.append('Content-Length: %d' % content_length)
+                elif version == 'HTTP/1.1':
+                    lines.append('Transfer-Encoding: chunked')
+                    response['chunked'] = True
+                else:
+                    # the end of the body is told by closing the connection
+                    response['keep_alive'] = False
+            if not response.get('keep_alive', keep_alive):
+                lines.append('Connection: close')
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = list(message.get('headers', []))
+                return
+            if message['type'] != 'http.response.body' or response['done']:
+                return
+            if response['status'] is None:
+                raise RuntimeError("Response body sent before its start")
+            data = message.get('body', b'')
+            more = message.get('more_body', False)
+            if 'written' not in response:
+                response['written'] = True
+                # a body sent at once gets a Content-Length
+                write_head(response['status'], response['headers'],
+                           None if more else len(data))
+            if method != 'HEAD' and data:
+                if response['chunked']:
+                    writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    writer.write(data)
+            if not more:
+                if response['chunked'] and method != 'HEAD':
+                    writer.write(b'0\r\n\r\n')
+                response['done'] = True
+            await writer.drain()
+
+        measured = self.metrics is not None and self.metrics.slot is not None
+        if measured:
+            start = self.metrics.start_request()
+        error = False
+        try:
+            await self.app(self._scope(connection, method, target, version,
+                                       headers), receive, send)
+        except (asyncio.CancelledError, ConnectionError):
+            error = True
+            raise
+        except Exception:
+            error = True
+            LOG.exception("ASGI application raised error")
+            if 'written' in response:
+                # too late to tell the client, cut the response short
+                return False
+            response['status'] = None
+        finally:
+            done.set()
+            if measured:
+                status = response['status'] or 500
+                self.metrics.finish_request(start, error or status >= 500)
+
+        if response['status'] is None:
+            body = b'Internal Server Error'
+            writer.write(b'HTTP/1.1 500 Internal Server Error\r\n'
+                         b'Content-Type: text/plain\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n%s'
+                         % (len(body), body))
+            await writer.drain()
+            return False
+        if not response['done']:
+            # the app returned without finishing the body
+            await send({'type': 'http.response.body', 'body': b''})
+        return response.get('keep_alive', keep_alive)
+
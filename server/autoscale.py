@@ -0,0 +1,123 @@
+"""Grow and shrink the children of a process.Parent with their load.
+
+Children report their load to metrics (see ``metrics.Metrics.set_load()``),
+which an Autoscaler turns into a child count::
+
+    server_metrics = metrics.Metrics()
+    server = wsgi.Server(app=app, metrics=server_metrics)
+    parent = process.Parent(server, metrics=server_metrics,
+                            autoscaler=autoscale.Autoscaler(2, 16))
+
+The children are overloaded when their greenthread pools are mostly in use,
+connections queue up to be accepted, or their event loops lag, and underloaded
+when none of these is the case. Either has to last ``sustain`` checks in a row
+before the count changes, by one child at a time, and the count isn't changed
+again until a cooldown passes, longer for shrinking than growing, so the count
+doesn't flap with short bursts of traffic.
+"""
+
+import logging
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Autoscaler(object):
+    """Decide how many children to run, between min and max children.
+
+    ``high_utilisation`` and ``low_utilisation`` are fractions of the pools in
+    use above which the children are overloaded, and below which they may be
+    underloaded. ``max_backlog`` connections waiting to be accepted, or an
+    event loop ``max_loop_lag`` seconds late, overload them too.
+    """
+
+    def __init__(self, min_children=1, max_children=8, high_utilisation=0.75,
+                 low_utilisation=0.25, max_backlog=8, max_loop_lag=0.1,
+                 sustain=3, up_cooldown=10, down_cooldown=60, interval=1.0):
+        if min_children < 1:
+            raise ValueError("Min children %d should be at least one"
+                             % min_children)
+        if max_children < min_children:
+            raise ValueError("Max children %d should not be less than min "
+                             "children %d" % (max_children, min_children))
+        if low_utilisation >= high_utilisation:
+            raise ValueError("Low utilisation %s should be less than high "
+                             "utilisation %s"
+                             % (low_utilisation, high_utilisation))
+
+        self.min_children = min_children
+        self.max_children = max_children
+        self.high_utilisation = high_utilisation
+        self.low_utilisation = low_utilisation
+        self.max_backlog = max_backlog
+        self.max_loop_lag = max_loop_lag
+        self.sustain = sustain
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        # seconds between checks
+        self.interval = interval
+
+        self._overloaded_checks = 0
+        self._underloaded_checks = 0
+        self._last_change = None
+
+    def clamp(self, count):
+        return min(max(count, self.min_children), self.max_children)
+
+    @staticmethod
+    def _utilisation(loads):
+        size = sum(load['pool_size'] for load in loads)
+        if not size:
+            return 0.0
+        return float(sum(load['pool_busy'] for load in loads)) / size
+
+    def overloaded(self, loads):
+        backlog = max(load['accept_backlog'] for load in loads)
+        lag = max(load['loop_lag'] for load in loads)
+        return (self._utilisation(loads) >= self.high_utilisation or
+                backlog >= self.max_backlog or lag >= self.max_loop_lag)
+
+    def underloaded(self, loads):
+        backlog = max(load['accept_backlog'] for load in loads)
+        lag = max(load['loop_lag'] for load in loads)
+        return (self._utilisation(loads) <= self.low_utilisation and
+                backlog == 0 and lag < self.max_loop_lag / 2)
+
+    def decide(self, count, loads, now=None):
+        """The child count to run now, given the current count and the loads
+        (see ``metrics.Metrics.read_load()``) of the ready children"""
+
+        if now is None:
+            now = time.time()
+        if not loads:
+            return self.clamp(count)
+
+        if self.overloaded(loads):
+            self._overloaded_checks += 1
+            self._underloaded_checks = 0
+        elif self.underloaded(loads):
+            self._underloaded_checks += 1
+            self._overloaded_checks = 0
+        else:
+            self._overloaded_checks = 0
+            self._underloaded_checks = 0
+
+        since_change = (float('inf') if self._last_change is None
+                        else now - self._last_change)
+        target = count
+        if (self._overloaded_checks >= self.sustain and
+                since_change >= self.up_cooldown):
+            target = count + 1
+        elif (self._underloaded_checks >= self.sustain and
+                since_change >= self.down_cooldown):
+            target = count - 1
+        target = self.clamp(target)
+
+        if target != count:
+            LOG.info('Autoscaling from %(count)d to %(target)d child(ren)',
+                     {'count': count, 'target': target})
+            self._last_change = now
+            self._overloaded_checks = 0
+            self._underloaded_checks = 0
+        return target
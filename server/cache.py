@@ -0,0 +1,452 @@
+"""Cache of WSGI responses, in each child and optionally shared by children.
+
+::
+
+    # in the parent, before children are forked
+    shared = cache.SharedCache(entries=1024, entry_size=64 * 1024)
+    app = cache.ResponseCache(router, ttl=30, shared=shared, metrics=metrics)
+    server = wsgi.Server(app=app, metrics=metrics)
+
+Responses with status 200 to GET and HEAD are cached, keyed on method, path,
+query string and the request headers named in ``vary``. Responses setting a
+cookie, with Cache-Control no-store, no-cache or private, varying on other
+headers or bigger than ``max_entry_bytes`` aren't cached, and not buffered
+beyond that size either, nor are responses of apps calling start_response
+only once their iterable is iterated. A response is cached for ``ttl``
+seconds, or its Cache-Control max-age. It gets an ETag computed from its body
+unless the app gave one, and requests with a matching If-None-Match are
+answered 304 Not Modified.
+
+Requests with an Authorization or Cookie header may get a response meant for
+their client only, which the key doesn't tell apart. Their responses are
+cached, and they are answered from the cache, only when the response is
+Cache-Control public or has s-maxage.
+
+The first tier is an LRU of ``maxsize`` responses in each child. Requests
+missing a key being computed in the same child wait for that response instead
+of computing it again.
+
+The second tier, a SharedCache, lives in shared memory, so a response computed
+by one child is found by the others. It is direct mapped: each key has one
+entry, which the response of another key hashing to it replaces. Children
+missing the same key at the same time still compute it each.
+"""
+
+import errno
+import fcntl
+import hashlib
+import itertools
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import eventlet.event
+import six
+
+from pyacc.common import utils
+from pyacc.server import metrics
+
+
+# Headers a 304 response repeats from the cached response
+_NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'date', 'etag',
+                         'expires', 'vary')
+# Cache-Control directives of responses not to cache
+_UNCACHEABLE_DIRECTIVES = ('no-store', 'no-cache', 'private')
+# Cache-Control directives of responses shared by requests with credentials
+_PUBLIC_DIRECTIVES = ('public', 's-maxage')
+# Request headers of credentials
+_CREDENTIAL_KEYS = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE')
+
+# Digest of the key, expiry time and length of the data of a shared entry
+_SHARED_HEADER = struct.Struct('<16sdI')
+
+
+def _directives(cache_control):
+    """{directive: value or None} of a Cache-Control header"""
+
+    directives = {}
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def _public(directives):
+    return any(directive in directives for directive in _PUBLIC_DIRECTIVES)
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+class _Entry(object):
+    __slots__ = ('status', 'headers', 'body', 'etag', 'public', 'expires')
+
+    def __init__(self, status, headers, body, etag, public, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        # whether requests with credentials may be answered with it
+        self.public = public
+        self.expires = expires
+
+
+class _Streamed(object):
+    """Response iterable of the chunks collected before a response turned
+    out too big to cache, then the rest of the app's"""
+
+    def __init__(self, collected, iterator, result):
+        self._collected = collected
+        self._iterator = iterator
+        self._result = result
+
+    def __iter__(self):
+        return itertools.chain(self._collected, self._iterator)
+
+    def close(self):
+        if hasattr(self._result, 'close'):
+            self._result.close()
+
+
+class ResponseCache(object):
+    """WSGI middleware caching the responses of ``app``, see the module
+    docstring.
+
+    Hits, misses and evictions are counted in attributes of each child, and
+    given ``metrics`` in the child's metrics slot.
+    """
+
+    def __init__(self, app, ttl=60, maxsize=1024, vary=('Accept',
+                 'Accept-Encoding'), max_entry_bytes=256 * 1024, shared=None,
+                 metrics=None):
+        self.app = app
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.local = utils.LRUCache(maxsize)
+        self.shared = shared
+        self.metrics = metrics
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        # hits waiting for the response being computed
+        self.coalesced = 0
+
+        self._vary = set(name.lower() for name in vary)
+        self._vary_keys = ['HTTP_' + name.upper().replace('-', '_')
+                           for name in vary]
+        # key -> Event sent the entry, or None, once computed
+        self._inflight = {}
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.local.evictions,
+            'shared_evictions': (self.shared.evictions
+                                 if self.shared is not None else 0),
+            'size': len(self.local),
+        }
+
+    def _count(self, field):
+        if self.metrics is not None:
+            self.metrics.count(field)
+
+    def _key(self, environ):
+        parts = [environ['REQUEST_METHOD'],
+                 environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                 environ.get('QUERY_STRING', '')]
+        parts.extend(environ.get(key, '') for key in self._vary_keys)
+        return '\0'.join(parts)
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        key = self._key(environ)
+        credentials = any(name in environ for name in _CREDENTIAL_KEYS)
+        entry = self._lookup(key, time.time(), credentials)
+        if entry is None and key in self._inflight:
+            entry = self._inflight[key].wait()
+            if entry is not None and credentials and not entry.public:
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self.coalesced += 1
+                self._count(metrics.CACHE_HITS)
+        if entry is not None:
+            return self._respond(entry, environ, start_response)
+
+        self.misses += 1
+        self._count(metrics.CACHE_MISSES)
+        if key in self._inflight:
+            # the response just computed wasn't cacheable, another request
+            # computes it again
+            return self.app(environ, start_response)
+        return self._fill(key, environ, start_response, credentials)
+
+    def _lookup(self, key, now, credentials):
+        entry = self.local.get(key)
+        if entry is not None:
+            if entry.expires <= now:
+                self.local.pop(key)
+            elif credentials and not entry.public:
+                return None
+            else:
+                self.hits += 1
+                self._count(metrics.CACHE_HITS)
+                return entry
+
+        if self.shared is not None:
+            value = self.shared.get(key, now)
+            if value is not None:
+                entry = _Entry(*value)
+                self._store_local(key, entry)
+                if credentials and not entry.public:
+                    return None
+                self.shared_hits += 1
+                self._count(metrics.CACHE_SHARED_HITS)
+                return entry
+        return None
+
+    def _store_local(self, key, entry):
+        evictions = self.local.evictions
+        self.local.set(key, entry)
+        if self.local.evictions != evictions:
+            self._count(metrics.CACHE_EVICTIONS)
+
+    def _fill(self, key, environ, start_response, credentials):
+        event = eventlet.event.Event()
+        self._inflight[key] = event
+        entry = None
+        try:
+            entry, result = self._call(environ, start_response, credentials)
+        finally:
+            del self._inflight[key]
+            event.send(entry)
+        if entry is None:
+            return result
+
+        self._store_local(key, entry)
+        if self.shared is not None:
+            value = (entry.status, entry.headers, entry.body, entry.etag,
+                     entry.public, entry.expires)
+            if self.shared.set(key, value, time.time()):
+                self._count(metrics.CACHE_SHARED_EVICTIONS)
+        return self._respond(entry, environ, start_response)
+
+    def _call(self, environ, start_response, credentials):
+        """Call the app, returns (entry, None) for a response to cache,
+        otherwise (None, response iterable)"""
+
+        state = {'collect': True, 'size': 0}
+        body = []
+
+        def _write(data):
+            if 'write' in state:
+                state['write'](data)
+                return
+            body.append(data)
+            state['size'] += len(data)
+
+        def _start_response(status, headers, exc_info=None):
+            if (state['collect'] and exc_info is None and
+                    self._cacheable(status, headers, credentials)):
+                state['response'] = (status, headers)
+                return _write
+            state['collect'] = False
+            state['passed'] = True
+            return start_response(status, headers, exc_info)
+
+        result = self.app(environ, _start_response)
+        # start_response called from now on, by an iterator, passes through
+        state['collect'] = False
+        if 'response' not in state:
+            return None, result
+
+        iterator = iter(result)
+        streamed = False
+        try:
+            for chunk in iterator:
+                _write(chunk)
+                if (state['size'] > self.max_entry_bytes and
+                        'passed' not in state):
+                    # without Content-Length, too big to cache is only known
+                    # now, the rest is sent as the app yields it
+                    streamed = True
+                    break
+        finally:
+            if not streamed and hasattr(result, 'close'):
+                result.close()
+        if streamed:
+            state['write'] = start_response(*state['response'])
+            return None, _Streamed(body, iterator, result)
+        if 'passed' in state:
+            # the app started over with an error response
+            return None, body
+
+        status, headers = state['response']
+        body = b''.join(body)
+        if len(body) > self.max_entry_bytes:
+            start_response(status, headers)
+            return None, [body]
+        return self._entry(status, headers, body), None
+
+    def _cacheable(self, status, headers, credentials):
+        if not status.startswith('200'):
+            return False
+        public = False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'cache-control':
+                directives = _directives(value)
+                if any(directive in directives
+                       for directive in _UNCACHEABLE_DIRECTIVES):
+                    return False
+                public = public or _public(directives)
+            if name == 'vary':
+                varied = set(header.strip().lower()
+                             for header in value.split(','))
+                if not varied <= self._vary:
+                    return False
+            if name == 'content-length':
+                try:
+                    if int(value) > self.max_entry_bytes:
+                        return False
+                except ValueError:
+                    # the size of the body isn't known
+                    return False
+        return public or not credentials
+
+    def _entry(self, status, headers, body):
+        headers = list(headers)
+        ttl = self.ttl
+        etag = None
+        public = False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'etag':
+                etag = value
+            elif name == 'cache-control':
+                directives = _directives(value)
+                max_age = directives.get('max-age')
+                if max_age and max_age.isdigit():
+                    ttl = int(max_age)
+                public = public or _public(directives)
+        if etag is None:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            headers.append(('ETag', etag))
+        return _Entry(status, headers, body, etag, public, time.time() + ttl)
+
+    @staticmethod
+    def _not_modified(environ, etag):
+        header = environ.get('HTTP_IF_NONE_MATCH')
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or _strip_weak(etag) in [_strip_weak(tag)
+                                                   for tag in tags]
+
+    def _respond(self, entry, environ, start_response):
+        if self._not_modified(environ, entry.etag):
+            start_response('304 Not Modified',
+                           [(name, value) for name, value in entry.headers
+                            if name.lower() in _NOT_MODIFIED_HEADERS])
+            return []
+        start_response(entry.status, list(entry.headers))
+        return [entry.body]
+
+
+class SharedCache(object):
+    """Direct mapped cache of ``entries`` responses in shared memory, each up
+    to ``entry_size`` bytes including its headers.
+
+    Create it in the parent before children are forked. Entries are locked
+    with byte range locks, a child finding the entry of a key locked, by
+    another child writing it, misses rather than waits.
+    """
+
+    def __init__(self, entries=1024, entry_size=64 * 1024):
+        if entry_size <= _SHARED_HEADER.size:
+            raise ValueError("Entry size %d should be more than %d"
+                             % (entry_size, _SHARED_HEADER.size))
+        self.entries = entries
+        self.entry_size = entry_size
+        # live entries of other keys replaced, by this process
+        self.evictions = 0
+
+        # A file rather than anonymous memory, for its byte range locks
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.truncate(entries * entry_size)
+        self._mmap = mmap.mmap(self._file.fileno(), entries * entry_size)
+
+    def _locate(self, key):
+        if isinstance(key, six.text_type):
+            key = key.encode('latin-1')
+        digest = hashlib.sha1(key).digest()[:16]
+        index = struct.unpack_from('<Q', digest)[0] % self.entries
+        return digest, index * self.entry_size
+
+    def _lock(self, operation, offset):
+        try:
+            fcntl.lockf(self._file.fileno(), operation | fcntl.LOCK_NB,
+                        self.entry_size, offset)
+        except (IOError, OSError) as exc:
+            if exc.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        return True
+
+    def _unlock(self, offset):
+        fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN, self.entry_size,
+                    offset)
+
+    def get(self, key, now):
+        """The value stored for key, None if missing or expired"""
+
+        digest, offset = self._locate(key)
+        if not self._lock(fcntl.LOCK_SH, offset):
+            return None
+        try:
+            stored, expires, length = _SHARED_HEADER.unpack_from(self._mmap,
+                                                                 offset)
+            if stored != digest or expires <= now:
+                return None
+            start = offset + _SHARED_HEADER.size
+            data = self._mmap[start:start + length]
+        finally:
+            self._unlock(offset)
+        return marshal.loads(data)
+
+    def set(self, key, value, now):
+        """Store value, a tuple whose last item is its expiry time. Returns
+        whether a live entry of another key was evicted."""
+
+        data = marshal.dumps(value)
+        if len(data) > self.entry_size - _SHARED_HEADER.size:
+            return False
+        digest, offset = self._locate(key)
+        if not self._lock(fcntl.LOCK_EX, offset):
+            return False
+        try:
+            stored, expires, _length = _SHARED_HEADER.unpack_from(self._mmap,
+                                                                  offset)
+            evicted = stored != digest and expires > now
+            start = offset + _SHARED_HEADER.size
+            self._mmap[start:start + len(data)] = data
+            _SHARED_HEADER.pack_into(self._mmap, offset, digest, value[-1],
+                                     len(data))
+        finally:
+            self._unlock(offset)
+        if evicted:
+            self.evictions += 1
+        return evicted
@@ -0,0 +1,334 @@
+"""File and large bodies served by wsgi.Server without copying them through
+Python.
+
+wsgi.Server puts FileWrapper in the environ as ``wsgi.file_wrapper`` (PEP
+3333). A response body wrapping a regular file is sent with os.sendfile(), the
+kernel copying from the page cache to the socket::
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/zip')])
+        return environ['wsgi.file_wrapper'](open(path, 'rb'))
+
+A Blob is a body kept in memory, like a pre-rendered export or a file mapped
+with Blob.from_file(). Built in the parent before fork, its pages are shared by
+all children, and it is sent from a memoryview without being copied::
+
+    BLOB = files.Blob.from_file('/srv/exports/latest.csv')
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/csv')])
+        return BLOB
+
+For both, the server sets Content-Length and Accept-Ranges, and answers a
+single range request on a 200 response with 206 Partial Content, or 416 if
+the range is beyond the end. Without sendfile, over TLS, files are mapped and
+sent like blobs. A FileCache keeps files open between requests.
+
+Middleware wrapping the response iterable, like that of metrics, hands a
+FileWrapper or Blob on as its ``file_body`` attribute. The body is sent the
+same way, and the wrapper closed once it is.
+"""
+
+import errno
+import mmap
+import os
+import socket
+import stat
+
+import eventlet
+import eventlet.hubs
+
+from pyacc.common import utils
+
+
+# Bytes sent by one os.sendfile() call, the hub runs other greenthreads in
+# between
+SENDFILE_CHUNK = 256 * 1024
+
+
+class FileWrapper(object):
+    """``wsgi.file_wrapper``, see the module docstring.
+
+    Iterated in blocks of ``blksize`` bytes when not served by wsgi.Server,
+    e.g. by a middleware reading the body.
+    """
+
+    def __init__(self, filelike, blksize=64 * 1024):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+    def extent(self):
+        """(fd, offset, size) of what's left to send, None if it isn't a
+        regular file"""
+
+        try:
+            fd = self.filelike.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        file_stat = os.fstat(fd)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        offset = self.filelike.tell() if hasattr(self.filelike, 'tell') else 0
+        return fd, offset, max(file_stat.st_size - offset, 0)
+
+    def send(self, sock, start, length):
+        fd, offset, _size = self.extent()
+        if hasattr(os, 'sendfile') and not hasattr(sock, 'do_handshake'):
+            _sendfile(sock, fd, offset + start, length)
+            return
+        if offset + start + length == 0:
+            return
+        data = mmap.mmap(fd, offset + start + length, access=mmap.ACCESS_READ)
+        try:
+            _send_view(sock, memoryview(data)[offset + start:], length)
+        finally:
+            data.close()
+
+
+class Blob(object):
+    """Body kept in memory, see the module docstring. ``data`` is bytes or a
+    buffer like an mmap."""
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_file(cls, path):
+        """A blob of the content of a file, mapped read only"""
+
+        with open(path, 'rb') as blob_file:
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(blob_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ))
+
+    def __iter__(self):
+        yield self.data[:]
+
+    def extent(self):
+        return None, 0, len(self.data)
+
+    def send(self, sock, start, length):
+        _send_view(sock, memoryview(self.data)[start:], length)
+
+
+class _OpenFile(object):
+    """A file of a FileCache, closed once evicted and no longer sent"""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        file_stat = os.fstat(self.fd)
+        self.identity = (file_stat.st_ino, file_stat.st_size,
+                         file_stat.st_mtime)
+        self.users = 0
+        self.evicted = False
+
+    def release(self):
+        self.users -= 1
+        if self.evicted and self.users == 0:
+            os.close(self.fd)
+
+
+class _CachedFile(object):
+    """File-like of a FileWrapper over a FileCache file"""
+
+    def __init__(self, open_file):
+        self._file = open_file
+        self._file.users += 1
+        self._position = 0
+
+    def fileno(self):
+        return self._file.fd
+
+    def tell(self):
+        return self._position
+
+    def read(self, size):
+        # the fd is shared, its offset can't be relied on
+        os.lseek(self._file.fd, self._position, os.SEEK_SET)
+        data = os.read(self._file.fd, size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.release()
+            self._file = None
+
+
+class FileCache(object):
+    """Keeps up to ``maxsize`` files open for FileWrapper bodies, saving the
+    open() and close() of each request. A file changed on disk since it was
+    opened is opened again."""
+
+    def __init__(self, maxsize=128):
+        self._files = utils.LRUCache(maxsize, on_evict=self._evicted)
+
+    @staticmethod
+    def _evicted(_path, open_file):
+        open_file.evicted = True
+        if open_file.users == 0:
+            os.close(open_file.fd)
+
+    def wrap(self, path):
+        """A FileWrapper of the file at path, raising OSError like open()"""
+
+        file_stat = os.stat(path)
+        open_file = self._files.get(path)
+        if open_file is not None and open_file.identity != (
+                file_stat.st_ino, file_stat.st_size, file_stat.st_mtime):
+            self._evicted(path, self._files.pop(path))
+            open_file = None
+        if open_file is None:
+            open_file = _OpenFile(path)
+            self._files.set(path, open_file)
+        return FileWrapper(_CachedFile(open_file))
+
+
+def _sendfile(sock, fd, offset, length):
+    out_fd = sock.fileno()
+    timeout = sock.gettimeout()
+    while length > 0:
+        try:
+            sent = os.sendfile(out_fd, fd, offset, min(length, SENDFILE_CHUNK))
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            eventlet.hubs.trampoline(out_fd, write=True, timeout=timeout,
+                                     timeout_exc=socket.timeout('timed out'))
+            continue
+        if sent == 0:
+            raise IOError("File shrank by %d bytes while being sent" % length)
+        offset += sent
+        length -= sent
+        eventlet.sleep(0)
+
+
+def _send_view(sock, view, length):
+    position = 0
+    while position < length:
+        end = min(position + SENDFILE_CHUNK, length)
+        sock.sendall(view[position:end])
+        position = end
+
+
+def _parse_range(header, size):
+    """(start, length) of a single byte range, None to send the whole body,
+    False if the range is beyond the end"""
+
+    units, _, ranges = header.partition('=')
+    if units.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix == 0:
+                return False
+            start, end = max(size - suffix, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, end - start + 1
+
+
+def _range(environ, status, headers, size):
+    """(status, headers, start, length) to send"""
+
+    headers = [(name, value) for name, value in headers
+               if name.lower() not in ('content-length', 'accept-ranges')]
+    headers.append(('Accept-Ranges', 'bytes'))
+    header = environ.get('HTTP_RANGE')
+    if_range = environ.get('HTTP_IF_RANGE')
+    if header and if_range:
+        validators = [value for name, value in headers
+                      if name.lower() in ('etag', 'last-modified')]
+        if if_range not in validators:
+            header = None
+    byte_range = None
+    if header and status.startswith('200'):
+        byte_range = _parse_range(header, size)
+    if byte_range is False:
+        return ('416 Range Not Satisfiable',
+                [('Content-Range', 'bytes */%d' % size),
+                 ('Content-Length', '0')], 0, 0)
+    if byte_range is None:
+        headers.append(('Content-Length', str(size)))
+        return status, headers, 0, size
+    start, length = byte_range
+    headers.append(('Content-Range', 'bytes %d-%d/%d'
+                    % (start, start + length - 1, size)))
+    headers.append(('Content-Length', str(length)))
+    return '206 Partial Content', headers, start, length
+
+
+def respond(app, sock, environ, start_response):
+    """Call app, sending FileWrapper and Blob bodies to sock itself. Used by
+    the HTTP protocol of wsgi.Server."""
+
+    response = {}
+
+    def _start():
+        if 'write' not in response:
+            response['write'] = start_response(*response['args'])
+        return response['write']
+
+    def _write(data):
+        _start()(data)
+
+    def _start_response(status, headers, exc_info=None):
+        response['args'] = (status, headers, exc_info)
+        if response.get('passed'):
+            response.pop('write', None)
+            return _start()
+        return _write
+
+    result = app(environ, _start_response)
+    # start_response called from now on, by an iterator, isn't deferred
+    response['passed'] = True
+    body = getattr(result, 'file_body', result)
+    if ('args' not in response or 'write' in response or
+            not isinstance(body, (FileWrapper, Blob))):
+        if 'args' in response:
+            _start()
+        return result
+
+    try:
+        extent = body.extent()
+        if extent is None:
+            _start()
+            # not a regular file, iterated by the server
+            return result
+        status, headers, _exc_info = response['args']
+        status, headers, start, length = _range(environ, status, headers,
+                                                extent[2])
+        # write() of the server sends the headers
+        start_response(status, headers)(b'')
+        if length and environ['REQUEST_METHOD'] != 'HEAD':
+            body.send(sock, start, length)
+    except Exception:
+        if hasattr(result, 'close'):
+            result.close()
+        raise
+    if hasattr(result, 'close'):
+        result.close()
+    return []
@@ -0,0 +1,149 @@
+"""Listening sockets for wsgi.Server besides its own TCP one.
+
+A server given ``listeners`` accepts on each of them, instead of listening on
+``host`` and ``port``::
+
+    server = wsgi.Server(app=app, listeners=[
+        listeners.unix('/run/app/http.sock', mode=0o660, group='proxy'),
+        eventlet.listen(('127.0.0.1', 8080)),
+    ])
+
+A Unix domain socket spares a reverse proxy on the same host the TCP/IP stack
+of loopback. unix() creates it with ``mode`` and, given by name or id,
+``owner`` and ``group``, all set before it listens so no client connects
+before. A socket file left by a server that died is removed, a path a running
+server listens on, or that isn't a socket, raises socket.error with EADDRINUSE
+like a TCP port in use. The file is left behind on exit.
+
+inherited() adopts sockets listening already, opened by the process starting
+this one. Without arguments they are passed like systemd's socket activation
+does: fds from 3 on, as many as ``LISTEN_FDS`` in the environment, if
+``LISTEN_PID`` is the pid of this process. So a supervisor can keep them open
+while restarting the server, and no connection is refused meanwhile. Fds given
+some other way, like on the command line, are passed as ``fds``::
+
+    parser.add_argument('--listen-fd', type=int, action='append')
+    ...
+    server = wsgi.Server(app=app,
+                         listeners=listeners.inherited(args.listen_fd))
+
+Adopting fds needs Python 3.
+"""
+
+import errno
+import grp
+import logging
+import os
+import pwd
+import socket
+import stat
+
+from eventlet import greenio
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+# First fd passed by socket activation, SD_LISTEN_FDS_START of systemd
+LISTEN_FDS_START = 3
+
+
+def unix(path, backlog=128, mode=None, owner=None, group=None):
+    """A listening Unix domain socket at path, see the module docstring"""
+
+    _remove_stale(path)
+    sock = greenio.GreenSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        if mode is not None:
+            os.chmod(path, mode)
+        if owner is not None or group is not None:
+            os.chown(path, _uid(owner), _gid(group))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    LOG.info("Listening on unix socket %s", path)
+    return sock
+
+
+def _remove_stale(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise socket.error(errno.EADDRINUSE,
+                           "%s exists and isn't a socket" % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as exc:
+        if exc.errno != errno.ECONNREFUSED:
+            raise
+        LOG.info("Removing stale unix socket %s", path)
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise socket.error(errno.EADDRINUSE,
+                       "A server is listening on %s already" % path)
+
+
+def _uid(owner):
+    if owner is None:
+        return -1
+    if isinstance(owner, six.integer_types):
+        return owner
+    return pwd.getpwnam(owner).pw_uid
+
+
+def _gid(group):
+    if group is None:
+        return -1
+    if isinstance(group, six.integer_types):
+        return group
+    return grp.getgrnam(group).gr_gid
+
+
+def inherited(fds=None, environ=None):
+    """The listening sockets of fds, or passed by socket activation, see the
+    module docstring"""
+
+    if fds is None:
+        fds = activation_fds(environ)
+    if fds and not six.PY3:
+        raise ValueError("Adopting inherited fds needs Python 3")
+    return [adopt(fd) for fd in fds]
+
+
+def activation_fds(environ=None):
+    """Fds passed by socket activation, [] if none were"""
+
+    if environ is None:
+        environ = os.environ
+    try:
+        pid = int(environ.get('LISTEN_PID', ''))
+        count = int(environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    if pid != os.getpid():
+        # meant for the process that started this one
+        return []
+    return list(range(LISTEN_FDS_START, LISTEN_FDS_START + count))
+
+
+def adopt(fd):
+    """A green socket of an inherited fd, which has to be listening"""
+
+    sock = socket.socket(fileno=fd)
+    if sock.type != socket.SOCK_STREAM or not sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+        sock.detach()
+        raise ValueError("Inherited fd %d is not a listening stream socket"
+                         % fd)
+    sock.set_inheritable(False)
+    LOG.info("Listening on inherited fd %d, %s", fd, sock.getsockname())
+    return greenio.GreenSocket(sock)
@@ -0,0 +1,389 @@
+"""Request metrics of all children, served by the parent for Prometheus.
+
+The parent allocates a shared memory region before forking, with a slot of
+counters for each child. A child only ever writes its own slot, so recording a
+request takes no lock and no system call. The parent reads all slots when it
+is scraped::
+
+    metrics = Metrics()
+    metrics.serve(port=9100)
+    server = wsgi.Server(app=app, metrics=metrics)
+    parent = process.Parent(server, count=4, metrics=metrics)
+    parent.wait()
+
+Slots are reused by restarted children, which keep counting from where the
+previous child left, so counters of a worker slot never go backwards.
+"""
+
+import bisect
+import ctypes
+import logging
+import mmap
+import os
+import time
+
+import eventlet
+import eventlet.wsgi
+
+from pyacc.common import config
+
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# Fields of a child slot
+PID = 0
+REQUESTS = 1
+# requests answered with a 5xx status or raising an error
+ERRORS = 2
+IN_FLIGHT = 3
+# load, reported periodically by the child, see set_load()
+POOL_BUSY = 4
+POOL_SIZE = 5
+ACCEPT_BACKLOG = 6
+# microseconds
+LOOP_LAG = 7
+# microseconds
+LATENCY_SUM = 8
+# the first of len(LATENCY_BUCKETS) + 1 bucket counters, the last is +Inf
+LATENCY_BUCKET = 9
+# response cache, see cache.ResponseCache
+CACHE_HITS = LATENCY_BUCKET + len(LATENCY_BUCKETS) + 1
+CACHE_SHARED_HITS = CACHE_HITS + 1
+CACHE_MISSES = CACHE_HITS + 2
+CACHE_EVICTIONS = CACHE_HITS + 3
+CACHE_SHARED_EVICTIONS = CACHE_HITS + 4
+# requests shed by admission control, see admission.Admission
+SHED_QUEUE_FULL = CACHE_SHARED_EVICTIONS + 1
+SHED_DEADLINE = SHED_QUEUE_FULL + 1
+SHED_ROUTE_LIMIT = SHED_QUEUE_FULL + 2
+SHED_CLIENT_LIMIT = SHED_QUEUE_FULL + 3
+# connections of wsgi.Server, see wsgi.Server(max_idle_connections)
+CONNECTIONS_OPEN = SHED_CLIENT_LIMIT + 1
+CONNECTIONS_IDLE = CONNECTIONS_OPEN + 1
+CONNECTIONS_REAPED = CONNECTIONS_OPEN + 2
+SLOT_FIELDS = CONNECTIONS_REAPED + 1
+
+# Fields of the parent
+CHILDREN_STARTED = 0
+CHILDREN_EXITED = 1
+# children exiting with non-zero return code
+CHILDREN_FAILED = 2
+PARENT_FIELDS = 3
+
+_WORD = ctypes.sizeof(ctypes.c_uint64)
+
+
+class Metrics(object):
+    """Shared memory counters of the parent and up to ``slots`` children.
+
+    Children started while all slots are in use aren't measured, so give
+    enough slots for twice the children, as a rolling reload runs old and new
+    children side by side.
+    """
+
+    def __init__(self, slots=64, prefix=config.PROJECT_NAME):
+        self.slots = slots
+        self.prefix = prefix
+
+        # anonymous mmap is MAP_SHARED, children write to the same pages
+        self._mmap = mmap.mmap(-1, (PARENT_FIELDS + slots * SLOT_FIELDS) *
+                               _WORD)
+        self.parent = (ctypes.c_uint64 * PARENT_FIELDS).from_buffer(self._mmap)
+        self._slots = [
+            (ctypes.c_uint64 * SLOT_FIELDS).from_buffer(
+                self._mmap, (PARENT_FIELDS + i * SLOT_FIELDS) * _WORD)
+            for i in range(slots)]
+
+        # parent side bookkeeping
+        self._free = list(range(slots))
+        self._used = set()
+        self._server_socket = None
+
+        # the slot of this child, None in the parent
+        self.slot = None
+        # callables of the parent returning more metrics to render, as
+        # [(name, type, help, [(labels, value)])]
+        self.collectors = []
+
+    def acquire_slot(self):
+        """Called in the parent before forking a child, returns the index of
+        its slot, None if all slots are in use"""
+
+        self.parent[CHILDREN_STARTED] += 1
+        if not self._free:
+            LOG.warning('All %d metrics slots are in use, child not measured',
+                        self.slots)
+            return None
+        index = self._free.pop(0)
+        self._used.add(index)
+        return index
+
+    def release_slot(self, index, return_code=0):
+        """Called in the parent after the child of the slot exited"""
+
+        self.parent[CHILDREN_EXITED] += 1
+        if return_code != 0:
+            self.parent[CHILDREN_FAILED] += 1
+        if index is None:
+            return
+        slot = self._slots[index]
+        # gauges of a dead child, counters carry on
+        for field in (PID, IN_FLIGHT, POOL_BUSY, POOL_SIZE, ACCEPT_BACKLOG,
+                      LOOP_LAG):
+            slot[field] = 0
+        self._free.append(index)
+        self._free.sort()
+
+    def bind(self, index):
+        """Called in the child after fork"""
+
+        if self._server_socket is not None:
+            self._server_socket.close()
+            self._server_socket = None
+        if index is None:
+            return
+        self.slot = self._slots[index]
+        self.slot[PID] = os.getpid()
+
+    def start_request(self):
+        """Called in the child when a request comes in, returns the start time
+        to give to finish_request()"""
+
+        self.slot[IN_FLIGHT] += 1
+        return time.time()
+
+    def finish_request(self, start, error=False):
+        self.slot[IN_FLIGHT] -= 1
+        self.record(time.time() - start, error)
+
+    def record(self, duration, error=False):
+        slot = self.slot
+        slot[REQUESTS] += 1
+        if error:
+            slot[ERRORS] += 1
+        slot[LATENCY_SUM] += int(duration * 1000000)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        slot[LATENCY_BUCKET + bucket] += 1
+
+    def count(self, field, value=1):
+        """Called in the child to add to a counter of its slot"""
+
+        if self.slot is not None:
+            self.slot[field] += value
+
+    def set_load(self, pool_busy, pool_size, accept_backlog, loop_lag):
+        """Called in the child to report how busy it is, loop_lag in seconds"""
+
+        slot = self.slot
+        if slot is None:
+            return
+        slot[POOL_BUSY] = pool_busy
+        slot[POOL_SIZE] = pool_size
+        slot[ACCEPT_BACKLOG] = accept_backlog
+        slot[LOOP_LAG] = int(loop_lag * 1000000)
+
+    def set_connections(self, open_, idle):
+        """Called in the child to report its open and idle connections"""
+
+        slot = self.slot
+        if slot is None:
+            return
+        slot[CONNECTIONS_OPEN] = open_
+        slot[CONNECTIONS_IDLE] = idle
+
+    def read_load(self, index):
+        """Called in the parent, the last load reported to the slot"""
+
+        slot = self._slots[index]
+        return {'pool_busy': slot[POOL_BUSY],
+                'pool_size': slot[POOL_SIZE],
+                'accept_backlog': slot[ACCEPT_BACKLOG],
+                'loop_lag': slot[LOOP_LAG] / 1000000.0}
+
+    def middleware(self, app):
+        return Middleware(app, self)
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+
+        lines = []
+        prefix = self.prefix
+
+        def metric(name, type_, help_, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, type_))
+            for labels, value in samples:
+                lines.append('%s_%s%s %s' % (prefix, name, labels, value))
+
+        metric('children_started_total', 'counter', 'Children forked.',
+               [('', self.parent[CHILDREN_STARTED])])
+        metric('children_exited_total', 'counter', 'Children exited.',
+               [('', self.parent[CHILDREN_EXITED])])
+        metric('children_failed_total', 'counter',
+               'Children exited with non-zero return code.',
+               [('', self.parent[CHILDREN_FAILED])])
+
+        used = sorted(self._used)
+        slots = [('{worker="%d"}' % i, self._slots[i]) for i in used]
+        metric('worker_up', 'gauge',
+               'Whether a child runs in the worker slot.',
+               [(labels, int(slot[PID] != 0)) for labels, slot in slots])
+        metric('requests_total', 'counter', 'Requests served.',
+               [(labels, slot[REQUESTS]) for labels, slot in slots])
+        metric('request_errors_total', 'counter',
+               'Requests failed or answered with a 5xx status.',
+               [(labels, slot[ERRORS]) for labels, slot in slots])
+        metric('requests_in_flight', 'gauge', 'Requests being served.',
+               [(labels, slot[IN_FLIGHT]) for labels, slot in slots])
+        metric('pool_busy', 'gauge', 'Greenthreads of the pool in use.',
+               [(labels, slot[POOL_BUSY]) for labels, slot in slots])
+        metric('pool_size', 'gauge', 'Size of the greenthread pool.',
+               [(labels, slot[POOL_SIZE]) for labels, slot in slots])
+        metric('accept_backlog', 'gauge',
+               'Connections waiting in the accept queue.',
+               [(labels, slot[ACCEPT_BACKLOG]) for labels, slot in slots])
+        metric('loop_lag_seconds', 'gauge',
+               'How late the event loop ran a timer.',
+               [(labels, '%.6f' % (slot[LOOP_LAG] / 1000000.0))
+                for labels, slot in slots])
+
+        # one histogram summed over all workers
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        latency_sum = 0
+        for _labels, slot in slots:
+            latency_sum += slot[LATENCY_SUM]
+            for i in range(len(buckets)):
+                buckets[i] += slot[LATENCY_BUCKET + i]
+        samples = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+            cumulative += count
+            samples.append(('_bucket{le="%s"}' % bound, cumulative))
+        samples.append(('_sum', '%.6f' % (latency_sum / 1000000.0)))
+        samples.append(('_count', cumulative))
+        metric('request_duration_seconds', 'histogram',
+               'Time to serve a request, including sending its body.', samples)
+
+        def tiers(local, shared):
+            samples = []
+            for labels, slot in slots:
+                samples.append(('%s,tier="local"}' % labels[:-1], slot[local]))
+                samples.append(('%s,tier="shared"}' % labels[:-1],
+                                slot[shared]))
+            return samples
+
+        metric('cache_hits_total', 'counter',
+               'Responses served from the response cache.',
+               tiers(CACHE_HITS, CACHE_SHARED_HITS))
+        metric('cache_misses_total', 'counter',
+               'Responses not found in the response cache.',
+               [(labels, slot[CACHE_MISSES]) for labels, slot in slots])
+        metric('cache_evictions_total', 'counter',
+               'Live responses evicted from the response cache.',
+               tiers(CACHE_EVICTIONS, CACHE_SHARED_EVICTIONS))
+
+        samples = []
+        for labels, slot in slots:
+            for reason, field in (('queue_full', SHED_QUEUE_FULL),
+                                  ('deadline', SHED_DEADLINE),
+                                  ('route_limit', SHED_ROUTE_LIMIT),
+                                  ('client_limit', SHED_CLIENT_LIMIT)):
+                samples.append(('%s,reason="%s"}' % (labels[:-1], reason),
+                                slot[field]))
+        metric('requests_shed_total', 'counter',
+               'Requests answered 503 by admission control.', samples)
+        metric('connections_open', 'gauge', 'Client connections open.',
+               [(labels, slot[CONNECTIONS_OPEN]) for labels, slot in slots])
+        metric('connections_idle', 'gauge',
+               'Client connections waiting for a request.',
+               [(labels, slot[CONNECTIONS_IDLE]) for labels, slot in slots])
+        metric('connections_reaped_total', 'counter',
+               'Client connections closed for being idle or slow.',
+               [(labels, slot[CONNECTIONS_REAPED]) for labels, slot in slots])
+
+        for collector in self.collectors:
+            for name, type_, help_, samples in collector():
+                metric(name, type_, help_, samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def _app(self, environ, start_response):
+        body = self.render().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    def serve(self, host='0.0.0.0', port=9100):
+        """Serve render() in a greenthread of the parent, on its own port"""
+
+        self._server_socket = eventlet.listen((host, port))
+        return eventlet.spawn(eventlet.wsgi.server, self._server_socket,
+                              self._app, log_output=False)
+
+
+class _Recorder(object):
+    """Wraps the response iterable to record the request once it is sent"""
+
+    def __init__(self, result, finish):
+        self._result = result
+        self._finish = finish
+
+    @property
+    def file_body(self):
+        """The FileWrapper or Blob wrapped, sent by the server itself (see
+        files.respond())"""
+        return getattr(self._result, 'file_body', self._result)
+
+    def __iter__(self):
+        return iter(self._result)
+
+    def close(self):
+        try:
+            if hasattr(self._result, 'close'):
+                self._result.close()
+        finally:
+            self._finish()
+
+
+class _SizedRecorder(_Recorder):
+    """Keeps len() of the response, which the server uses for Content-Length"""
+
+    def __len__(self):
+        return len(self._result)
+
+
+class Middleware(object):
+    """Records requests to the slot of the child"""
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        if self.metrics.slot is None:
+            return self.app(environ, start_response)
+
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return start_response(status_line, headers, exc_info)
+
+        def _finish(error=False):
+            error = error or not status or status[0].startswith('5')
+            self.metrics.finish_request(start, error)
+
+        start = self.metrics.start_request()
+        try:
+            result = self.app(environ, _start_response)
+        except Exception:
+            _finish(error=True)
+            raise
+        if hasattr(result, '__len__'):
+            return _SizedRecorder(result, _finish)
+        return _Recorder(result, _finish)
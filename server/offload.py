@@ -0,0 +1,418 @@
+"""Running CPU bound work of handlers off the hub of a wsgi.Server child.
+
+A handler computing for a while stalls every greenthread of its child. Given
+to a pool, the work runs elsewhere and the handler's greenthread waits without
+blocking the others::
+
+    # in the parent, pools start in each child on first use
+    THREADS = offload.ThreadPool(size=4)
+    PROCESSES = offload.ProcessPool(size=2, timeout=10)
+
+    def app(environ, start_response):
+        body = THREADS.run(zlib.compress, data, 9)
+        ...
+
+    @offload.offloaded(PROCESSES)
+    def render_report(rows):
+        ...
+
+A ThreadPool runs work in native threads, for work releasing the GIL like
+compression, hashing or C extensions. A ProcessPool runs it in worker
+processes forked by the child, for pure Python work. Their functions, arguments
+and results are pickled, so functions have to be importable by name.
+
+Both queue up to ``max_pending`` calls while all ``size`` workers are busy,
+raising Full beyond that so handlers can shed load. With a ``timeout`` a call
+raises Timeout once it took that many seconds, including its wait in the
+queue. A call timed out or killed, like by eventlet.Timeout, is cancelled: it
+is dropped if not yet started, and a process worker running it is killed and
+replaced. A thread can't be stopped, its result is discarded.
+
+Offloaded functions called from a worker run right away.
+"""
+
+import collections
+import errno
+import functools
+import logging
+import os
+import pickle
+import signal
+import stat
+import struct
+import sys
+
+import eventlet
+import eventlet.event
+import eventlet.hubs
+import eventlet.patcher
+import eventlet.queue
+import eventlet.semaphore
+import six
+
+from pyacc.server import process
+
+
+LOG = logging.getLogger(__name__)
+
+# Workers are native threads and processes, never greenthreads
+_threading = eventlet.patcher.original('threading')
+_queue = eventlet.patcher.original('queue' if six.PY3 else 'Queue')
+_os = eventlet.patcher.original('os')
+
+# Length of a pickled message to or from a worker process
+_LENGTH = struct.Struct('!I')
+
+# Whether the current thread is a worker, see offloaded()
+_worker = _threading.local()
+
+# Pipe fds of this process to its worker processes, which new workers close
+_worker_fds = set()
+
+
+class Full(Exception):
+    """Raised by run() when max_pending calls wait already"""
+
+
+class Timeout(Exception):
+    """Raised by run() when a call took longer than the pool's timeout"""
+
+
+def offloaded(pool):
+    """Decorator running a function in pool"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_worker, 'active', False):
+                return func(*args, **kwargs)
+            # by the wrapper, a process worker finds it by name
+            return pool.run(wrapper, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Pool(object):
+
+    def __init__(self, size, max_pending, timeout):
+        self.size = size
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+        self._pid = None
+        self._slots = None
+
+    def stats(self):
+        busy = (self.size + self.max_pending - self._slots.balance
+                if self._slots is not None else 0)
+        return {
+            'running': min(busy, self.size),
+            'pending': max(busy - self.size, 0),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'cancelled': self.cancelled,
+        }
+
+    def start(self):
+        """Start the workers, done by the first run() in each process"""
+
+        self._pid = os.getpid()
+        self._slots = eventlet.semaphore.Semaphore(self.size +
+                                                   self.max_pending)
+        self._start()
+
+    def run(self, func, *args, **kwargs):
+        """func(*args, **kwargs) run by a worker, waited for cooperatively"""
+
+        if getattr(_worker, 'active', False):
+            return func(*args, **kwargs)
+        if self._pid != os.getpid():
+            self.start()
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise Full("%d calls are pending already" % self.max_pending)
+
+        error = Timeout("Offloaded %s took more than %s seconds"
+                        % (getattr(func, '__name__', func), self.timeout))
+        timer = None
+        if self.timeout is not None:
+            timer = eventlet.Timeout(self.timeout, error)
+        try:
+            result = self._run(func, args, kwargs)
+        except BaseException as exc:
+            if exc is error:
+                self.timeouts += 1
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._slots.release()
+        self.completed += 1
+        return result
+
+
+class _Job(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.result = None
+        self.exc_info = None
+        self.done = eventlet.event.Event()
+
+
+class ThreadPool(_Pool):
+    """Pool of ``size`` native threads, see the module docstring"""
+
+    def __init__(self, size=4, max_pending=64, timeout=None):
+        super(ThreadPool, self).__init__(size, max_pending, timeout)
+        self._jobs = None
+        self._finished = None
+        self._wakeup_fds = None
+
+    def _start(self):
+        self._jobs = _queue.Queue()
+        self._finished = collections.deque()
+        self._wakeup_fds = os.pipe()
+        for fd in self._wakeup_fds:
+            process._set_nonblocking(fd)
+        eventlet.spawn_n(self._dispatch)
+        for i in range(self.size):
+            thread = _threading.Thread(target=self._work,
+                                       name='offload-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        _worker.active = True
+        while True:
+            job = self._jobs.get()
+            if job.cancelled:
+                continue
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except BaseException:
+                job.exc_info = sys.exc_info()
+            self._finished.append(job)
+            try:
+                _os.write(self._wakeup_fds[1], b'.')
+            except OSError as exc:
+                # the pipe is full of wakeups not read yet
+                if exc.errno != errno.EAGAIN:
+                    raise
+
+    def _dispatch(self):
+        """Greenthread handing results of threads to their callers"""
+
+        while True:
+            eventlet.hubs.trampoline(self._wakeup_fds[0], read=True)
+            try:
+                os.read(self._wakeup_fds[0], 4096)
+            except OSError as exc:
+                if exc.errno != errno.EAGAIN:
+                    raise
+            while self._finished:
+                job = self._finished.popleft()
+                if not job.cancelled:
+                    job.done.send()
+
+    def _run(self, func, args, kwargs):
+        job = _Job(func, args, kwargs)
+        self._jobs.put(job)
+        try:
+            job.done.wait()
+        except BaseException:
+            job.cancelled = True
+            self.cancelled += 1
+            raise
+        if job.exc_info is not None:
+            six.reraise(*job.exc_info)
+        return job.result
+
+
+class _Process(object):
+    """A worker process of a ProcessPool, and its pipes"""
+
+    def __init__(self):
+        request_read, self.request_fd = os.pipe()
+        self.response_fd, response_write = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                for fd in _worker_fds | set([self.request_fd,
+                                             self.response_fd]):
+                    _os.close(fd)
+                _serve_worker(request_read, response_write)
+            finally:
+                _os._exit(1)
+        os.close(request_read)
+        os.close(response_write)
+        process._set_nonblocking(self.request_fd)
+        process._set_nonblocking(self.response_fd)
+        _worker_fds.update((self.request_fd, self.response_fd))
+
+    def call(self, data):
+        """(succeeded, result or exception) of a pickled call"""
+
+        _write(self.request_fd, _LENGTH.pack(len(data)) + data)
+        length = _LENGTH.unpack(_read(self.response_fd, _LENGTH.size))[0]
+        return pickle.loads(_read(self.response_fd, length))
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for fd in (self.request_fd, self.response_fd):
+            _worker_fds.discard(fd)
+            os.close(fd)
+        eventlet.spawn_n(_reap, self.pid)
+
+
+class ProcessPool(_Pool):
+    """Pool of ``size`` worker processes, see the module docstring"""
+
+    def __init__(self, size=2, max_pending=64, timeout=None):
+        super(ProcessPool, self).__init__(size, max_pending, timeout)
+        self._idle = None
+
+    def _start(self):
+        self._idle = eventlet.queue.LightQueue()
+        for _ in range(self.size):
+            self._idle.put(_Process())
+
+    def _run(self, func, args, kwargs):
+        data = pickle.dumps((func, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        process = self._idle.get()
+        try:
+            succeeded, result = process.call(data)
+        except (IOError, OSError, EOFError) as exc:
+            LOG.error("Offload worker %d failed: %s", process.pid, exc)
+            self._replace(process)
+            raise
+        except BaseException:
+            # interrupted, the worker may still be running the call
+            self.cancelled += 1
+            self._replace(process)
+            raise
+        self._idle.put(process)
+        if not succeeded:
+            raise result
+        return result
+
+    def _replace(self, process):
+        process.kill()
+        self._idle.put(_Process())
+
+
+def _serve_worker(request_fd, response_fd):
+    """Main loop of a worker process"""
+
+    _worker.active = True
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                   signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    _close_sockets()
+    while True:
+        header = _read_blocking(request_fd, _LENGTH.size)
+        if header is None:
+            # the child exited
+            _os._exit(0)
+        length = _LENGTH.unpack(header)[0]
+        data = _read_blocking(request_fd, length)
+        if data is None:
+            _os._exit(0)
+        func = None
+        try:
+            # e.g. a function defined after the worker forked isn't found
+            func, args, kwargs = pickle.loads(data)
+            response = (True, func(*args, **kwargs))
+        except Exception as exc:
+            response = (False, exc)
+        try:
+            data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps((False, RuntimeError(
+                "Unpicklable result of %s: %r" % (func, response[1]))),
+                pickle.HIGHEST_PROTOCOL)
+        _write_blocking(response_fd, _LENGTH.pack(len(data)) + data)
+
+
+def _close_sockets():
+    """Close listening and client sockets inherited from the child, which
+    would otherwise outlive it being drained"""
+
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return
+    for fd in fds:
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                _os.close(fd)
+        except OSError:
+            pass
+
+
+def _write(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            written = _os.write(fd, view)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            eventlet.hubs.trampoline(fd, write=True)
+            continue
+        view = view[written:]
+
+
+def _read(fd, length):
+    chunks = []
+    while length:
+        try:
+            data = _os.read(fd, length)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            eventlet.hubs.trampoline(fd, read=True)
+            continue
+        if not data:
+            raise EOFError("Offload worker exited")
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def _read_blocking(fd, length):
+    chunks = []
+    while length:
+        data = _os.read(fd, length)
+        if not data:
+            return None
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def _write_blocking(fd, data):
+    while data:
+        data = data[_os.write(fd, data):]
+
+
+def _reap(pid):
+    while True:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                return
+        except OSError:
+            return
+        eventlet.sleep(0.05)
@@ -0,0 +1,172 @@
+"""Pin the children of a process.Parent to CPUs, and set their niceness.
+
+A child runs a single hub, so a single busy thread. Left to the scheduler it
+moves between cores, and on hosts with several NUMA nodes between nodes,
+losing its caches each time. Given a Placement, each worker slot gets CPUs of
+its own::
+
+    parent = process.Parent(server, count=8,
+                            placement=placement.Placement(numa=True,
+                                                          reserved_cpus=1))
+
+The CPUs of a slot only depend on its index, so the child restarted or
+recycled in a slot runs where the previous one did. Each slot gets
+``cpus_per_child`` CPUs. With ``numa=True`` they are CPUs of the same node,
+and slots alternate between nodes, so children spread over all of them.
+Once there are more slots than CPU sets, like when autoscaling, slots share
+them again from the first.
+
+``reserved_cpus`` CPUs are kept for the parent, which is pinned to them, and
+given to no child. With ``cpus_per_child=0`` children aren't pinned, but for
+keeping off those. ``nice`` is the niceness of every child, or a dict of
+slot index to niceness, slots not in it keeping the parent's.
+
+CPUs are those the parent may run on when the Placement is made, unless given
+as ``cpus``. NUMA nodes are read from /sys, a host without shows as one node.
+Pinning needs os.sched_setaffinity(), Linux and Python 3.3+.
+"""
+
+import glob
+import logging
+import os
+import re
+
+
+LOG = logging.getLogger(__name__)
+
+_NODE_PATH = '/sys/devices/system/node'
+
+
+def parse_cpu_list(text):
+    """Set of CPUs of a kernel CPU list like ``0-3,8,10-11``"""
+
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _dash, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """[set of CPUs] of each NUMA node, by node number, [] if unknown"""
+
+    nodes = []
+    for path in glob.glob(os.path.join(_NODE_PATH, 'node*', 'cpulist')):
+        match = re.search(r'node(\d+)', path)
+        try:
+            with open(path) as cpulist:
+                cpus = parse_cpu_list(cpulist.read())
+        except (IOError, OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append((int(match.group(1)), cpus))
+    return [cpus for _node, cpus in sorted(nodes)]
+
+
+class Placement(object):
+    """Where children of each worker slot run, see the module docstring"""
+
+    def __init__(self, cpus_per_child=1, numa=False, reserved_cpus=0,
+                 nice=None, cpus=None):
+        pinning = bool(cpus_per_child or reserved_cpus)
+        if pinning and not hasattr(os, 'sched_setaffinity'):
+            raise ValueError("CPU affinity is not supported on this platform")
+        if cpus is None:
+            cpus = (os.sched_getaffinity(0) if pinning else ())
+        cpus = sorted(set(cpus))
+        if reserved_cpus < 0 or (pinning and reserved_cpus >= len(cpus)):
+            raise ValueError("Reserved CPUs %d should be between zero and "
+                             "the %d CPUs available" % (reserved_cpus,
+                                                       len(cpus)))
+        if cpus_per_child and cpus_per_child > len(cpus) - reserved_cpus:
+            raise ValueError("CPUs per child %d should not be more than the "
+                             "%d CPUs not reserved"
+                             % (cpus_per_child, len(cpus) - reserved_cpus))
+
+        self.cpus_per_child = cpus_per_child
+        self.numa = numa
+        self.nice = nice
+
+        self.parent_cpus = tuple(cpus[:reserved_cpus])
+        # CPU sets of the slots, slot index modulo their number
+        self.cpu_sets = []
+        if cpus_per_child:
+            self.cpu_sets = self._cpu_sets(cpus[reserved_cpus:])
+        elif reserved_cpus:
+            # children would inherit the parent's CPUs
+            self.cpu_sets = [tuple(cpus[reserved_cpus:])]
+
+    def _cpu_sets(self, cpus):
+        available = set(cpus)
+        nodes = [sorted(node & available)
+                 for node in (numa_nodes() if self.numa else [])]
+        nodes = [node for node in nodes if node]
+        if not nodes:
+            nodes = [cpus]
+
+        per_node = []
+        for node in nodes:
+            size = min(self.cpus_per_child, len(node))
+            # a rest too small for a set is left unused
+            per_node.append([tuple(node[start:start + size])
+                             for start in range(0, len(node) - size + 1,
+                                                size)])
+        cpu_sets = []
+        for index in range(max(len(sets) for sets in per_node)):
+            for sets in per_node:
+                if index < len(sets):
+                    cpu_sets.append(sets[index])
+        return cpu_sets
+
+    def cpus_of(self, slot):
+        """CPUs of the children of a slot, None if they aren't pinned"""
+
+        if not self.cpu_sets:
+            return None
+        return self.cpu_sets[slot % len(self.cpu_sets)]
+
+    def nice_of(self, slot):
+        """Niceness of the children of a slot, None to keep the parent's"""
+
+        if isinstance(self.nice, dict):
+            return self.nice.get(slot)
+        return self.nice
+
+    def apply_parent(self):
+        """Pin the parent to the reserved CPUs, called before forking"""
+
+        if self.parent_cpus:
+            os.sched_setaffinity(0, self.parent_cpus)
+            LOG.info('Parent pinned to CPUs %s', _format(self.parent_cpus))
+
+    def apply(self, slot):
+        """Pin the calling child and set its niceness, called after fork"""
+
+        cpus = self.cpus_of(slot)
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+        nice = self.nice_of(slot)
+        if nice is not None:
+            try:
+                _set_nice(nice)
+            except OSError as exc:
+                # lowering it needs CAP_SYS_NICE
+                LOG.warning('Cannot set niceness %d of slot %d: %s', nice,
+                            slot, exc)
+        if cpus is not None or nice is not None:
+            LOG.info('Child of slot %d on CPUs %s, niceness %d', slot,
+                     _format(cpus) if cpus is not None else 'any',
+                     os.nice(0))
+
+
+def _set_nice(nice):
+    if hasattr(os, 'setpriority'):
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+    else:
+        os.nice(nice - os.nice(0))
+
+
+def _format(cpus):
+    return ','.join(str(cpu) for cpu in cpus)
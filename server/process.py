@@ -16,17 +16,67 @@ but found out that it has problems and I need os.fork().
 
 import abc
 import errno
+import fcntl
+import gc
+import json
 import logging
 import os
+import random
 import signal
 import six
+import socket
+import struct
 import sys
+import time
 
 import eventlet
+import eventlet.patcher
+from eventlet.green import select
+
+from pyacc.common import startup
+from pyacc.common import utils
 
 
 LOG = logging.getLogger(__name__)
 
+# Parent polls for exited children every wait_interval
+REAP_POLL = 'poll'
+# Parent blocks until SIGCHLD (or a shutdown signal) wakes it up
+REAP_SIGNAL = 'signal'
+
+# Seconds between checks of children's age and memory against their limits
+LIMIT_CHECK_INTERVAL = 5.0
+
+# Circuit breaker states of a worker slot
+CIRCUIT_CLOSED = 'closed'
+# too many children of the slot exited before becoming ready, none is started
+# until circuit_reset seconds passed
+CIRCUIT_OPEN = 'open'
+# one child is tried, the circuit closes once it is ready
+CIRCUIT_HALF_OPEN = 'half-open'
+
+# Length of a message on a control channel, see Channel
+_FRAME = struct.Struct('!I')
+
+# Messages of children, see Child.handle_message()
+MESSAGE_READY = 'ready'
+MESSAGE_RECYCLE = 'recycle'
+MESSAGE_HEARTBEAT = 'heartbeat'
+# Messages of the parent, see Parent.send()
+MESSAGE_DRAIN = 'drain'
+MESSAGE_STOP = 'stop'
+MESSAGE_LOG_LEVEL = 'log_level'
+MESSAGE_CONFIG = 'config'
+
+# Channels write frames whole, never switching greenthreads in between
+_os = eventlet.patcher.original('os')
+
+# Most seconds between heartbeats of children, see Parent(heartbeat_timeout)
+HEARTBEAT_INTERVAL = 1.0
+
+# The Child object of the current process, None in the parent
+_current_child = None
+
 
 def _sighup_supported():
     return hasattr(signal, 'SIGHUP')
@@ -50,6 +100,113 @@ def _setup_signal_handler(handler):
         signal.signal(signal.SIGHUP, handler)
 
 
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Channel(object):
+    """One end of the control channel between the parent and a child.
+
+    A socketpair, carrying dicts with a ``type`` as JSON, each framed by its
+    length. Ends are kept as file descriptors, which children close without
+    objects around to close them again.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._buffer = b''
+        # what didn't fit into a non-blocking end yet
+        self._pending = b''
+
+    @staticmethod
+    def pair():
+        """(parent end, child end) of a new channel"""
+
+        socks = socket.socketpair()
+        fds = [os.dup(sock.fileno()) for sock in socks]
+        for sock in socks:
+            sock.close()
+        return Channel(fds[0]), Channel(fds[1])
+
+    def send(self, message):
+        """Send a message, blocking unless the end is non-blocking. What
+        doesn't fit into a non-blocking end is sent along with the next
+        message, returns False then."""
+
+        data = json.dumps(message).encode('utf-8')
+        self._pending += _FRAME.pack(len(data)) + data
+        try:
+            while self._pending:
+                self._pending = self._pending[_os.write(self.fd,
+                                                       self._pending):]
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+        return not self._pending
+
+    def receive(self):
+        """Messages received, once the end is readable. None once the other
+        end is closed."""
+
+        try:
+            data = _os.read(self.fd, 65536)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            if exc.errno != errno.ECONNRESET:
+                raise
+            data = b''
+        if not data:
+            return None
+        self._buffer += data
+        messages = []
+        while len(self._buffer) >= _FRAME.size:
+            length = _FRAME.unpack_from(self._buffer)[0]
+            end = _FRAME.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append(json.loads(
+                self._buffer[_FRAME.size:end].decode('utf-8')))
+            self._buffer = self._buffer[end:]
+        return messages
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _kill(pid, signo):
+    try:
+        os.kill(pid, signo)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+def notify_ready():
+    """Tell the parent that the service of this child process is ready.
+
+    Services with ``notifies_ready = True`` call it themselves, e.g. once they
+    are accepting connections. For other services the child calls it right
+    before ``service.wait()``. Does nothing outside of a child process.
+    """
+    if _current_child is not None:
+        _current_child.notify_ready()
+
+
+def request_recycle():
+    """Ask the parent to replace this child process, e.g. when it served as
+    many requests as it should.
+
+    The child carries on until the parent drained it, which happens once the
+    replacement is ready. Does nothing outside of a child process.
+    """
+    if _current_child is not None:
+        _current_child.request_recycle()
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Service(object):
     """ Service to be run by Child processes.
@@ -59,8 +216,23 @@ class Service(object):
 
     The Service is supposed to be implemented using eventlet greenthreads. Run multiple
     tasks in greenthreads and wait() for them.
+
+    A service may also provide a drain() method, which should stop taking new
+    work and make wait() return once in-flight work is done. Children call it
+    on SIGHUP, e.g. when replaced by a rolling reload. Without it SIGHUP stops
+    the child like SIGTERM does.
+
+    Optionally too, load() returns a dict the parent gets with each heartbeat
+    (see Parent), and reconfigure() takes the config pushed by the parent.
+
+    The Parent runs a service in a child process of class ``child_class``, e.g.
+    aio.AsyncChild for asyncio services.
     """
 
+    # Whether the service calls notify_ready() by itself
+    notifies_ready = False
+    child_class = None
+
     @abc.abstractmethod
     def stop(self):
         return
@@ -69,6 +241,40 @@ class Service(object):
     def wait(self):
         return
 
+    def preload(self):
+        """Optional. Called once in the parent before forking children.
+
+        Load everything children would otherwise load on their own, so that it
+        lives in memory pages shared copy-on-write by all children.
+        """
+        return
+
+
+class _Slot(object):
+    """Restart history of the children filling one of the count positions"""
+
+    def __init__(self, index):
+        self.index = index
+        self.state = CIRCUIT_CLOSED
+        self.starts = 0
+        # exits before becoming ready, and after
+        self.startup_failures = 0
+        self.crashes = 0
+        # consecutive failed children of either kind, for the backoff
+        self.failures = 0
+        # consecutive exits before becoming ready, for the circuit breaker
+        self.startup_failures_in_row = 0
+        self.next_start = 0
+        self.opened = None
+        # (time, return code, whether the child was ready)
+        self.last_exit = None
+
+    def status(self):
+        return {'slot': self.index, 'state': self.state, 'starts': self.starts,
+                'startup_failures': self.startup_failures,
+                'crashes': self.crashes, 'failures': self.failures,
+                'next_start': self.next_start, 'last_exit': self.last_exit}
+
 
 class Parent(object):
     """Parent represents the parent process.
@@ -76,32 +282,217 @@ class Parent(object):
     Parent process starts child process, wait for them to exit and restart them
     ensure the count of child processes. Signals are handled for proper cleaning
     up.
+
+    With ``reap_mode=REAP_POLL`` (the default) the parent wakes up every
+    ``wait_interval`` to check for exited children. With
+    ``reap_mode=REAP_SIGNAL`` it sleeps until SIGCHLD arrives, using the
+    self-pipe trick, so an idle parent uses no CPU and a crashed child is
+    restarted right away.
+
+    With ``preload=True`` the parent calls ``service.preload()`` before the
+    first fork, collects, and freezes (Python 3.7+) the garbage collector's
+    view of all objects right before forking the first child after it. Frozen
+    objects are never touched by the children's garbage collections, which
+    keeps their pages shared. A reload unfreezes them before preloading again,
+    so what the service dropped, like its old app, is collected in the parent.
+
+    SIGHUP triggers a rolling reload: the service is preloaded again if
+    ``preload`` is set, a replacement is forked for every child, and once all
+    replacements are ready the old children are drained one at a time, each
+    given ``drain_timeout`` seconds before being killed. If the replacements
+    aren't ready within ``reload_timeout`` seconds, they are stopped and the
+    old children keep serving.
+
+    With a ``metrics.Metrics`` as ``metrics`` each child is given a slot to
+    record its numbers to, and children started and exited are counted.
+
+    With an ``autoscale.Autoscaler`` as ``autoscaler`` (which needs ``metrics``
+    too) ``count`` changes with the load children report, between the
+    autoscaler's min and max children. Excess children are drained like on a
+    reload, but without waiting for each other.
+
+    Children are recycled once older than ``max_age`` seconds, once their RSS
+    exceeds ``max_rss_bytes``, both checked every LIMIT_CHECK_INTERVAL seconds,
+    or when they ask for it with ``request_recycle()``. A replacement is forked
+    first and the old child drained once it is ready, with at most
+    ``max_recycling`` children being replaced or drained at a time, so capacity
+    doesn't drop when many children hit their limits together.
+
+    Each child fills a worker slot, and children failing in a slot are
+    restarted with exponential backoff, from ``backoff_base`` up to
+    ``backoff_max`` seconds with random jitter. A child exiting before it is
+    ready is a startup failure and always waits for the backoff. A child
+    crashing after it was ready is restarted right away, unless the previous
+    child of the slot failed too and didn't stay up for ``backoff_max``
+    seconds. After ``circuit_threshold`` startup failures in a row the slot's
+    circuit opens: nothing is started in it for ``circuit_reset`` seconds, then
+    a single child is tried. Other slots keep serving meanwhile. See
+    ``slot_status()``, or the slot metrics.
+
+    With a ``watchdog.Watchdog`` as ``watchdog`` each child reports
+    greenthreads blocking its hub.
+
+    Each child has a control Channel to the parent, which it also exits on
+    once the parent died. Children send their readiness and recycle requests
+    over it, and with ``heartbeat_timeout`` heartbeats, along with the
+    ``load()`` of services having one. A ready child missing heartbeats for
+    ``heartbeat_timeout`` seconds, its hub blocked or its process stopped, is
+    killed and restarted. See ``child_status()``. The parent sends log level
+    changes, config updates and drain or stop commands with ``send()``.
+
+    With a ``placement.Placement`` as ``placement`` the parent is pinned to
+    its reserved CPUs once it starts waiting, and each child is pinned to the
+    CPUs of its slot and given its niceness right after fork.
     """
 
-    def __init__(self, service, count=1, wait_interval=0.01):
+    def __init__(self, service, count=1, wait_interval=0.01,
+                 reap_mode=REAP_POLL, preload=False, reload_timeout=60,
+                 drain_timeout=60, metrics=None, autoscaler=None, max_age=None,
+                 max_rss_bytes=None, max_recycling=1, backoff_base=1.0,
+                 backoff_max=60.0, circuit_threshold=8, circuit_reset=600,
+                 watchdog=None, heartbeat_timeout=None, placement=None):
         if count < 0:
             raise ValueError("Child count %d should not be less than zero" % count)
+        if reap_mode not in (REAP_POLL, REAP_SIGNAL):
+            raise ValueError("Unknown reap mode %s" % reap_mode)
+        if autoscaler is not None:
+            if metrics is None:
+                raise ValueError("Autoscaling needs metrics of the children")
+            count = autoscaler.clamp(count)
+        if max_recycling < 1:
+            raise ValueError("Max recycling %d should be at least one"
+                             % max_recycling)
 
         self.service = service
         self.count = count
         self.wait_interval = wait_interval
+        self.reap_mode = reap_mode
+        self.preload = preload
+        # set by a preload, until the next fork freezes its objects
+        self._freeze_pending = False
+        self.reload_timeout = reload_timeout
+        self.drain_timeout = drain_timeout
+        self.metrics = metrics
+        self.autoscaler = autoscaler
+        self._next_autoscale = 0
+        self.max_age = max_age
+        self.max_rss_bytes = max_rss_bytes
+        self.max_recycling = max_recycling
+        self._next_limit_check = 0
+        # pid of a child being recycled -> its replacement
+        self.recycling = {}
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_threshold = circuit_threshold
+        self.circuit_reset = circuit_reset
+        # worker slot index -> _Slot
+        self.slots = {}
+        if self.metrics is not None:
+            self.metrics.collectors.append(self._collect_slot_metrics)
+        self.watchdog = watchdog
+        self.heartbeat_timeout = heartbeat_timeout
+        self._next_heartbeat_check = 0
+        self.placement = placement
 
         self.signal_caught = None
         self.signal_frame = None
         self.children = {}
         self.completed_children = {}
+        # children being drained, no longer counted in self.children
+        self.retiring_children = {}
         self.running = True
+        self.reload_requested = False
         _setup_signal_handler(self._signal_handler)
 
-        # use pipe to stop child after parent dies
-        self.pipe_read_fd, self.pipe_write_fd = os.pipe()
+        self.wakeup_read_fd = None
+        self.wakeup_write_fd = None
+        if self.reap_mode == REAP_SIGNAL:
+            self._setup_wakeup()
+
+    def _setup_wakeup(self):
+        # Self-pipe trick: signal handlers write a byte, wait() blocks on the
+        # read end
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        _set_nonblocking(self.wakeup_read_fd)
+        _set_nonblocking(self.wakeup_write_fd)
+        signal.signal(signal.SIGCHLD, self._sigchld_handler)
+        if hasattr(signal, 'siginterrupt'):
+            signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _wakeup(self):
+        if self.wakeup_write_fd is None:
+            return
+        try:
+            os.write(self.wakeup_write_fd, b'\0')
+        except OSError as exc:
+            # pipe full means a wake up is already pending
+            if exc.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _drain_wakeup(self):
+        while True:
+            try:
+                if not os.read(self.wakeup_read_fd, 4096):
+                    return
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno != errno.EAGAIN:
+                    raise
+                return
+
+    def _sigchld_handler(self, signo, frame):
+        self._wakeup()
 
     def _signal_handler(self, signo, frame):
         LOG.info('Parent signal caught: %s', _signo_to_name(signo))
         self.signal_caught = signo
         self.signal_frame = frame
+        if _sighup_supported() and signo == signal.SIGHUP:
+            self.reload_requested = True
+            self._wakeup()
+            return
+
         self.running = False
         _setup_signal_handler(signal.SIG_DFL)
+        self._wakeup()
+
+    def _all_children(self):
+        return (list(self.children.values()) +
+                list(self.retiring_children.values()))
+
+    def _wait_event(self, timeout=None):
+        """Sleep until a child may have exited, a child reported its status, or
+        the parent is stopping"""
+
+        channel_fds = dict((child.channel.fd, child)
+                           for child in self._all_children()
+                           if child.channel is not None)
+        fds = list(channel_fds.keys())
+        if self.reap_mode == REAP_POLL:
+            if timeout is None or timeout > self.wait_interval:
+                timeout = self.wait_interval
+        else:
+            fds.append(self.wakeup_read_fd)
+
+        if not fds:
+            eventlet.sleep(timeout)
+            return
+
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except (select.error, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        for fd in readable:
+            if fd == self.wakeup_read_fd:
+                self._drain_wakeup()
+            elif fd in channel_fds:
+                channel_fds[fd].read_messages()
+            # else a late wake up of an earlier green select(), whose timeout
+            # and fd became ready in the same hub iteration
 
     def _wait_child(self):
         try:
@@ -116,6 +507,8 @@ class Parent(object):
         return_code = os.WEXITSTATUS(status)
         if os.WIFSIGNALED(status):
             signo = os.WTERMSIG(status)
+            # negative like subprocess, a killed child hasn't completed
+            return_code = -signo
             LOG.info('Child process terminated by signal %(sig_name)s with '
                      'return code %(return_code)d',
                      {'sig_name': _signo_to_name(signo),
@@ -128,53 +521,503 @@ class Parent(object):
 
     def _complete_child(self, pid, return_code):
         child = self.children.pop(pid, None)
-        if child and return_code == 0:
+        if child is None:
+            # a retired child isn't completed, whatever its return code is
+            child = self.retiring_children.pop(pid, None)
+        elif return_code == 0:
             self.completed_children[pid] = child
+        elif self.running:
+            self._slot_failed(child, return_code)
+        if child is not None:
+            child.close_channel()
+            if self.metrics is not None:
+                self.metrics.release_slot(child.metrics_slot, return_code)
+
+    def _preload(self):
+        service_preload = getattr(self.service, 'preload', None)
+        if hasattr(gc, 'unfreeze'):
+            # frozen by the previous preload, never collected otherwise
+            gc.unfreeze()
+        # Collections during loading would leave freed holes in pages children
+        # are going to share
+        gc.disable()
+        try:
+            if service_preload is not None:
+                start = time.time()
+                with startup.phase('preload service'):
+                    service_preload()
+                LOG.info('Service preloaded in %.3f seconds',
+                         time.time() - start)
+                startup.report(LOG.debug)
+            gc.collect()
+        finally:
+            gc.enable()
+        self._freeze_pending = True
+
+    def _get_slot(self, index):
+        if index not in self.slots:
+            self.slots[index] = _Slot(index)
+        return self.slots[index]
+
+    def _backoff(self, failures):
+        delay = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+        # jitter, so slots failing together don't fork together again
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _slot_failed(self, child, return_code):
+        now = time.time()
+        slot = self._get_slot(child.slot)
+        slot.last_exit = (now, return_code, child.ready)
+        if child.ready:
+            slot.crashes += 1
+            if now - child.started >= self.backoff_max:
+                # had been healthy for long
+                slot.failures = 0
+            delay = self._backoff(slot.failures) if slot.failures else 0
+            slot.failures += 1
+            LOG.warning('Child %(pid)d of slot %(slot)d crashed, restarting '
+                        'in %(delay).1f seconds',
+                        {'pid': child.pid, 'slot': slot.index, 'delay': delay})
+            slot.next_start = now + delay
+            return
+
+        slot.startup_failures += 1
+        slot.startup_failures_in_row += 1
+        slot.failures += 1
+        if (slot.state == CIRCUIT_HALF_OPEN or
+                slot.startup_failures_in_row >= self.circuit_threshold):
+            slot.state = CIRCUIT_OPEN
+            slot.opened = now
+            slot.next_start = now + self.circuit_reset
+            LOG.error('Child %(pid)d of slot %(slot)d exited before ready, '
+                      '%(count)d times in a row. Circuit open, retrying in '
+                      '%(delay)d seconds',
+                      {'pid': child.pid, 'slot': slot.index,
+                       'count': slot.startup_failures_in_row,
+                       'delay': self.circuit_reset})
+            return
+        delay = self._backoff(slot.failures)
+        slot.next_start = now + delay
+        LOG.warning('Child %(pid)d of slot %(slot)d exited before ready, '
+                    'restarting in %(delay).1f seconds',
+                    {'pid': child.pid, 'slot': slot.index, 'delay': delay})
 
-    def _start_child(self):
-        child = Child(self.service, pipe_read_fd=self.pipe_read_fd,
-                      pipe_write_fd=self.pipe_write_fd)
+    def _update_slots(self):
+        """Close the circuit of slots whose child became ready"""
+
+        for child in self.children.values():
+            if not child.ready:
+                continue
+            slot = self._get_slot(child.slot)
+            if slot.startup_failures_in_row or slot.state != CIRCUIT_CLOSED:
+                if slot.state != CIRCUIT_CLOSED:
+                    LOG.info('Child of slot %d is ready, circuit closed',
+                             slot.index)
+                slot.state = CIRCUIT_CLOSED
+                slot.startup_failures_in_row = 0
+
+    def slot_status(self):
+        """Restart history and circuit state of each worker slot"""
+
+        return [self.slots[index].status() for index in sorted(self.slots)]
+
+    def _collect_slot_metrics(self):
+        slots = [('{slot="%d"}' % index, self.slots[index])
+                 for index in sorted(self.slots)]
+        return [
+            ('slot_starts_total', 'counter', 'Children started in the slot.',
+             [(labels, slot.starts) for labels, slot in slots]),
+            ('slot_startup_failures_total', 'counter',
+             'Children of the slot exited before becoming ready.',
+             [(labels, slot.startup_failures) for labels, slot in slots]),
+            ('slot_crashes_total', 'counter',
+             'Children of the slot crashed after becoming ready.',
+             [(labels, slot.crashes) for labels, slot in slots]),
+            ('slot_circuit_open', 'gauge',
+             'Whether no child is started in the slot after failing to start.',
+             [(labels, int(slot.state == CIRCUIT_OPEN))
+              for labels, slot in slots]),
+        ]
+
+    def _can_start(self, index, now):
+        slot = self._get_slot(index)
+        return now >= slot.next_start
+
+    def _start_child(self, slot):
+        """Fork a child filling the worker slot of the given index"""
+
+        if self._freeze_pending and hasattr(gc, 'freeze'):
+            # Move everything into the permanent generation, so GC in children
+            # doesn't write to the pages of objects inherited from the parent.
+            # Once per preload, objects the parent creates later, while
+            # running, are collected in it as usual.
+            gc.freeze()
+            self._freeze_pending = False
+        metrics_slot = None
+        if self.metrics is not None:
+            metrics_slot = self.metrics.acquire_slot()
+        child_class = getattr(self.service, 'child_class', None) or Child
+        heartbeat_interval = None
+        if self.heartbeat_timeout is not None:
+            heartbeat_interval = min(HEARTBEAT_INTERVAL,
+                                     self.heartbeat_timeout / 3.0)
+        child = child_class(self.service, close_fds=self._child_close_fds(),
+                            metrics=self.metrics, metrics_slot=metrics_slot,
+                            watchdog=self.watchdog,
+                            heartbeat_interval=heartbeat_interval,
+                            placement=self.placement)
+        child.slot = slot
+        worker_slot = self._get_slot(slot)
+        worker_slot.starts += 1
+        if worker_slot.state == CIRCUIT_OPEN:
+            worker_slot.state = CIRCUIT_HALF_OPEN
         pid = child.start()
         self.children[pid] = child
         LOG.info('Child process started')
+        return child
+
+    def _ensure_child_count(self, force=False):
+        """Start children in free slots, unless backing off or force"""
 
-    def _ensure_child_count(self):
-        while len(self.children) + len(self.completed_children) < self.count:
-            self._start_child()
+        missing = (self.count - len(self.children) -
+                   len(self.completed_children))
+        if missing <= 0:
+            return
+        taken = set(child.slot for child in self.children.values())
+        taken.update(child.slot for child in self.completed_children.values())
+        free = [index for index in range(self.count + len(taken))
+                if index not in taken][:missing]
+        now = time.time()
+        for index in free:
+            if not force and not self._can_start(index, now):
+                continue
+            self._start_child(index)
             # make sure we don't fork too quickly
             eventlet.sleep(self.wait_interval)
 
+    def _child_close_fds(self):
+        """File descriptors of the parent that children must not keep"""
+
+        fds = [self.wakeup_read_fd, self.wakeup_write_fd]
+        fds.extend(child.channel.fd for child in self._all_children()
+                   if child.channel is not None)
+        return [fd for fd in fds if fd is not None]
+
     def _handle_child_exit(self):
-        pid, return_code = self._wait_child()
-        self._complete_child(pid, return_code)
+        # reap every exited child in one pass
+        while True:
+            pid, return_code = self._wait_child()
+            if pid is None:
+                break
+            self._complete_child(pid, return_code)
+
+    def _wait_ready(self, children):
+        """Wait until all given children are ready. False if one of them
+        exited, the parent is stopping or reload_timeout passed."""
+
+        deadline = time.time() + self.reload_timeout
+        while self.running:
+            self._handle_child_exit()
+            if any(child.pid not in self.children for child in children):
+                return False
+            if all(child.ready for child in children):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._wait_event(remaining)
+        return False
+
+    def _drain_child(self, child):
+        """Ask a retiring child to finish in-flight work, without waiting"""
+
+        LOG.info('Draining child %d', child.pid)
+        child.drain_deadline = time.time() + self.drain_timeout
+        _kill(child.pid, signal.SIGHUP)
+
+    def _kill_undrained(self):
+        """Kill retiring children not drained within drain_timeout"""
+
+        now = time.time()
+        for child in list(self.retiring_children.values()):
+            if (child.drain_deadline is not None and
+                    child.drain_deadline <= now):
+                LOG.warning('Child %d not drained in %d seconds, killing it',
+                            child.pid, self.drain_timeout)
+                _kill(child.pid, signal.SIGKILL)
+                child.drain_deadline = None
+
+    def _wait_drained(self, child):
+        while self.running:
+            self._handle_child_exit()
+            if child.pid not in self.retiring_children:
+                return
+            self._kill_undrained()
+            self._wait_event(self._next_timeout())
+
+    def _retire_child(self, child):
+        self.retiring_children[child.pid] = self.children.pop(child.pid)
+        self._drain_child(child)
+
+    def _autoscale(self):
+        now = time.time()
+        if self.autoscaler is None or now < self._next_autoscale:
+            return
+        self._next_autoscale = now + self.autoscaler.interval
+
+        loads = [self.metrics.read_load(child.metrics_slot)
+                 for child in self.children.values()
+                 if child.ready and child.metrics_slot is not None]
+        self.count = self.autoscaler.decide(self.count, loads, now)
+        # _ensure_child_count() starts missing children, the ones of the last
+        # slots are retired, which keeps slots in use contiguous
+        excess = (len(self.children) - len(self.recycling) +
+                  len(self.completed_children) - self.count)
+        if excess > 0:
+            replacements = set(child.pid for child in self.recycling.values())
+            children = sorted((child for child in self.children.values()
+                               if child.pid not in replacements),
+                              key=lambda child: (child.slot, child.started))
+            for child in children[-excess:]:
+                self._retire_child(child)
+
+    def _check_limits(self):
+        now = time.time()
+        if ((self.max_age is None and self.max_rss_bytes is None) or
+                now < self._next_limit_check):
+            return
+        self._next_limit_check = now + LIMIT_CHECK_INTERVAL
+
+        for child in self.children.values():
+            if child.recycle_requested:
+                continue
+            if self.max_age is not None and now - child.started > self.max_age:
+                LOG.info('Child %d is older than %d seconds', child.pid,
+                         self.max_age)
+                child.recycle_requested = True
+            elif self.max_rss_bytes is not None:
+                try:
+                    rss = utils.read_memory_usage(child.pid)['rss']
+                except (IOError, OSError):
+                    continue
+                if rss > self.max_rss_bytes:
+                    LOG.info('Child %(pid)d uses %(rss)d bytes of RSS',
+                             {'pid': child.pid, 'rss': rss})
+                    child.recycle_requested = True
+
+    def _recycle(self):
+        """Replace children asking to be recycled, a few at a time"""
+
+        for pid, replacement in list(self.recycling.items()):
+            if pid not in self.children:
+                # exited meanwhile, the replacement takes its place
+                del self.recycling[pid]
+            elif replacement.pid not in self.children:
+                LOG.warning('Replacement of child %d exited, retrying', pid)
+                del self.recycling[pid]
+            elif replacement.ready:
+                del self.recycling[pid]
+                LOG.info('Recycling child %(pid)d, replaced by %(new_pid)d',
+                         {'pid': pid, 'new_pid': replacement.pid})
+                self._retire_child(self.children[pid])
+
+        replacements = set(child.pid for child in self.recycling.values())
+        for child in list(self.children.values()):
+            # children still draining count too, they hold on to memory
+            if (len(self.recycling) + len(self.retiring_children) >=
+                    self.max_recycling):
+                break
+            if (child.recycle_requested and child.pid not in self.recycling
+                    and child.pid not in replacements and
+                    self._can_start(child.slot, time.time())):
+                self.recycling[child.pid] = self._start_child(child.slot)
+
+    def _check_heartbeats(self):
+        """Kill ready children whose heartbeats stopped"""
+
+        now = time.time()
+        if self.heartbeat_timeout is None or now < self._next_heartbeat_check:
+            return
+        self._next_heartbeat_check = now + min(HEARTBEAT_INTERVAL,
+                                               self.heartbeat_timeout / 3.0)
+        for child in self.children.values():
+            if (child.ready and not child.killed and
+                    now - child.last_message > self.heartbeat_timeout):
+                LOG.error('Child %(pid)d sent no heartbeat for %(seconds).1f '
+                          'seconds, killing it',
+                          {'pid': child.pid,
+                           'seconds': now - child.last_message})
+                _kill(child.pid, signal.SIGKILL)
+                child.killed = True
+
+    def send(self, message, pids=None):
+        """Send a message to the children of the given pids, all running
+        ones by default. Returns the pids it was sent to.
+
+        Children handle messages of type MESSAGE_DRAIN and MESSAGE_STOP like
+        SIGHUP and SIGTERM, MESSAGE_LOG_LEVEL with a ``level`` and optional
+        ``logger`` name by setting the level, and MESSAGE_CONFIG by passing
+        its ``config`` to ``service.reconfigure()``.
+        """
+        sent = []
+        for child in self._all_children():
+            if (child.channel is None or
+                    (pids is not None and child.pid not in pids)):
+                continue
+            if child.channel.send(message):
+                sent.append(child.pid)
+            else:
+                LOG.warning('Control channel of child %d is full, %s message '
+                            'not sent yet', child.pid, message.get('type'))
+        return sent
+
+    def set_log_level(self, level, logger=None):
+        """Set the level of a logger, the root one by default, in all
+        children"""
+        return self.send({'type': MESSAGE_LOG_LEVEL, 'level': level,
+                          'logger': logger})
+
+    def push_config(self, config):
+        """Pass config, anything JSON serializable, to the
+        ``reconfigure()`` of the service in all children"""
+        return self.send({'type': MESSAGE_CONFIG, 'config': config})
+
+    def child_status(self):
+        """State, time since the last message and last reported load of each
+        child"""
+
+        now = time.time()
+        status = []
+        for child in sorted(self._all_children(), key=lambda c: c.started):
+            status.append({
+                'pid': child.pid, 'slot': child.slot, 'ready': child.ready,
+                'retiring': child.pid in self.retiring_children,
+                'silent': now - child.last_message, 'load': child.load})
+        return status
+
+    def _next_timeout(self):
+        """Seconds until the parent has something to do on its own"""
+
+        deadlines = [child.drain_deadline
+                     for child in self.retiring_children.values()
+                     if child.drain_deadline is not None]
+        if self.autoscaler is not None:
+            deadlines.append(self._next_autoscale)
+        if self.max_age is not None or self.max_rss_bytes is not None:
+            deadlines.append(self._next_limit_check)
+        if self.heartbeat_timeout is not None:
+            deadlines.append(self._next_heartbeat_check)
+        if len(self.children) + len(self.completed_children) < self.count:
+            # a slot backing off
+            deadlines.extend(slot.next_start for slot in self.slots.values()
+                             if slot.next_start > time.time())
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), self.wait_interval)
+
+    def _reload(self):
+        LOG.info('Reloading %d child(ren)', len(self.children))
+        # every child is replaced anyway
+        self.recycling = {}
+        if self.preload:
+            self._preload()
+
+        old_children = list(self.children.values())
+        for child in old_children:
+            self.retiring_children[child.pid] = self.children.pop(child.pid)
+        # asked for by hand, not held back by backoff
+        self._ensure_child_count(force=True)
+        new_children = list(self.children.values())
+
+        if not self._wait_ready(new_children):
+            if not self.running:
+                return
+            LOG.error('Replacement children are not ready, aborting reload')
+            for child in new_children:
+                if child.pid in self.children:
+                    # retiring, so being stopped isn't taken as a failure
+                    self.retiring_children[child.pid] = \
+                        self.children.pop(child.pid)
+                    _kill(child.pid, signal.SIGTERM)
+            while self.running and any(child.pid in self.retiring_children
+                                       for child in new_children):
+                self._handle_child_exit()
+                self._wait_event()
+            for child in old_children:
+                if self.retiring_children.pop(child.pid, None) is not None:
+                    self.children[child.pid] = child
+            return
+
+        # one at a time, so that at most one old child's in-flight work is
+        # being wound down, the replacements already take all new connections
+        for child in old_children:
+            if not self.running:
+                return
+            if child.pid in self.retiring_children:
+                self._drain_child(child)
+                self._wait_drained(child)
+        LOG.info('Reload finished')
+
+    def report_memory(self):
+        """Log and return memory usage of each running child, keyed by pid.
+
+        ``pss`` is what a child really costs: its private pages plus its share
+        of the pages shared copy-on-write with the parent and other children.
+        """
+        report = {}
+        for pid in list(self.children.keys()):
+            try:
+                report[pid] = utils.read_memory_usage(pid)
+            except (IOError, OSError):
+                # the child exited, or /proc isn't available
+                continue
+            LOG.info('Child %(pid)d memory: rss=%(rss)d pss=%(pss)d '
+                     'shared=%(shared)d private=%(private)d',
+                     dict(report[pid], pid=pid))
+        return report
 
     def wait(self):
+        if self.placement is not None:
+            self.placement.apply_parent()
+        if self.preload:
+            self._preload()
         try:
             while self.running:
-                self._ensure_child_count()
                 self._handle_child_exit()
                 if len(self.completed_children) == self.count:
                     break
-                eventlet.sleep(self.wait_interval)
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self._reload()
+                    continue
+                self._update_slots()
+                self._kill_undrained()
+                self._autoscale()
+                self._check_limits()
+                self._check_heartbeats()
+                self._recycle()
+                # refill right after reaping, before going back to sleep
+                self._ensure_child_count()
+                self._wait_event(self._next_timeout())
         except eventlet.greenlet.GreenletExit:
             LOG.info("Method wait called after green thread killed. Stopping.")
         self.stop()
 
     def stop(self):
         self.running = False
-        for pid in self.children.keys():
-            try:
-                os.kill(pid, signal.SIGTERM)
-            except OSError as exc:
-                if exc.errno != errno.ESRCH:
-                    raise
+        # wait() may be blocked in another greenthread
+        self._wakeup()
+        for child in self._all_children():
+            _kill(child.pid, signal.SIGTERM)
 
-        if len(self.children) > 0:
-            children_pid_str_list = [str(i) for i in self.children.keys()]
+        if len(self._all_children()) > 0:
+            children_pid_str_list = [str(i.pid) for i in self._all_children()]
             LOG.info('Waiting child(ren) %s to exit',
                      ', '.join(children_pid_str_list))
-        while len(self.children) > 0:
+        while len(self._all_children()) > 0:
             self._handle_child_exit()
+            if len(self._all_children()) > 0:
+                eventlet.sleep(self.wait_interval)
 
 
 class SignalExit(SystemExit):
@@ -193,23 +1036,131 @@ class Child(object):
 
     In each child process, a service is run. You can use eventlet greenthreads in
     the service. Signals are handled for proper cleaning up.
+
+    The Child object is used by both processes, talking over ``channel``, its
+    own end of their control Channel.
     """
 
-    def __init__(self, service, pipe_read_fd, pipe_write_fd):
+    def __init__(self, service, close_fds=(), metrics=None, metrics_slot=None,
+                 watchdog=None, heartbeat_interval=None, placement=None):
         self.service = service
-        self.pipe_read_fd = pipe_read_fd
-        self.pipe_write_fd = pipe_write_fd
+        self.close_fds = close_fds
+        self.metrics = metrics
+        self.metrics_slot = metrics_slot
+        self.watchdog = watchdog
+        self.heartbeat_interval = heartbeat_interval
+        self.placement = placement
 
         self.pid = None
         self.signal_caught = None
         self.signal_frame = None
-        self.pipe_read = None
+
+        self.channel = None
+        self.ready = False
+        self.recycle_requested = False
+
+        # set in the child process
+        self.forked = None
+
+        # set in the parent process
+        self.slot = None
+        self.started = None
+        self.drain_deadline = None
+        # when a message of the child was last read
+        self.last_message = None
+        # as reported by the service with its last heartbeat
+        self.load = None
+        # for missing heartbeats
+        self.killed = False
+
+    def notify_ready(self):
+        """Called in the child process"""
+
+        if self.ready:
+            return
+        self.ready = True
+        self.channel.send({'type': MESSAGE_READY})
+        LOG.debug('Child ready %.3f seconds after fork',
+                  time.time() - self.forked)
+        startup.report(LOG.debug)
+
+    def request_recycle(self):
+        """Called in the child process"""
+
+        if self.recycle_requested:
+            return
+        self.recycle_requested = True
+        self.channel.send({'type': MESSAGE_RECYCLE})
+
+    def read_messages(self):
+        """Called in the parent process when the channel is readable"""
+
+        messages = self.channel.receive()
+        if messages is None:
+            self.close_channel()
+            return
+        if messages:
+            self.last_message = time.time()
+        for message in messages:
+            if message['type'] == MESSAGE_READY:
+                self.ready = True
+            elif message['type'] == MESSAGE_RECYCLE:
+                LOG.info('Child %d asks to be recycled', self.pid)
+                self.recycle_requested = True
+            elif message['type'] == MESSAGE_HEARTBEAT:
+                self.load = message.get('load')
+
+    def close_channel(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def handle_message(self, message):
+        """Called in the child process for each message of the parent"""
+
+        if message['type'] == MESSAGE_DRAIN and _sighup_supported():
+            # handled like the signals, in whatever way the child does
+            os.kill(os.getpid(), signal.SIGHUP)
+        elif message['type'] in (MESSAGE_DRAIN, MESSAGE_STOP):
+            os.kill(os.getpid(), signal.SIGTERM)
+        elif message['type'] == MESSAGE_LOG_LEVEL:
+            logging.getLogger(message.get('logger')).setLevel(
+                message['level'])
+        elif message['type'] == MESSAGE_CONFIG:
+            reconfigure = getattr(self.service, 'reconfigure', None)
+            if reconfigure is None:
+                LOG.warning('Service of child %d takes no config', self.pid)
+                return
+            try:
+                reconfigure(message['config'])
+            except Exception:
+                LOG.exception('Child service raised error when reconfiguring')
+        else:
+            LOG.warning('Unknown message %s from parent', message['type'])
+
+    def heartbeat(self):
+        """Called in the child process every heartbeat_interval seconds"""
+
+        message = {'type': MESSAGE_HEARTBEAT}
+        load = getattr(self.service, 'load', None)
+        if load is not None:
+            try:
+                message['load'] = load()
+            except Exception:
+                LOG.exception('Child service raised error reporting its load')
+        self.channel.send(message)
 
     def _signal_handler(self, signo, frame):
         LOG.info('Child %(pid)d signal caught: %(sig_name)s',
                  {'pid': self.pid, 'sig_name': _signo_to_name(signo)})
         self.signal_caught = signo
         self.signal_frame = frame
+        if (_sighup_supported() and signo == signal.SIGHUP and
+                hasattr(self.service, 'drain')):
+            # Don't block in the signal handler, wait() returns once drained
+            eventlet.spawn_n(self._drain)
+            return
+
         _setup_signal_handler(signal.SIG_DFL)
 
         try:
@@ -220,33 +1171,99 @@ class Child(object):
         finally:
             raise SignalExit(signo)
 
-    def _setup_pipe_watcher(self):
-        os.close(self.pipe_write_fd)
-        self.pipe_read = eventlet.greenio.GreenPipe(self.pipe_read_fd, 'r')
-        eventlet.spawn_n(self._pipe_watcher)
+    def _drain(self):
+        try:
+            self.service.drain()
+        except Exception:
+            LOG.exception('Child service raised error when draining')
+            sys.exit(1)
+
+    def _setup_signal_wakeup(self):
+        # The hub retries its poll after a signal handler returns, so
+        # greenthreads a handler spawns would wait for the next unrelated
+        # event. A byte written to the wakeup fd on each signal ends the poll.
+        read_fd, write_fd = os.pipe()
+        _set_nonblocking(read_fd)
+        _set_nonblocking(write_fd)
+        signal.set_wakeup_fd(write_fd)
+        eventlet.spawn_n(self._signal_wakeup_reader, read_fd)
+
+    @staticmethod
+    def _signal_wakeup_reader(read_fd):
+        while True:
+            eventlet.hubs.trampoline(read_fd, read=True)
+            try:
+                os.read(read_fd, 4096)
+            except OSError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
 
-    def _pipe_watcher(self):
-        """Make sure child exits if parent dies, using pipe"""
+    def _channel_reader(self):
+        """Handle messages of the parent, and make sure child exits if parent
+        dies, closing the channel"""
 
-        self.pipe_read.read()
+        while True:
+            eventlet.hubs.trampoline(self.channel.fd, read=True)
+            messages = self.channel.receive()
+            if messages is None:
+                break
+            for message in messages:
+                self.handle_message(message)
         LOG.info('Parent process died unexpectedly. Child exiting.')
         sys.exit(1)
 
+    def _heartbeat(self):
+        while True:
+            self.heartbeat()
+            eventlet.sleep(self.heartbeat_interval)
+
+    def _run_service(self):
+        """Run the service in the child process, until it is done"""
+
+        _setup_signal_handler(self._signal_handler)
+        self._setup_signal_wakeup()
+        eventlet.spawn_n(self._channel_reader)
+        if self.heartbeat_interval is not None:
+            eventlet.spawn_n(self._heartbeat)
+        if self.watchdog is not None:
+            self.watchdog.start()
+        if not getattr(self.service, 'notifies_ready', False):
+            self.notify_ready()
+        try:
+            self.service.wait()
+        except:
+            LOG.exception('Child service raised error when start and wait')
+            raise
+
     def start(self):
+        global _current_child
+
+        parent_end, child_end = Channel.pair()
         pid = os.fork()
         if pid == 0:
+            self.forked = time.time()
+            _current_child = self
             self.pid = os.getpid()
+            parent_end.close()
+            self.channel = child_end
             # Reopen eventlet hub to make sure we don't share an epoll fd between
             # parent and children
             eventlet.hubs.use_hub()
-            _setup_signal_handler(self._signal_handler)
-            self._setup_pipe_watcher()
-            try:
-                self.service.wait()
-            except:
-                LOG.exception('Child service raised error when start and wait')
-                raise
+            for fd in self.close_fds:
+                os.close(fd)
+            if self.metrics is not None:
+                self.metrics.bind(self.metrics_slot)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            if self.placement is not None:
+                self.placement.apply(self.slot)
+            self._run_service()
             sys.exit(0)
         else:
             self.pid = pid
+            self.started = time.time()
+            self.last_message = self.started
+            child_end.close()
+            # a child not reading its channel doesn't block the parent
+            _set_nonblocking(parent_end.fd)
+            self.channel = parent_end
             return pid
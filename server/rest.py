@@ -0,0 +1,253 @@
+"""REST resources on top of wsgi.Router, in the style of openstack/cinder.
+
+A Controller implements the actions ``mapper.resource()`` connects: index,
+create, show, update, delete, new and edit. Each is called with the
+webob.Request, the variables of the matched route and, for requests with a
+body, the deserialized ``body``. Wrap the controller in a Resource to connect
+it::
+
+    mapper.resource('server', 'servers',
+                    controller=Resource(ServerController()))
+
+An action returns a webob.Response, a webob.exc.HTTPException, None (204),
+something serializable, or a Collection. Collections are streamed item by item
+in chunks, so a large list never has to be built in memory. Give them a
+``limit`` and a ``key`` to paginate with cursors: the response ends with the
+cursor of the next page, which is the key of the last item. The controller
+fetches the next page starting after ``decode_cursor()`` of the request's
+``cursor`` parameter, e.g. ``WHERE id > cursor ORDER BY id``, so deep pages
+cost as much as the first one.
+
+JSON is serialized by orjson, ujson or simplejson when one is installed, by
+the json module otherwise.
+"""
+
+import base64
+import json
+import logging
+
+import six
+import webob
+import webob.dec
+import webob.exc
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+LOG = logging.getLogger(__name__)
+
+# Collections are written to the client in chunks of at least this many bytes
+CHUNK_SIZE = 64 * 1024
+
+
+def encode_cursor(value):
+    """Opaque cursor for a page starting after value, a JSON serializable"""
+
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """The value encode_cursor() was given, None if there is no cursor"""
+
+    if not cursor:
+        return None
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(
+            padded.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise webob.exc.HTTPBadRequest("Invalid cursor %s" % cursor)
+
+
+def get_limit(request, default=100, maximum=1000):
+    """Page size asked by the request's ``limit`` parameter"""
+
+    try:
+        limit = int(request.params.get('limit', default))
+    except ValueError:
+        raise webob.exc.HTTPBadRequest("Invalid limit")
+    if limit <= 0:
+        raise webob.exc.HTTPBadRequest("Limit should be greater than zero")
+    return min(limit, maximum)
+
+
+class Collection(object):
+    """A list of items sent to the client while it is being iterated.
+
+    ``items`` can be any iterable, e.g. a database cursor or a generator. With
+    ``limit`` at most as many items are sent, and if there are more
+    ``next_cursor`` is set to the encoded ``key`` of the last item sent.
+    """
+
+    def __init__(self, items, name='items', limit=None, key=None):
+        if limit is not None and key is None:
+            raise ValueError("A key is needed to paginate a collection")
+
+        self.items = items
+        self.name = name
+        self.limit = limit
+        self.key = key
+        self.next_cursor = None
+
+    def __iter__(self):
+        items = iter(self.items)
+        if self.limit is None:
+            for item in items:
+                yield item
+            return
+
+        last = None
+        for count, item in enumerate(items):
+            if count == self.limit:
+                # there is at least one more item, so a next page
+                self.next_cursor = encode_cursor(self.key(last))
+                return
+            last = item
+            yield item
+
+
+class JSONSerializer(object):
+    """Serialize to JSON with the fastest backend installed"""
+
+    content_type = 'application/json'
+
+    def __init__(self):
+        if orjson is not None:
+            self._dumps = orjson.dumps
+            self._loads = orjson.loads
+        elif ujson is not None:
+            self._dumps = lambda obj: ujson.dumps(obj).encode('utf-8')
+            self._loads = ujson.loads
+        elif simplejson is not None:
+            self._dumps = lambda obj: simplejson.dumps(obj).encode('utf-8')
+            self._loads = simplejson.loads
+        else:
+            self._dumps = lambda obj: json.dumps(obj).encode('utf-8')
+            self._loads = json.loads
+
+    def serialize(self, obj):
+        return self._dumps(obj)
+
+    def deserialize(self, data):
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        return self._loads(data)
+
+    def stream(self, collection, chunk_size=CHUNK_SIZE):
+        """Serialize a Collection to chunks of a JSON object:
+        {"<name>": [...], "next": "<cursor>"}"""
+
+        buf = [b'{' + self._dumps(collection.name) + b':[']
+        size = len(buf[0])
+        separator = b''
+        for item in collection:
+            data = separator + self._dumps(item)
+            separator = b','
+            buf.append(data)
+            size += len(data)
+            if size >= chunk_size:
+                yield b''.join(buf)
+                buf = []
+                size = 0
+        buf.append(b']')
+        if collection.next_cursor is not None:
+            buf.append(b',"next":' + self._dumps(collection.next_cursor))
+        buf.append(b'}')
+        yield b''.join(buf)
+
+
+class Controller(object):
+    """Base class of REST controllers, see the module docstring"""
+
+
+class Resource(object):
+    """WSGI app calling the action of a controller the request was routed to.
+
+    ``serializers`` is a list of serializers to choose from, by the ``format``
+    of the route (e.g. ``/servers.json``) or else the Accept header. The first
+    one is the default.
+    """
+
+    def __init__(self, controller, serializers=None):
+        self.controller = controller
+        self.serializers = serializers or [JSONSerializer()]
+
+    def _get_serializer(self, request, route_format):
+        if route_format:
+            for serializer in self.serializers:
+                if serializer.content_type.split('/')[-1] == route_format:
+                    return serializer
+            raise webob.exc.HTTPNotAcceptable()
+
+        offers = [serializer.content_type for serializer in self.serializers]
+        if 'Accept' not in request.headers:
+            return self.serializers[0]
+        acceptable = request.accept.acceptable_offers(offers)
+        if not acceptable:
+            raise webob.exc.HTTPNotAcceptable()
+        return self.serializers[offers.index(acceptable[0][0])]
+
+    def _get_body(self, request):
+        if not request.content_length:
+            return None
+        content_type = request.content_type
+        for serializer in self.serializers:
+            if serializer.content_type == content_type:
+                try:
+                    return serializer.deserialize(request.body)
+                except ValueError:
+                    raise webob.exc.HTTPBadRequest("Malformed request body")
+        raise webob.exc.HTTPUnsupportedMediaType()
+
+    def _respond(self, request, result, serializer):
+        if isinstance(result, webob.Response):
+            return result
+        response = webob.Response(content_type=serializer.content_type,
+                                  charset=None)
+        if result is None:
+            response.status_int = 204
+            response.content_type = None
+        elif isinstance(result, Collection):
+            # no Content-Length, the body is sent chunked as it is built
+            response.app_iter = serializer.stream(result)
+        else:
+            response.body = serializer.serialize(result)
+        return response
+
+    @webob.dec.wsgify(RequestClass=webob.Request)
+    def __call__(self, request):
+        args = dict(request.environ['wsgiorg.routing_args'][1])
+        args.pop('controller', None)
+        action = args.pop('action', None)
+        route_format = args.pop('format', None)
+
+        method = getattr(self.controller, action or '', None)
+        if method is None or action.startswith('_'):
+            return webob.exc.HTTPNotFound()
+
+        try:
+            serializer = self._get_serializer(request, route_format)
+            body = self._get_body(request)
+            if body is not None:
+                args['body'] = body
+            result = method(request, **args)
+        except webob.exc.HTTPException as exc:
+            return exc
+        except Exception:
+            LOG.exception("Action %s of %s failed", action,
+                          type(self.controller).__name__)
+            return webob.exc.HTTPInternalServerError()
+
+        return self._respond(request, result, serializer)
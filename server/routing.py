@@ -0,0 +1,282 @@
+"""Route table compiled from a routes.Mapper.
+
+routes matches a URL by trying the regular expression of each candidate route
+in turn. RouteTable compiles the mapper into a trie on path segments instead,
+so finding the few routes a URL may match costs a dict lookup per segment
+however many routes there are. Only those are then checked with their own
+regular expression, in the order routes would try them, so the same route
+wins. Results are kept in a bounded LRU cache keyed on (method, path).
+
+Path variables can be typed with ``types``, a dict of variable name to a key
+of TYPES. A typed variable has to match the type's pattern, and its value in
+the match dict is converted, e.g. ``types={'id': 'int'}``.
+"""
+
+import bisect
+import itertools
+import re
+
+import six
+
+from pyacc.common import utils
+
+
+TYPES = {
+    'int': (r'\d+', int),
+    'uuid': (r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?'
+             r'[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}', lambda value: value.lower()),
+    'str': (r'[^/]+', lambda value: value),
+}
+
+# Things in a requirement that may match '/'
+_UNSAFE_REQUIREMENT = re.compile(r'(?<!\\)\.|\\[DSW]|\[\^(?![^\]]*/)|(?<!\\)/')
+
+# Kinds of segments of a compiled route
+_STATIC = 'static'
+# a whole segment is a variable
+_VARIABLE = 'variable'
+# a segment starting with some static text, e.g. '{id}.{format}' or
+# 'new.{format}'
+_PARTIAL = 'partial'
+# the route can't be split any further, e.g. '*path', '{path:.*}'
+_REST = 'rest'
+
+
+class _Node(object):
+
+    __slots__ = ('static', 'variables', 'partial', 'partial_lengths', 'routes',
+                 'rest', 'min_rank')
+
+    def __init__(self):
+        # segment -> _Node
+        self.static = {}
+        # [(name, compiled requirement or None, _Node)]
+        self.variables = []
+        # static text a segment starts with -> _Node
+        self.partial = {}
+        self.partial_lengths = []
+        # [(rank, methods or None, route)] of routes ending here
+        self.routes = []
+        # [(rank, methods or None, route)] of routes matching the rest of URL
+        self.rest = []
+        # lowest route rank in the subtree, to stop searching early
+        self.min_rank = None
+
+    def update_min_rank(self, rank):
+        if self.min_rank is None or rank < self.min_rank:
+            self.min_rank = rank
+
+
+def _split(path):
+    # '/users/5' -> ['users', '5'], '/' -> ['']
+    return path.split('/')[1:]
+
+
+def _compile_segments(route):
+    """Split a route into segments, each a tuple of its kind and details"""
+
+    segments = [[]]
+    for part in route.routelist:
+        if isinstance(part, dict):
+            segments[-1].append(part)
+            continue
+        pieces = part.split('/')
+        if pieces[0]:
+            segments[-1].append(pieces[0])
+        for piece in pieces[1:]:
+            segments.append([piece] if piece else [])
+
+    # routes not starting with '/' are left to their regular expression
+    if segments.pop(0):
+        return [(_REST,)]
+
+    compiled = []
+    for segment in segments:
+        variables = [part for part in segment if isinstance(part, dict)]
+        requirements = [route.reqs.get(part['name']) for part in variables]
+        if (any(part['type'] != ':' for part in variables) or
+                any(requirement is not None and
+                    _UNSAFE_REQUIREMENT.search(requirement)
+                    for requirement in requirements)):
+            compiled.append((_REST,))
+            break
+
+        if not segment:
+            compiled.append((_STATIC, ''))
+        elif not variables:
+            compiled.append((_STATIC, segment[0]))
+        elif len(segment) == 1:
+            requirement = requirements[0]
+            if requirement is not None:
+                requirement = re.compile(r'(?:%s)\Z' % requirement)
+            compiled.append((_VARIABLE, variables[0]['name'], requirement))
+        else:
+            prefix = segment[0] if not isinstance(segment[0], dict) else ''
+            compiled.append((_PARTIAL, prefix))
+    return compiled
+
+
+class RouteTable(object):
+    """Match URLs against the routes of a routes.Mapper.
+
+    The mapper is compiled when the table is built, routes connected later are
+    not seen.
+    """
+
+    def __init__(self, mapper, cache_size=1024, types=None):
+        self.mapper = mapper
+        self.types = dict((name, (re.compile(r'(?:%s)\Z' % TYPES[type_][0]),
+                                  TYPES[type_][1]))
+                          for name, type_ in (types or {}).items())
+        self.cache = utils.LRUCache(cache_size) if cache_size else None
+
+        self._root = _Node()
+        # conditions other than method make a match depend on more than
+        # (method, path)
+        self._cacheable = True
+
+        mapper.create_regs()
+        for index, route in enumerate(mapper.matchlist):
+            if not route.static:
+                self._add(index, route)
+
+    def _rank(self, index, route):
+        """Routes with a lower rank are tried first.
+
+        Since routes 2.5 routes with a longer static prefix are tried first,
+        then the order of the mapper.
+        """
+        if not hasattr(self.mapper, '_prefix_lens'):
+            return (0, index)
+        prefix = ''.join(itertools.takewhile(
+            lambda part: isinstance(part, six.string_types), route.routelist))
+        if route.minimization and not prefix.startswith('/'):
+            prefix = '/' + prefix
+        return (-len(prefix.rstrip('/')), index)
+
+    def _add(self, index, route):
+        conditions = route.conditions or {}
+        if set(conditions) - set(['method']):
+            self._cacheable = False
+        methods = conditions.get('method')
+        rank = self._rank(index, route)
+        entry = (rank, set(methods) if methods else None, route)
+
+        # prefix and minimization change how routes match URLs
+        if self.mapper.prefix or self.mapper.minimization:
+            segments = [(_REST,)]
+        else:
+            segments = _compile_segments(route)
+
+        node = self._root
+        node.update_min_rank(rank)
+        for segment in segments:
+            kind = segment[0]
+            if kind == _REST:
+                bisect.insort(node.rest, entry)
+                return
+            if kind == _STATIC:
+                child = node.static.setdefault(segment[1], _Node())
+            elif kind == _VARIABLE:
+                for name, requirement, child in node.variables:
+                    if (name, requirement) == segment[1:]:
+                        break
+                else:
+                    child = _Node()
+                    node.variables.append(segment[1:] + (child,))
+            else:
+                prefix = segment[1]
+                child = node.partial.setdefault(prefix, _Node())
+                if len(prefix) not in node.partial_lengths:
+                    node.partial_lengths.append(len(prefix))
+            node = child
+            node.update_min_rank(rank)
+        bisect.insort(node.routes, entry)
+
+    def _try(self, entries, path, method, environ, best):
+        """Match the path against routes ranked before the best one.
+
+        best is [rank, match dict, route] of the best match found so far.
+        """
+        mapper = self.mapper
+        for rank, methods, route in entries:
+            if rank >= best[0]:
+                return
+            if methods is not None and method not in methods:
+                continue
+            match = route.match(path, environ, mapper.sub_domains,
+                                mapper.sub_domains_ignore, mapper.domain_match)
+            if not isinstance(match, dict) and not match:
+                continue
+            match = self._convert(match)
+            if match is not None:
+                best[:] = [rank, match, route]
+                return
+
+    def _search(self, node, segments, position, path, method, environ, best):
+        """Depth first search for the lowest ranked route matching the path"""
+
+        if node.min_rank is None or node.min_rank >= best[0]:
+            return
+        if node.rest:
+            self._try(node.rest, path, method, environ, best)
+        if position == len(segments):
+            self._try(node.routes, path, method, environ, best)
+            return
+
+        segment = segments[position]
+        child = node.static.get(segment)
+        if child is not None:
+            self._search(child, segments, position + 1, path, method, environ,
+                         best)
+        for length in node.partial_lengths:
+            child = node.partial.get(segment[:length])
+            if child is not None:
+                self._search(child, segments, position + 1, path, method,
+                             environ, best)
+        if not segment:
+            return
+        for name, requirement, child in node.variables:
+            if requirement is not None and not requirement.match(segment):
+                continue
+            if name in self.types and not self.types[name][0].match(segment):
+                continue
+            self._search(child, segments, position + 1, path, method, environ,
+                         best)
+
+    def _convert(self, match):
+        for name, (pattern, convert) in self.types.items():
+            if name in match:
+                value = match[name]
+                if not pattern.match(value):
+                    return None
+                match[name] = convert(value)
+        return match
+
+    def _match(self, path, method, environ):
+        # ranks are (-prefix length, index)
+        best = [(1, 0), None, None]
+        self._search(self._root, _split(path), 0, path, method, environ, best)
+        if best[2] is None:
+            return None
+        return best[1], best[2]
+
+    def match(self, path, method, environ=None):
+        """Return (match dict, route) for the path, or None if nothing matches.
+
+        environ is only needed by routes with conditions other than method.
+        """
+        if environ is None:
+            environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        if self.cache is None or not self._cacheable:
+            return self._match(path, method, environ)
+
+        key = (method, path)
+        result = self.cache.get(key, False)
+        if result is False:
+            result = self._match(path, method, environ)
+            self.cache.set(key, result)
+        if result is None:
+            return None
+        # the match dict is the caller's to change
+        return result[0].copy(), result[1]
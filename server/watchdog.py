@@ -0,0 +1,256 @@
+"""Find the greenthreads blocking the eventlet hub of children.
+
+A greenthread that doesn't yield, calling an unpatched C driver or computing
+for long, freezes every other greenthread of its child. Given to
+process.Parent, a Watchdog runs in each child and
+
+1. measures the lag of the hub, as how late a greenthread sleeping every
+   ``interval`` wakes up;
+2. times each run of a greenthread, from being switched to until it switches
+   away, into a histogram per route of the request the greenthread serves;
+3. logs the stack and the request of a greenthread running longer than
+   ``threshold`` seconds. The stack is captured by a thread of the watchdog
+   while the greenthread still runs, so it shows where it blocks.
+
+::
+
+    watchdog = Watchdog(threshold=0.1)
+    server = wsgi.Server(app=app)
+    parent = process.Parent(server, count=4, watchdog=watchdog)
+    parent.wait()
+
+wsgi.Server tags the greenthread serving each request. The route is the
+template of the route an app of wsgi.Router matched, the path otherwise.
+Greenthreads serving no request count as route ``-``. Hub lag and the routes
+which blocked longest are logged every ``report_interval`` seconds.
+"""
+
+import bisect
+import logging
+import sys
+import time
+import traceback
+import weakref
+
+import eventlet
+import eventlet.hubs
+import eventlet.patcher
+import greenlet
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of blocking time histogram buckets
+BLOCKING_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+# Route of greenthreads not serving a request
+NO_ROUTE = '-'
+# Route counting requests of routes beyond max_routes
+OTHER_ROUTES = 'other'
+
+# The watchdog would be monkey patched into a greenthread otherwise
+_threading = eventlet.patcher.original('threading')
+_thread = eventlet.patcher.original('_thread' if six.PY3 else 'thread')
+_sleep = eventlet.patcher.original('time').sleep
+_clock = getattr(time, 'perf_counter', time.time)
+
+# The Watchdog started in the current process
+_current = None
+
+
+def current():
+    """The Watchdog running in this process, None if there's none"""
+    return _current
+
+
+class Histogram(object):
+    """Blocking times of a route"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BLOCKING_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        self.buckets[bisect.bisect_left(BLOCKING_BUCKETS, duration)] += 1
+        self.count += 1
+        self.sum += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the given percentile"""
+
+        rank = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index < len(BLOCKING_BUCKETS):
+                    return BLOCKING_BUCKETS[index]
+                return self.max
+        return 0.0
+
+
+class Watchdog(object):
+    """Measures hub lag and greenthread run times in a child, see the module
+    docstring.
+
+    The watchdog thread checks every ``check_interval`` seconds for a
+    greenthread running over ``threshold``. At most ``max_routes`` routes get
+    histograms of their own, further ones count as OTHER_ROUTES.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.05, check_interval=None,
+                 report_interval=60, max_routes=200, report_routes=10):
+        if threshold <= 0:
+            raise ValueError("Threshold %s should be more than zero"
+                             % threshold)
+        self.threshold = threshold
+        self.interval = interval
+        self.check_interval = check_interval or threshold / 2.0
+        self.report_interval = report_interval
+        self.max_routes = max_routes
+        self.report_routes = report_routes
+
+        # route -> Histogram of greenthread run times
+        self.histograms = {}
+        self.lag = Histogram()
+        self.stalls = 0
+
+        self._hub = None
+        self._thread_id = None
+        # greenthread -> environ of the request it serves
+        self._requests = weakref.WeakKeyDictionary()
+        # the greenthread running, and since when
+        self._running = None
+        self._switched_in = None
+        # (greenthread, switched in, stack) captured by the watchdog thread
+        self._stall = None
+        self._stall_checked = None
+        # (duration, environ, stack) to be logged by the heartbeat
+        self._stalled = []
+
+    def start(self):
+        """Called in the child process, before the service runs"""
+
+        global _current
+
+        _current = self
+        self._hub = eventlet.hubs.get_hub()
+        self._thread_id = _thread.get_ident()
+        greenlet.settrace(self._trace)
+        eventlet.spawn_n(self._heartbeat)
+        thread = _threading.Thread(target=self._watch, name='watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def middleware(self, app):
+        return Middleware(app, self)
+
+    def tag(self, environ):
+        """Tag the current greenthread as serving the request of environ"""
+        self._requests[greenlet.getcurrent()] = environ
+
+    def route(self, environ):
+        if environ is None:
+            return NO_ROUTE
+        route = environ.get('routes.route')
+        path = (getattr(route, 'routepath', None) or
+                environ.get('PATH_INFO', ''))
+        return '%s %s' % (environ.get('REQUEST_METHOD', ''), path)
+
+    def _trace(self, event, args):
+        """greenlet trace function, called on each switch"""
+
+        if event not in ('switch', 'throw'):
+            return
+        origin, target = args
+        now = _clock()
+        started = self._switched_in
+        self._running = target
+        self._switched_in = now
+        if started is None or origin is self._hub.greenlet:
+            return
+
+        duration = now - started
+        environ = self._requests.get(origin)
+        route = self.route(environ)
+        histogram = self.histograms.get(route)
+        if histogram is None:
+            if len(self.histograms) >= self.max_routes:
+                route = OTHER_ROUTES
+            histogram = self.histograms.setdefault(route, Histogram())
+        histogram.record(duration)
+
+        stall = self._stall
+        if stall is not None and stall[0] is origin and stall[1] == started:
+            # Logging may switch greenthreads, the heartbeat does it
+            self._stalled.append((duration, environ, stall[2]))
+            self._stall = None
+
+    def _watch(self):
+        """Runs in the watchdog thread"""
+
+        while True:
+            _sleep(self.check_interval)
+            running, since = self._running, self._switched_in
+            if (running is None or running is self._hub.greenlet or
+                    since is None or since == self._stall_checked or
+                    _clock() - since < self.threshold):
+                continue
+            self._stall_checked = since
+            frame = sys._current_frames().get(self._thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            self._stall = (running, since, stack)
+
+    def _heartbeat(self):
+        next_report = time.time() + self.report_interval
+        while True:
+            start = _clock()
+            eventlet.sleep(self.interval)
+            self.lag.record(max(_clock() - start - self.interval, 0))
+
+            while self._stalled:
+                duration, environ, stack = self._stalled.pop(0)
+                self.stalls += 1
+                LOG.warning("Greenthread blocked the hub for %.3fs serving "
+                            "%s:\n%s", duration, self._request(environ),
+                            stack)
+
+            if time.time() >= next_report:
+                next_report = time.time() + self.report_interval
+                self._report()
+
+    @staticmethod
+    def _request(environ):
+        if environ is None:
+            return "no request"
+        return "%s %s" % (environ.get('REQUEST_METHOD'),
+                          environ.get('PATH_INFO'))
+
+    def _report(self):
+        LOG.info("Hub lag p50 %.4fs p99 %.4fs max %.4fs, %d stalls",
+                 self.lag.percentile(50), self.lag.percentile(99),
+                 self.lag.max, self.stalls)
+        routes = sorted(self.histograms.items(),
+                        key=lambda item: item[1].sum, reverse=True)
+        for route, histogram in routes[:self.report_routes]:
+            LOG.info("Blocking by %s: %d runs, total %.3fs, p99 %.4fs, "
+                     "max %.4fs", route, histogram.count, histogram.sum,
+                     histogram.percentile(99), histogram.max)
+
+
+class Middleware(object):
+    """Tags the greenthread serving each request"""
+
+    def __init__(self, app, watchdog):
+        self.app = app
+        self.watchdog = watchdog
+
+    def __call__(self, environ, start_response):
+        self.watchdog.tag(environ)
+        return self.app(environ, start_response)
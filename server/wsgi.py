@@ -1,29 +1,250 @@
+import collections
+import functools
 import logging
+import os
+import random
+import re
 import socket
+import time
 
+import eventlet
+from eventlet import greenio
+from eventlet import support
 import eventlet.wsgi
-from paste import deploy
-import routes.middleware
-import webob
-import webob.dec
-import webob.exc
 
+from pyacc.common import startup
 from pyacc.common import utils
+from pyacc.server import files
+from pyacc.server import metrics
 from pyacc.server import process
+from pyacc.server import routing
+from pyacc.server import watchdog
 
 
 LOG = logging.getLogger(__name__)
 
+# Idle connections get this long to send a request after the server starts
+# draining
+DRAIN_GRACE = 1.0
+
+# Seconds between load reports to metrics
+LOAD_REPORT_INTERVAL = 1.0
+
+# Only needed by loaders, routers and warmup, imported once used. eventlet.wsgi
+# can't wait, the server classes below are built on it.
+loadwsgi = startup.lazy_import('paste.deploy.loadwsgi')
+routes = startup.lazy_import('routes')
+webob = startup.lazy_import('webob')
+
 
 class Loader(object):
-    """Load wsgi applications from paste configurations"""
+    """Load wsgi applications from paste configurations.
+
+    The config is parsed once, when the loader is created, and each app built
+    once per name, later calls return the same app. Done in the parent, both
+    are inherited by children. clear() forgets the apps, and parses the config
+    again if its file changed since.
+    """
 
     def __init__(self, config_path=None):
-        utils.normalize_config_path(config_path)
-        self.config_path = config_path
+        self.config_path = utils.normalize_config_path(config_path)
+        self._apps = {}
+        self._parse()
+
+    def _parse(self):
+        with startup.phase('parse config %s' % self.config_path):
+            self._mtime = os.path.getmtime(self.config_path)
+            self._config = loadwsgi.ConfigLoader(self.config_path)
 
     def load_app(self, name):
-        return deploy.loadapp("config:%s" % self.config_path, name=name)
+        if name in self._apps:
+            return self._apps[name]
+        with startup.phase('load app %s' % (name or 'main')):
+            context = self._config.get_context(loadwsgi.APP, name)
+            app = self._apps[name] = context.create()
+        return app
+
+    def clear(self):
+        self._apps = {}
+        if os.path.getmtime(self.config_path) != self._mtime:
+            self._parse()
+
+
+class _DeadlineInput(object):
+    """wsgi.input whose reads raise socket.timeout once the body took longer
+    than its deadline to read"""
+
+    def __init__(self, wsgi_input, deadline):
+        self._input = wsgi_input
+        self._deadline = deadline
+
+    def _call(self, method, *args):
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("Request body read deadline passed")
+        with eventlet.Timeout(remaining, socket.timeout(
+                "Request body read deadline passed")):
+            return getattr(self._input, method)(*args)
+
+    def read(self, *args):
+        return self._call('read', *args)
+
+    def readline(self, *args):
+        return self._call('readline', *args)
+
+    def readlines(self, *args):
+        return self._call('readlines', *args)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self._input, name)
+
+
+class _WSGIServer(eventlet.wsgi.Server):
+    draining = False
+    requests = 0
+    max_requests = None
+    header_timeout = None
+    body_timeout = None
+    max_idle = None
+    metrics = None
+    # connections closed by timeouts and deadlines, or evicted when idle
+    reaped = 0
+
+    def count_request(self):
+        self.requests += 1
+        if self.requests == self.max_requests:
+            LOG.info("Served %d requests, asking to be recycled",
+                     self.requests)
+            process.request_recycle()
+
+    def __init__(self, *args, **kwargs):
+        eventlet.wsgi.Server.__init__(self, *args, **kwargs)
+        # id of connection -> connection waiting for a request, the one idle
+        # the longest first
+        self.idle = collections.OrderedDict()
+
+    def connection_idle(self, connection):
+        self.idle[id(connection)] = connection
+        while self.max_idle is not None and len(self.idle) > self.max_idle:
+            _, oldest = self.idle.popitem(last=False)
+            self.reap(oldest)
+
+    def connection_busy(self, connection):
+        self.idle.pop(id(connection), None)
+
+    def _count_reaped(self):
+        self.reaped += 1
+        if self.metrics is not None:
+            self.metrics.count(metrics.CONNECTIONS_REAPED)
+
+    def reap(self, connection):
+        self._count_reaped()
+        connection[2] = eventlet.wsgi.STATE_CLOSE
+        greenio.shutdown_safe(connection[1])
+
+    def process_request(self, connection):
+        """eventlet.wsgi's, counting connections timing out"""
+
+        try:
+            self.protocol(connection, self)
+        except socket.timeout:
+            self._count_reaped()
+            connection[1].close()
+            self.log.debug('(%s) timed out %r' % (self.pid, connection[0]))
+
+
+class _HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """Counts requests served on the connection, stops keep-alive once the
+    server is draining, sends file bodies with sendfile (see files), and
+    tracks idle connections and read deadlines"""
+
+    _header_deadline = None
+
+    def _read_request_line(self):
+        if self.server.header_timeout is not None and not self.rfile.closed:
+            self._wait_request()
+        line = eventlet.wsgi.HttpProtocol._read_request_line(self)
+        self.server.connection_busy(self.conn_state)
+        return line
+
+    def _wait_request(self):
+        """Wait for the first byte of a request, as long as the keep-alive
+        timeout allows, then start the deadline of its request line and
+        headers"""
+
+        if self.server.keepalive and not isinstance(self.server.keepalive,
+                                                    bool):
+            self.connection.settimeout(self.server.keepalive)
+        try:
+            self.rfile.peek(1)
+        except socket.timeout:
+            raise
+        except (IOError, OSError, ValueError, AttributeError):
+            # read again and handled by eventlet.wsgi
+            pass
+        self._header_deadline = eventlet.Timeout(
+            self.server.header_timeout,
+            socket.timeout("Request header read deadline passed"))
+
+    def _cancel_header_deadline(self):
+        if self._header_deadline is not None:
+            self._header_deadline.cancel()
+            self._header_deadline = None
+
+    def parse_request(self):
+        try:
+            return eventlet.wsgi.HttpProtocol.parse_request(self)
+        finally:
+            self._cancel_header_deadline()
+
+    def get_environ(self):
+        self._request_read = True
+        environ = eventlet.wsgi.HttpProtocol.get_environ(self)
+        environ['wsgi.file_wrapper'] = files.FileWrapper
+        if self.server.body_timeout is not None:
+            environ['wsgi.input'] = _DeadlineInput(
+                environ['wsgi.input'], time.time() + self.server.body_timeout)
+        return environ
+
+    def handle_one_response(self):
+        if self.server.draining:
+            # sends Connection: close, so the client doesn't send another
+            # request the server won't read
+            self.close_connection = 1
+        self.application = functools.partial(files.respond, self.application,
+                                             self.connection)
+        eventlet.wsgi.HttpProtocol.handle_one_response(self)
+
+    def handle_one_request(self):
+        # set once a request was parsed, not when the client closed or sent
+        # nothing
+        self._request_read = False
+        try:
+            eventlet.wsgi.HttpProtocol.handle_one_request(self)
+        finally:
+            # requests ending before their headers are parsed
+            self._cancel_header_deadline()
+        if self._request_read:
+            self.conn_state[3] += 1
+            self.server.count_request()
+        if self.server.draining:
+            self.close_connection = 1
+        if not self.close_connection:
+            self.server.connection_idle(self.conn_state)
+
+
+def _pending_input(sock):
+    """Whether the client sent a request not read yet. Such connections
+    aren't closed as idle on drain, their request is served, then the
+    connection closed for draining."""
+
+    try:
+        return bool(sock.fd.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+    except (socket.error, AttributeError):
+        return False
 
 
 # TODO Finished, but not tested
@@ -32,11 +253,79 @@ class Server(process.Service):
 
     It internally runs by eventlet.wsgi.server. Greenthreads will handle multiple
     concurrent client connects.
+
+    By default the listening socket is opened in the parent and shared by all
+    children, which accept from the same queue. With ``reuse_port=True`` the
+    parent only reserves the port, and each child binds its own SO_REUSEPORT
+    socket after fork so the kernel balances connections between children.
+    Given ``listeners``, sockets listening already like Unix domain sockets
+    or inherited fds (see the listeners module), the server accepts on all of
+    them instead, shared by the children the same way, and doesn't listen on
+    ``host`` and ``port``. Clients of Unix domain sockets have ``unix`` as
+    ``REMOTE_ADDR``, so share a client limit of admission.
+
+    Instead of ``app``, a ``loader`` can be given to load the app named
+    ``name`` from paste config. It is loaded in the parent by ``preload()``
+    (see ``process.Parent(preload=True)``), which also requests
+    ``warmup_paths`` so lazily built state is shared by children too.
+    Otherwise each child loads the app on its own. The loader parses its
+    config once, and builds each app once, until ``preload()`` reloads it.
+
+    Children log where their startup time went at debug level, see the
+    startup module.
+
+    The server tells its parent it is ready once it accepts connections, and
+    supports draining, which rolling reloads of the parent rely on. Note that
+    with ``reuse_port=True`` connections still queued on a drained child's own
+    socket are reset by the kernel when it is closed.
+
+    With a ``metrics.Metrics`` as ``metrics``, also given to the parent, every
+    request is counted and timed in the child's metrics slot, and the load of
+    the child is reported every LOAD_REPORT_INTERVAL seconds.
+
+    After ``max_requests`` requests, plus a random number up to
+    ``max_requests_jitter`` so that children don't all reach it together, a
+    child asks its parent to be recycled (see ``process.request_recycle()``).
+
+    With an ``accesslog.AccessLog`` as ``access_log`` access log lines are
+    buffered and written in batches by a thread, instead of logged by the
+    greenthread serving each request.
+
+    With an ``admission.Admission`` as ``admission`` the child keeps accepting
+    once its pool is full, queues connections for a while then answers them
+    503, and limits concurrent requests per route and client.
+
+    ``client_socket_timeout`` bounds each read and write of a request. Between
+    requests, and before the first one, a connection is closed once idle for
+    ``keepalive_timeout`` seconds instead. ``header_timeout`` bounds the time
+    to read the request line and all headers, from the first byte of the
+    request, and ``body_timeout`` the time to read its whole body, a request
+    exceeding the latter sees socket.timeout reading ``wsgi.input``. Beyond
+    ``max_idle_connections`` idle connections, the one idle the longest is
+    closed. Connections closed so count as reaped, see ``connection_stats()``.
+
+    Bodies of ``environ['wsgi.file_wrapper']`` are sent with sendfile, and
+    range requests of them answered, see the files module.
+
+    When a watchdog runs in the child (see ``process.Parent``), the greenthread
+    serving each request is tagged with it, for blocking times per route.
     """
 
+    notifies_ready = True
+
     def __init__(self, name=None, app=None, host='0.0.0.0', port=1234,
                  pool_size=1024, backlog=128, family=socket.AF_INET,
-                 client_socket_timeout=900, max_header_line=None):
+                 client_socket_timeout=900, max_header_line=None,
+                 reuse_port=False, loader=None, warmup_paths=(), metrics=None,
+                 max_requests=None, max_requests_jitter=0, access_log=None,
+                 admission=None, keepalive_timeout=None,
+                 max_idle_connections=None, header_timeout=None,
+                 body_timeout=None, listeners=None):
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        if reuse_port and listeners:
+            raise ValueError("Listeners can't be given with reuse_port")
+
         self.name = name
         self.app = app
         self.host = host
@@ -45,6 +334,18 @@ class Server(process.Service):
         self.backlog = backlog
         self.family = family
         self.client_socket_timeout = client_socket_timeout
+        self.reuse_port = reuse_port
+        self.loader = loader
+        self.warmup_paths = warmup_paths
+        self.metrics = metrics
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.access_log = access_log
+        self.admission = admission
+        self.keepalive_timeout = keepalive_timeout
+        self.max_idle_connections = max_idle_connections
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
         self._wsgi_logger = utils.WritableLogger(
             logging.getLogger("eventlet.wsgi.server"))
 
@@ -53,33 +354,231 @@ class Server(process.Service):
         eventlet.wsgi.MAX_HEADER_LINE = self.max_header_line
 
         self._pool = eventlet.GreenPool(size=self.pool_size)
-        self._socket = eventlet.listen((self.host, self.port), backlog=self.backlog,
+        if listeners:
+            self._sockets = list(listeners)
+            # of the first TCP listener, None without any
+            self.host = self.port = None
+            inet = [sock for sock in self._sockets
+                    if sock.family in (socket.AF_INET, socket.AF_INET6)]
+            if inet:
+                (self.host, self.port) = inet[0].getsockname()[0:2]
+        else:
+            if self.reuse_port:
+                sock = self._reserve_port()
+            else:
+                sock = eventlet.listen((self.host, self.port),
+                                       backlog=self.backlog,
                                        family=self.family)
-        (self.host, self.port) = self._socket.getsockname()[0:2]
+            self._sockets = [sock]
+            (self.host, self.port) = sock.getsockname()[0:2]
+        self._socket = self._sockets[0]
         self._wsgi = None
 
+    def _reserve_port(self):
+        # Bound but never listening, so the kernel doesn't route connections to
+        # it. It keeps the port, also a random one, reserved for the children.
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
     def _setup_socket(self):
-        # Duplicate sever socket to keep underlying file descriptor usable after
-        # others exit
-        self._socket_dup = self._socket.dup()
-        self._socket_dup.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Each child has its own accept queue, no thundering herd
+            self._socket_dup = eventlet.listen((self.host, self.port),
+                                               backlog=self.backlog,
+                                               family=self.family,
+                                               reuse_port=True)
+            self._sockets_dup = [self._socket_dup]
+            return
+
+        # Duplicate sever sockets to keep underlying file descriptors usable
+        # after others exit
+        self._sockets_dup = []
+        for sock in self._sockets:
+            sock_dup = sock.dup()
+            if sock.family != socket.AF_UNIX:
+                sock_dup.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sockets_dup.append(sock_dup)
+        self._socket_dup = self._sockets_dup[0]
+
+    def _load_app(self):
+        self.app = self.loader.load_app(self.name)
+
+    def _warmup(self, path):
+        try:
+            with startup.phase('warm up %s' % path):
+                response = webob.Request.blank(path).get_response(self.app)
+        except Exception:
+            LOG.exception("Warming up %s failed", path)
+            return
+        LOG.info("Warmed up %(path)s: %(status)s",
+                 {'path': path, 'status': response.status})
+
+    # Will be invoked in parent process before fork, again on each reload
+    def preload(self):
+        if self.loader is not None:
+            # a reload gets the app built again
+            self.loader.clear()
+            self._load_app()
+        for path in self.warmup_paths:
+            self._warmup(path)
 
     # Will be invoked in child process
     def wait(self):
-        self._setup_socket()
+        if self.app is None and self.loader is not None:
+            self._load_app()
+        with startup.phase('setup socket'):
+            self._setup_socket()
+        app = self.app
+        if self.admission is not None:
+            app = self.admission.middleware(app)
+        if self.metrics is not None:
+            app = self.metrics.middleware(app)
+        if watchdog.current() is not None:
+            app = watchdog.current().middleware(app)
 
-        wsgi_kwargs = {
-            'sock': self._socket_dup,
-            'site': self.app,
-            'custom_pool': self._pool,
-            'log': self._wsgi_logger,
-            'socket_timeout': self.client_socket_timeout,
-            'keepalive': True,
-        }
+        log = self._wsgi_logger
+        log_format = eventlet.wsgi.DEFAULT_LOG_FORMAT
+        if self.access_log is not None:
+            self.access_log.start()
+            log = self.access_log
+            log_format = self.access_log.fields_format
+        self._wsgi_server = _WSGIServer(
+            self._socket_dup, self._socket_dup.getsockname(), app, log=log,
+            log_format=log_format, protocol=_HttpProtocol,
+            socket_timeout=self.client_socket_timeout,
+            keepalive=self.keepalive_timeout or True)
+        self._wsgi_server.header_timeout = self.header_timeout
+        self._wsgi_server.body_timeout = self.body_timeout
+        self._wsgi_server.max_idle = self.max_idle_connections
+        self._wsgi_server.metrics = self.metrics
+        if self.max_requests:
+            # children all inherit the parent's random state
+            self._wsgi_server.max_requests = (
+                self.max_requests +
+                random.SystemRandom().randint(0, self.max_requests_jitter))
 
         LOG.info("Starting WSGI server")
         # Server multiple client connections concurrently using greenthreads
-        self._wsgi = eventlet.wsgi.server(**wsgi_kwargs)
+        self._wsgi = eventlet.spawn(self._serve)
+        if self.metrics is not None:
+            eventlet.spawn_n(self._report_load)
+        process.notify_ready()
+        self._wsgi.wait()
+
+    def _serve(self):
+        """The accept loop of eventlet.wsgi.server, but draining gracefully.
+
+        eventlet.wsgi.server shuts down every idle connection when it stops,
+        including ones just accepted whose request hasn't been read yet, or
+        whose client sent its next request already. Here idle connections get
+        DRAIN_GRACE seconds to send a request, answered with Connection:
+        close, then those with nothing sent are shut down. Each listener has
+        an accept loop of its own.
+        """
+        # id of connection -> [addr, socket, state, requests served], clients
+        # of Unix domain sockets have no address
+        connections = {}
+        admission = self.admission
+
+        def _spawn(connection):
+            connections[id(connection)] = connection
+            self._wsgi_server.connection_idle(connection)
+            self._pool.spawn(self._wsgi_server.process_request,
+                             connection).link(_clean_connection, connection)
+
+        def _clean_connection(_, conn):
+            connections.pop(id(conn), None)
+            self._wsgi_server.connection_busy(conn)
+            conn[2] = eventlet.wsgi.STATE_CLOSE
+            greenio.shutdown_safe(conn[1])
+            conn[1].close()
+            if admission is not None and self._pool.free():
+                waiting = admission.pop()
+                if waiting is not None:
+                    _spawn(waiting)
+
+        def _accept(listener):
+            while not self._wsgi_server.draining:
+                try:
+                    client_socket, client_addr = listener.accept()
+                except eventlet.wsgi.ACCEPT_EXCEPTIONS as exc:
+                    if (support.get_errno(exc) not in
+                            eventlet.wsgi.ACCEPT_ERRNO):
+                        raise
+                    break
+                except (KeyboardInterrupt, SystemExit):
+                    break
+                client_socket.settimeout(self.client_socket_timeout)
+                connection = [client_addr, client_socket,
+                              eventlet.wsgi.STATE_IDLE, 0]
+                if admission is not None and not self._pool.free():
+                    admission.wait(connection)
+                else:
+                    _spawn(connection)
+
+        # the first listener is accepted from here, drain() kills this one
+        acceptors = [eventlet.spawn(_accept, listener)
+                     for listener in self._sockets_dup[1:]]
+        try:
+            _accept(self._sockets_dup[0])
+        finally:
+            self._wsgi_server.draining = True
+            for acceptor in acceptors:
+                acceptor.kill()
+            if admission is not None:
+                admission.reject_waiting()
+            eventlet.spawn_after(DRAIN_GRACE, self._close_idle, connections)
+            self._pool.waitall()
+            LOG.info("WSGI server exited")
+            for listener in self._sockets_dup:
+                listener.close()
+
+    def _report_load(self):
+        while not self._wsgi_server.draining:
+            start = time.time()
+            eventlet.sleep(LOAD_REPORT_INTERVAL)
+            # a busy loop runs the timer late
+            loop_lag = max(time.time() - start - LOAD_REPORT_INTERVAL, 0)
+            backlog = sum(utils.read_accept_backlog(listener)
+                          for listener in self._sockets_dup)
+            self.metrics.set_load(self._pool.running(), self._pool.size,
+                                  backlog, loop_lag)
+            stats = self.connection_stats()
+            self.metrics.set_connections(stats['open'], stats['idle'])
+
+    def connection_stats(self):
+        """Open and idle connections of the child, and how many were reaped"""
+
+        if self._wsgi is None:
+            return {'open': 0, 'idle': 0, 'reaped': 0}
+        return {'open': self._pool.running(),
+                'idle': len(self._wsgi_server.idle),
+                'reaped': self._wsgi_server.reaped}
+
+    def load(self):
+        """Reported to the parent with each heartbeat, see process.Parent"""
+
+        load = self.connection_stats()
+        load['pool_busy'] = self._pool.running()
+        load['pool_size'] = self._pool.size
+        return load
+
+    @staticmethod
+    def _close_idle(connections):
+        for connection in list(connections.values()):
+            if (connection[2] == eventlet.wsgi.STATE_IDLE and
+                    not _pending_input(connection[1])):
+                connection[2] = eventlet.wsgi.STATE_CLOSE
+                greenio.shutdown_safe(connection[1])
+
+    def drain(self):
+        LOG.info("Draining WSGI server")
+        if self._wsgi is not None:
+            # stop accepting, wait() returns after in-flight requests finish
+            self._wsgi.kill(SystemExit)
 
     def stop(self):
         LOG.info("Stopping WSGI server")
@@ -92,23 +591,69 @@ class Server(process.Service):
 # TODO After all, my process.py would boot up the wsgi server
 # TODO I start to think, why not just use web.py?
 class Router(object):
+    """Dispatch requests to the controller of the route they match.
+
+    With ``compiled=True`` URLs are matched by a routing.RouteTable built from
+    the mapper, with ``cache_size`` and ``types`` passed to it, and no
+    webob.Request is built on the way to the controller. Requests overriding
+    their method with ``_method``, and redirect routes, are still handed to
+    routes.
+    """
 
-    def __init__(self, mapper):
+    def __init__(self, mapper, compiled=False, cache_size=1024, types=None):
         self.mapper = mapper
         self._router = routes.middleware.RoutesMiddleware(self._dispatch, self.mapper)
+        self._table = None
+        if compiled:
+            self._table = routing.RouteTable(mapper, cache_size=cache_size,
+                                             types=types)
+
+    def __call__(self, environ, start_response):
+        if self._table is None:
+            return self._route(environ, start_response)
+        return self._route_compiled(environ, start_response)
+
+    def _route(self, environ, start_response):
+        return self._router(environ, start_response)
 
-    @webob.dec.wsgify(RequestClass=webob.Request)
-    def __call__(self, request):
-        return self._router
+    def _route_compiled(self, environ, start_response):
+        if ('_method' in environ.get('QUERY_STRING', '') or
+                (environ['REQUEST_METHOD'] == 'POST' and
+                 routes.middleware.is_form_post(environ))):
+            return self._router(environ, start_response)
+
+        result = self._table.match(environ['PATH_INFO'],
+                                   environ['REQUEST_METHOD'], environ)
+        if result is None:
+            return webob.exc.HTTPNotFound()(environ, start_response)
+        match, route = result
+        if route.redirect:
+            return self._router(environ, start_response)
+
+        # what RoutesMiddleware sets up for the controller
+        url = routes.util.URLGenerator(self.mapper, environ)
+        environ['wsgiorg.routing_args'] = ((url), match)
+        environ['routes.route'] = route
+        environ['routes.url'] = url
+        if 'path_info' in match:
+            old_path = environ['PATH_INFO']
+            new_path = match['path_info'] or ''
+            environ['PATH_INFO'] = new_path
+            if not new_path.startswith('/'):
+                environ['PATH_INFO'] = '/' + new_path
+            environ['SCRIPT_NAME'] += re.sub(
+                r'^(.*?)/' + re.escape(new_path) + '$', r'\1', old_path)
+
+        app = match['controller']
+        return app(environ, start_response)
 
     @staticmethod
-    @webob.dec.wsgify(RequestClass=webob.Request)
-    def _dispatch(request):
-        url, match = request.environ['wsgiorg.routing_args']
+    def _dispatch(environ, start_response):
+        url, match = environ['wsgiorg.routing_args']
         if not match:
-            return webob.exc.HTTPNotFound()
+            return webob.exc.HTTPNotFound()(environ, start_response)
         app = match['controller']
-        return app
+        return app(environ, start_response)
 
 # TODO I can use web.py as wsgi application and Apache+mod_wsgi as multiprocess server.
 # TODO For web.py: application = web.application(urls, globals()).wsgifunc()
@@ -0,0 +1,26 @@
+"""I will modify this into mock someday.
+
+By now it is tested manually. Test case includes:
+1. Run ``python test_startup.py``. routes and webob are imported before
+   pyacc.server.wsgi, whose lazy modules should still import their submodules
+   on use: a wsgi.Router is built and answers 404 for an unknown path.
+2. The startup phases recorded are logged, with ``import routes.middleware``
+   among them.
+"""
+
+import routes
+import webob
+
+from pyacc.common import config
+from pyacc.common import startup
+from pyacc.server import wsgi
+
+
+if __name__ == '__main__':
+    config.setup_logging()
+    mapper = routes.Mapper()
+    mapper.connect('/servers', controller=object())
+    router = wsgi.Router(mapper)
+    response = webob.Request.blank('/unknown').get_response(router)
+    print("GET /unknown: %s" % response.status)
+    startup.report()
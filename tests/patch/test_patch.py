@@ -3,6 +3,7 @@
 
 from pyacc.tests.patch.mda.cls_a import A
 from pyacc.common.patch import Patch
+from pyacc.common.patch import PatchSet
 
 
 a = A()
@@ -57,6 +58,25 @@ with Patch('pyacc.tests.patch.mdc.cls_c.E', decorate=False, return_value=7) as m
     a.f1()
     print 'mock trace %s' % mock
 
+print '----------patch set-----------'
+
+patches = ['pyacc.tests.patch.mdb.cls_b.B.f2',
+           Patch('pyacc.tests.patch.mdc.cls_c.C', decorate=False)]
+with PatchSet(patches) as mocks:
+    a = A()
+    a.f1()
+    print 'mock traces %s' % mocks
+
+print '----------patch set path error-----------'
+
+try:
+    with PatchSet(['pyacc.tests.patch.mdb.cls_b.B.f2',
+                   'pyacc.tests.patch.mdc.cls_c.E']) as mocks:
+        pass
+except AttributeError as e:
+    # nothing patched
+    print 'error %s' % e
+
 print '----------------------------'
 
 a = A()
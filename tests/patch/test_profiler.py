@@ -0,0 +1,38 @@
+# Manual tests. Methods of classes, a module function and a decorated method
+# are profiled while attached, and called as before once detached.
+
+import logging
+
+from pyacc.common import config
+from pyacc.common.patch import Profiler
+from pyacc.tests.patch.mda.cls_a import A
+
+
+config.setup_logging()
+
+profiler = Profiler(['pyacc.tests.patch.mda.cls_a.A.f2',
+                     'pyacc.tests.patch.mdb.cls_b.B.f2',
+                     'pyacc.tests.patch.mdc.cls_c.C'], sample_rate=0.5)
+
+print('--------attached----------')
+
+profiler.attach()
+for _ in range(10):
+    A().f1()
+# A.f2 called 10 times, B.f2 and C 20 times each, about half of the calls
+# sampled
+profiler.dump(log=logging.getLogger(__name__).info)
+
+print('--------detached----------')
+
+profiler.detach()
+A().f1()
+# counts unchanged
+profiler.dump()
+
+print('--------context manager----------')
+
+profiler.reset()
+with profiler:
+    A().f1()
+profiler.dump()
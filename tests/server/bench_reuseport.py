@@ -0,0 +1,128 @@
+"""Compare the shared listening socket with per-child SO_REUSEPORT sockets.
+
+Run manually: ``python bench_reuseport.py [children] [clients] [requests]``.
+
+For each mode a Parent with N wsgi.Server children is started on a random
+loopback port. Client threads open a new connection per request, so every
+request goes through accept(). Reported per mode:
+
+1. Latency from connect() to the first response byte (mean, p50, p99), which
+   includes the time the connection waits in the accept queue.
+2. How many requests each child served. The app returns its pid. A perfectly
+   even spread has a max/min ratio of 1.0.
+"""
+
+import collections
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from pyacc.server import process
+from pyacc.server import wsgi
+
+
+def pid_app(env, start_response):
+    body = str(os.getpid()).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def start_parent(children, reuse_port):
+    server = wsgi.Server(name='bench', app=pid_app, host='127.0.0.1', port=0,
+                         reuse_port=reuse_port)
+    pid = os.fork()
+    if pid == 0:
+        parent = process.Parent(server, count=children)
+        parent.wait()
+        os._exit(0)
+    server._socket.close()
+    return pid, server.port
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("Server on port %d did not come up" % port)
+
+
+def one_request(port):
+    start = time.time()
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: bench\r\n'
+                     b'Connection: close\r\n\r\n')
+        data = sock.recv(65536)
+        latency = time.time() - start
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return latency, data.rsplit(b'\r\n\r\n', 1)[-1].decode('ascii')
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100.0))
+    return values[index]
+
+
+def run(children, clients, requests, reuse_port):
+    parent_pid, port = start_parent(children, reuse_port)
+    try:
+        wait_listening(port)
+        # let every child reach accept()
+        time.sleep(1)
+
+        latencies = []
+        served = collections.Counter()
+        lock = threading.Lock()
+
+        def client():
+            for _ in range(requests):
+                latency, pid = one_request(port)
+                with lock:
+                    latencies.append(latency)
+                    served[pid] += 1
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        os.kill(parent_pid, signal.SIGTERM)
+        os.waitpid(parent_pid, 0)
+
+    counts = sorted(served.values())
+    print("mode=%-12s req/s=%8.1f mean=%.2fms p50=%.2fms p99=%.2fms "
+          "children_served=%d max/min=%.2f per_child=%s" % (
+              'reuse_port' if reuse_port else 'shared',
+              len(latencies) / elapsed,
+              1000 * sum(latencies) / len(latencies),
+              1000 * percentile(latencies, 50),
+              1000 * percentile(latencies, 99),
+              len(counts),
+              float(counts[-1]) / counts[0],
+              counts))
+
+
+if __name__ == '__main__':
+    children = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    for reuse_port in (False, True):
+        run(children, clients, requests, reuse_port)
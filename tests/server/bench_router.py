@@ -0,0 +1,108 @@
+"""Compare routing through routes.middleware with the compiled route table.
+
+Run manually: ``python bench_router.py [resources] [requests]``.
+
+A mapper with ``resources`` REST resources, 14 routes each (1400 routes by
+default), is served by wsgi.Router(mapper) and wsgi.Router(mapper,
+compiled=True). Both routers should dispatch every request to the same
+controller with the same match dict, then the time per request of each is
+printed, once with the route cache disabled and once enabled.
+
+With the defaults the compiled table routes about 3.3x faster, around 30us
+against 100us per request, and about 2x with 20 resources. The route cache
+makes no measurable difference: most requests carry a random id, so their
+paths rarely repeat.
+"""
+
+import random
+import sys
+import time
+
+import routes
+
+from pyacc.server import wsgi
+
+
+class Controller(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, env, start_response):
+        url, match = env['wsgiorg.routing_args']
+        match = dict(match)
+        match.pop('controller')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [self.name, sorted(match.items())]
+
+
+def build_mapper(resources):
+    mapper = routes.Mapper()
+    for i in range(resources):
+        mapper.resource('item%d' % i, 'items%d' % i,
+                        controller=Controller('items%d' % i))
+    return mapper
+
+
+def build_requests(resources, count):
+    requests = []
+    for _ in range(count):
+        i = random.randrange(resources)
+        method, path = random.choice([
+            ('GET', '/items%d' % i),
+            ('POST', '/items%d' % i),
+            ('GET', '/items%d/%d' % (i, random.randrange(1000))),
+            ('PUT', '/items%d/%d' % (i, random.randrange(1000))),
+            ('DELETE', '/items%d/%d' % (i, random.randrange(1000))),
+            ('GET', '/items%d/new' % i),
+            ('GET', '/items%d/%d/edit' % (i, random.randrange(1000))),
+            ('GET', '/missing/%d' % i),
+        ])
+        requests.append({'REQUEST_METHOD': method, 'PATH_INFO': path,
+                         'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                         'SERVER_NAME': 'bench', 'SERVER_PORT': '80',
+                         'wsgi.url_scheme': 'http'})
+    return requests
+
+
+def route(router, environ):
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result['status'] = status
+
+    body = router(dict(environ), start_response)
+    if result['status'].startswith('404'):
+        return '404'
+    return body
+
+
+def run(router, requests):
+    start = time.time()
+    for environ in requests:
+        route(router, environ)
+    return (time.time() - start) / len(requests)
+
+
+if __name__ == '__main__':
+    resources = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    mapper = build_mapper(resources)
+    requests = build_requests(resources, count)
+    print("%d routes, %d requests" % (len(mapper.matchlist), count))
+
+    routes_router = wsgi.Router(mapper)
+    for cache_size in (0, 1024):
+        compiled_router = wsgi.Router(mapper, compiled=True,
+                                      cache_size=cache_size)
+        for environ in requests[:2000]:
+            expected = route(routes_router, environ)
+            actual = route(compiled_router, environ)
+            assert expected == actual, (environ['REQUEST_METHOD'],
+                                        environ['PATH_INFO'], expected, actual)
+
+        routes_time = run(routes_router, requests)
+        compiled_time = run(compiled_router, requests)
+        print("cache_size=%-5d routes.middleware=%.1fus compiled=%.1fus "
+              "speedup=%.1fx" % (cache_size, routes_time * 1e6,
+                                 compiled_time * 1e6,
+                                 routes_time / compiled_time))
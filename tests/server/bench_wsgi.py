@@ -0,0 +1,378 @@
+"""Load benchmark of process.Parent running wsgi.Server children, on loopback.
+
+Run manually::
+
+    python bench_wsgi.py --count 1 2 4 --payload 64 16384 --output run.json
+    python bench_wsgi.py ... --compare run.json
+
+For every combination of ``--count``, ``--pool-size``, ``--backlog``,
+``--payload`` and ``--placement`` a Parent is started in a forked process,
+serving an app that returns ``payload`` bytes. Load generator processes, each
+holding ``--connections`` keep-alive connections in threads, send requests
+back to back for ``--duration`` seconds after a ``--warmup``. Reported for
+each run:
+
+1. Requests per second and errors.
+2. Latency p50, p99 and p999, from sending a request to reading the whole
+   response.
+3. CPU usage and RSS of each child, read from /proc. CPU is in percent of one
+   core over the measured duration.
+
+``--placement`` is ``none``, children placed by the scheduler, ``pinned``,
+each child pinned to a CPU of its own, or ``numa``, pinned and spread over NUMA
+nodes, ``--reserved-cpus`` kept for the parent (see the placement module).
+When pinned, load generators run on the CPUs no child is pinned to, if any.
+Compare e.g.::
+
+    python bench_wsgi.py --count 4 --placement none pinned numa
+
+With ``--output`` the results are written as JSON. With ``--compare`` the runs
+are compared with those of a JSON file written before, and the exit code is 1
+if any run got more than ``--tolerance`` slower, in req/s or p99.
+"""
+
+import argparse
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+from pyacc.common import utils
+from pyacc.server import placement
+from pyacc.server import process
+from pyacc.server import wsgi
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def payload_app(payload):
+    body = b'x' * payload
+    headers = [('Content-Type', 'application/octet-stream'),
+               ('Content-Length', str(len(body)))]
+
+    def app(env, start_response):
+        start_response('200 OK', headers)
+        return [body]
+    return app
+
+
+def make_placement(name, reserved_cpus):
+    if name == 'none':
+        return None
+    return placement.Placement(numa=(name == 'numa'),
+                               reserved_cpus=reserved_cpus)
+
+
+def generator_cpus(child_placement, count):
+    """CPUs the children and parent aren't pinned to, None for any"""
+
+    if child_placement is None:
+        return None
+    cpus = set(os.sched_getaffinity(0)) - set(child_placement.parent_cpus)
+    for slot in range(count):
+        cpus -= set(child_placement.cpus_of(slot))
+    return cpus or None
+
+
+def start_parent(count, pool_size, backlog, payload, child_placement):
+    server = wsgi.Server(name='bench', app=payload_app(payload),
+                         host='127.0.0.1', port=0, pool_size=pool_size,
+                         backlog=backlog)
+    pid = os.fork()
+    if pid == 0:
+        parent = process.Parent(server, count=count,
+                                reap_mode=process.REAP_SIGNAL,
+                                placement=child_placement)
+        parent.wait()
+        os._exit(0)
+    server._socket.close()
+    return pid, server.port
+
+
+def wait_children(parent_pid, count, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        children = children_of(parent_pid)
+        if len(children) == count:
+            try:
+                socket.create_connection(('127.0.0.1', port),
+                                         timeout=1).close()
+                return children
+            except socket.error:
+                pass
+        time.sleep(0.05)
+    raise RuntimeError("Children of parent %d did not come up" % parent_pid)
+
+
+def children_of(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        # fields after the command: state, ppid, ...
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return sorted(children)
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of stat
+    return ((int(fields[11]) + int(fields[12])) /
+            float(os.sysconf('SC_CLK_TCK')))
+
+
+def read_response(sock, buf):
+    """Read one response, return what was read past its end"""
+
+    while b'\r\n\r\n' not in buf:
+        data = sock.recv(65536)
+        if not data:
+            raise socket.error("Connection closed")
+        buf += data
+    head, buf = buf.split(b'\r\n\r\n', 1)
+    if not head.startswith(b'HTTP/1.1 200'):
+        raise ValueError("Unexpected response %r" % head[:32])
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while len(buf) < length:
+        data = sock.recv(max(65536, length - len(buf)))
+        if not data:
+            raise socket.error("Connection closed")
+        buf += data
+    return buf[length:]
+
+
+def generate(port, connections, duration):
+    """Run in a load generator process, returns (latencies, errors)"""
+
+    request = (b'GET / HTTP/1.1\r\nHost: bench\r\n'
+               b'Connection: keep-alive\r\n\r\n')
+    deadline = time.time() + duration
+    latencies = array.array('d')
+    errors = [0]
+    lock = threading.Lock()
+
+    def client():
+        local = array.array('d')
+        local_errors = 0
+        sock = None
+        buf = b''
+        while time.time() < deadline:
+            try:
+                if sock is None:
+                    sock = socket.create_connection(('127.0.0.1', port))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    buf = b''
+                start = clock()
+                sock.sendall(request)
+                buf = read_response(sock, buf)
+                local.append(clock() - start)
+            except (socket.error, ValueError):
+                local_errors += 1
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is not None:
+            sock.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def run_generators(port, generators, connections, duration, cpus=None):
+    pipes = []
+    for _ in range(generators):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            if cpus is not None:
+                os.sched_setaffinity(0, cpus)
+            latencies, errors = generate(port, connections, duration)
+            data = struct.pack('!II', len(latencies), errors)
+            data += latencies.tostring() if not hasattr(
+                latencies, 'tobytes') else latencies.tobytes()
+            with os.fdopen(write_fd, 'wb') as pipe:
+                pipe.write(data)
+            os._exit(0)
+        os.close(write_fd)
+        pipes.append((pid, read_fd))
+
+    latencies = array.array('d')
+    errors = 0
+    for pid, read_fd in pipes:
+        with os.fdopen(read_fd, 'rb') as pipe:
+            data = pipe.read()
+        os.waitpid(pid, 0)
+        count, generator_errors = struct.unpack('!II', data[:8])
+        part = array.array('d')
+        if hasattr(part, 'frombytes'):
+            part.frombytes(data[8:])
+        else:
+            part.fromstring(data[8:])
+        latencies.extend(part)
+        errors += generator_errors
+    return latencies, errors
+
+
+def percentile(values, pct):
+    index = min(len(values) - 1, int(len(values) * pct / 100.0))
+    return values[index]
+
+
+def run(args, count, pool_size, backlog, payload, placement_name):
+    child_placement = make_placement(placement_name, args.reserved_cpus)
+    cpus = generator_cpus(child_placement, count)
+    parent_pid, port = start_parent(count, pool_size, backlog, payload,
+                                    child_placement)
+    try:
+        children = wait_children(parent_pid, count, port)
+        if args.warmup:
+            run_generators(port, args.generators, args.connections,
+                           args.warmup, cpus)
+        cpu_before = dict((pid, cpu_seconds(pid)) for pid in children)
+        start = time.time()
+        latencies, errors = run_generators(port, args.generators,
+                                           args.connections, args.duration,
+                                           cpus)
+        elapsed = time.time() - start
+        per_child = []
+        for pid in children:
+            usage = utils.read_memory_usage(pid)
+            per_child.append({
+                'pid': pid,
+                'cpu_percent': round(100 * (cpu_seconds(pid) -
+                                            cpu_before[pid]) / elapsed, 1),
+                'rss': usage['rss'],
+                'pss': usage['pss'],
+            })
+    finally:
+        os.kill(parent_pid, signal.SIGTERM)
+        os.waitpid(parent_pid, 0)
+
+    latencies = sorted(latencies)
+    if not latencies:
+        latencies = [float('nan')]
+    return {
+        'count': count,
+        'pool_size': pool_size,
+        'backlog': backlog,
+        'payload': payload,
+        'placement': placement_name,
+        'requests': len(latencies),
+        'errors': errors,
+        'req_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(1000 * percentile(latencies, 50), 3),
+        'p99_ms': round(1000 * percentile(latencies, 99), 3),
+        'p999_ms': round(1000 * percentile(latencies, 99.9), 3),
+        'children': per_child,
+    }
+
+
+def run_key(result):
+    key = ('count=%(count)d pool_size=%(pool_size)d backlog=%(backlog)d '
+           'payload=%(payload)d' % result)
+    # runs of baselines from before placements weren't placed
+    return key + ' placement=%s' % result.get('placement', 'none')
+
+
+def compare(results, baseline_path, tolerance):
+    """Print the change of each run from the baseline, True if none
+    regressed"""
+
+    with open(baseline_path) as baseline_file:
+        baseline = dict((run_key(result), result)
+                        for result in json.load(baseline_file)['results'])
+    passed = True
+    for result in results:
+        key = run_key(result)
+        if key not in baseline:
+            print("%s: not in baseline" % key)
+            continue
+        base = baseline[key]
+        req_s_change = result['req_s'] / base['req_s'] - 1
+        p99_change = result['p99_ms'] / base['p99_ms'] - 1
+        regressed = req_s_change < -tolerance or p99_change > tolerance
+        passed = passed and not regressed
+        print("%s: req/s %+.1f%% p99 %+.1f%% %s" % (
+            key, 100 * req_s_change, 100 * p99_change,
+            'REGRESSED' if regressed else 'ok'))
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--pool-size', type=int, nargs='+', default=[1024])
+    parser.add_argument('--backlog', type=int, nargs='+', default=[128])
+    parser.add_argument('--payload', type=int, nargs='+', default=[64, 16384])
+    parser.add_argument('--placement', nargs='+', default=['none'],
+                        choices=['none', 'pinned', 'numa'])
+    parser.add_argument('--reserved-cpus', type=int, default=0,
+                        help="CPUs kept for the parent when pinned")
+    parser.add_argument('--generators', type=int,
+                        default=max(1,
+                                    os.sysconf('SC_NPROCESSORS_ONLN') // 2))
+    parser.add_argument('--connections', type=int, default=16,
+                        help="keep-alive connections per generator")
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of a baseline run")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = []
+    for count in args.count:
+        for pool_size in args.pool_size:
+            for backlog in args.backlog:
+                for payload in args.payload:
+                    for placement_name in args.placement:
+                        result = run(args, count, pool_size, backlog,
+                                     payload, placement_name)
+                        results.append(result)
+                        print("%s: req/s=%.1f p50=%.2fms p99=%.2fms "
+                              "p999=%.2fms errors=%d cpu=%s rss=%s" % (
+                                  run_key(result), result['req_s'],
+                                  result['p50_ms'], result['p99_ms'],
+                                  result['p999_ms'], result['errors'],
+                                  [child['cpu_percent']
+                                   for child in result['children']],
+                                  [child['rss'] // 1024 // 1024
+                                   for child in result['children']]))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'generators': args.generators,
+                       'connections': args.connections,
+                       'duration': args.duration,
+                       'results': results}, output, indent=2, sort_keys=True)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
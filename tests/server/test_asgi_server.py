@@ -0,0 +1,36 @@
+"""I will modify this into mock someday.
+
+By now it is tested manually, with Python 3. Test case includes:
+1. Start the asgi server on one side. Use curl to connect on another side.
+   Curl should return the message and the scope.
+2. ``curl -d hello localhost:1234`` should echo the request body back.
+3. Send SIGHUP to the parent while running curl in a loop. New children should
+   be started, then old ones drained one by one. No curl should fail.
+4. Kill parent by SIGKILL (kill -9). All children should exit.
+"""
+
+import pprint
+
+from pyacc.common import config
+from pyacc.server import asgi
+from pyacc.server import process
+
+
+async def asgi_app(scope, receive, send):
+    message = await receive()
+    body = {
+        'message': 'hello world',
+        'body': message['body'],
+        'scope': scope,
+    }
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body',
+                'body': pprint.pformat(body).encode('utf-8')})
+
+
+if __name__ == '__main__':
+    config.setup_logging()
+    server = asgi.Server(asgi_app)
+    parent = process.Parent(server, count=4)
+    parent.wait()
@@ -0,0 +1,64 @@
+"""I will modify this into mock someday.
+
+By now it is tested manually. Test case includes:
+1. Run ``python test_autoscale.py``. The decisions of an Autoscaler fed with
+   synthetic loads are printed: the count should grow by one child after
+   ``sustain`` overloaded checks, not again before ``up_cooldown``, and shrink
+   back to ``min_children`` one child per ``down_cooldown`` once idle.
+2. Run ``python test_autoscale.py serve`` and load it with e.g.
+   ``ab -c 64 -n 100000 http://localhost:1234/``. Children should be added up
+   to 4 while loaded, then drained one by one down to 1 after ``ab`` ends. See
+   the counts at localhost:9100/metrics.
+"""
+
+import sys
+import time
+
+from pyacc.common import config
+from pyacc.server import autoscale
+from pyacc.server import metrics
+from pyacc.server import process
+from pyacc.server import wsgi
+
+
+def busy_app(env, start_response):
+    start = time.time()
+    while time.time() - start < 0.01:
+        pass
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'busy\n']
+
+
+def load(utilisation, backlog=0, loop_lag=0.0):
+    return {'pool_busy': int(utilisation * 1024), 'pool_size': 1024,
+            'accept_backlog': backlog, 'loop_lag': loop_lag}
+
+
+def simulate():
+    scaler = autoscale.Autoscaler(1, 4, sustain=3, up_cooldown=10,
+                                  down_cooldown=30)
+    count = 1
+    for now in range(200):
+        if now < 60:
+            loads = [load(0.9, backlog=20, loop_lag=0.2)] * count
+        else:
+            loads = [load(0.01)] * count
+        new_count = scaler.decide(count, loads, now)
+        if new_count != count:
+            print("t=%3d %d -> %d" % (now, count, new_count))
+        count = new_count
+
+
+if __name__ == '__main__':
+    config.setup_logging()
+    if len(sys.argv) < 2 or sys.argv[1] != 'serve':
+        simulate()
+        sys.exit(0)
+
+    server_metrics = metrics.Metrics()
+    server_metrics.serve(port=9100)
+    server = wsgi.Server(name=__name__, app=busy_app, metrics=server_metrics)
+    scaler = autoscale.Autoscaler(1, 4, up_cooldown=5, down_cooldown=10)
+    parent = process.Parent(server, metrics=server_metrics, autoscaler=scaler,
+                            reap_mode=process.REAP_SIGNAL)
+    parent.wait()
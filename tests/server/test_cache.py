@@ -0,0 +1,69 @@
+"""I will modify this into mock someday.
+
+By now it is tested manually. Test case includes:
+1. ``curl -i localhost:1234/slow`` takes a second the first time, then returns
+   at once with the same ETag until the ttl of 10 seconds passed, from
+   whichever child serves it.
+2. ``curl -i -H 'If-None-Match: <etag>' localhost:1234/slow`` returns 304.
+3. ``ab -c 50 -n 50 http://localhost:1234/slow`` right after the ttl passed.
+   The app should log computing the response at most once per child.
+4. ``curl localhost:1234/fresh`` is never cached, each call returns a new
+   time.
+5. See the hits, misses and evictions per tier at localhost:9100/metrics.
+6. ``curl -N localhost:1234/big`` streams 100 lines, one every 0.05 seconds,
+   without Content-Length. Being bigger than ``max_entry_bytes``, it is never
+   cached and its lines show up as they are yielded, not all at the end.
+7. ``curl -H 'Cookie: a=1' localhost:1234/slow`` always takes a second, it
+   is neither answered from the cache nor cached. ``curl -H 'Cookie: a=1'
+   localhost:1234/public`` is cached like without the cookie.
+"""
+
+import logging
+import time
+
+import eventlet
+
+from pyacc.common import config
+from pyacc.server import cache
+from pyacc.server import metrics
+from pyacc.server import process
+from pyacc.server import wsgi
+
+
+LOG = logging.getLogger(__name__)
+
+
+def big_body():
+    for i in range(100):
+        eventlet.sleep(0.05)
+        yield ('%d %s\n' % (i, 'x' * 1024)).encode('utf-8')
+
+
+def wsgi_app(env, start_response):
+    if env['PATH_INFO'] == '/big':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return big_body()
+    if env['PATH_INFO'] == '/public':
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Cache-Control', 'public')])
+        return [('%f\n' % time.time()).encode('utf-8')]
+    if env['PATH_INFO'] == '/fresh':
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Cache-Control', 'no-store')])
+        return [('%f\n' % time.time()).encode('utf-8')]
+    LOG.info("Computing %s", env['PATH_INFO'])
+    eventlet.sleep(1)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [('computed at %f\n' % time.time()).encode('utf-8')]
+
+
+if __name__ == '__main__':
+    config.setup_logging()
+    server_metrics = metrics.Metrics()
+    server_metrics.serve(port=9100)
+    app = cache.ResponseCache(wsgi_app, ttl=10, max_entry_bytes=4096,
+                              shared=cache.SharedCache(entries=64),
+                              metrics=server_metrics)
+    server = wsgi.Server(name=__name__, app=app, metrics=server_metrics)
+    parent = process.Parent(server, count=4, metrics=server_metrics)
+    parent.wait()
@@ -11,11 +11,20 @@ By now it is tested manually. Test case includes:
 8. Kill parent by SIGKILL (kill -9). All should die.
 9. Service finishes in given time, rather than loop forever. Child should exit
    with return code 0. Parent exit after all children finish.
+10. Repeat above with ``python test_process.py signal``, i.e. reap_mode
+    REAP_SIGNAL. Idle parent should show ~0% CPU in top, killed children should
+    be restarted immediately.
+11. Kill children by SIGKILL repeatedly within a minute. The first restart of
+    a slot should be immediate, then each one later than the previous, the
+    other children untouched. ``parent.slot_status()`` should show the crashes.
+12. Stop a child with ``kill -STOP``. The parent should log the child sent no
+    heartbeat for 5 seconds, kill it and start another in its slot.
 
 To send signal, use ``kill -s SIGXXX`` command in terminal.
 """
 
 import os
+import sys
 
 import eventlet
 
@@ -41,6 +50,8 @@ class TestService(process.Service):
 
 if __name__ == '__main__':
     config.setup_logging()
-    parent = process.Parent(TestService(), count=4)
+    reap_mode = sys.argv[1] if len(sys.argv) > 1 else process.REAP_POLL
+    parent = process.Parent(TestService(), count=4, reap_mode=reap_mode,
+                            heartbeat_timeout=5)
     eventlet.spawn(delayed_stop, parent)
     parent.wait()
\ No newline at end of file
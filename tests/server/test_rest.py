@@ -0,0 +1,53 @@
+"""I will modify this into mock someday.
+
+By now it is tested manually. Test case includes:
+1. ``curl -i localhost:1234/servers`` returns the first page of servers and a
+   ``next`` cursor. ``curl -i 'localhost:1234/servers?cursor=<next>'`` returns
+   the page after it.
+2. ``curl -i 'localhost:1234/servers?limit=1000'`` is sent chunked.
+3. ``curl -i localhost:1234/servers/7.json`` returns server 7, server 0 is 404.
+4. ``curl -i -X POST -H 'Content-Type: application/json' -d '{"name": "a"}'
+   localhost:1234/servers`` returns 201 and the server.
+5. ``curl -i -H 'Accept: text/xml' localhost:1234/servers/7`` returns 406.
+"""
+
+import routes
+import webob
+import webob.exc
+
+from pyacc.common import config
+from pyacc.server import process
+from pyacc.server import rest
+from pyacc.server import wsgi
+
+
+SERVER_COUNT = 100000
+
+
+class ServerController(rest.Controller):
+
+    def index(self, request):
+        after = rest.decode_cursor(request.params.get('cursor')) or 0
+        servers = ({'id': i, 'name': 'server-%d' % i}
+                   for i in range(after + 1, SERVER_COUNT + 1))
+        return rest.Collection(servers, 'servers',
+                               limit=rest.get_limit(request),
+                               key=lambda server: server['id'])
+
+    def show(self, request, id):
+        if not 0 < int(id) <= SERVER_COUNT:
+            raise webob.exc.HTTPNotFound()
+        return {'server': {'id': int(id), 'name': 'server-%s' % id}}
+
+    def create(self, request, body):
+        return webob.Response(status=201, json_body={'server': body})
+
+
+if __name__ == '__main__':
+    config.setup_logging()
+    mapper = routes.Mapper()
+    mapper.resource('server', 'servers',
+                    controller=rest.Resource(ServerController()))
+    server = wsgi.Server(name=__name__, app=wsgi.Router(mapper, compiled=True))
+    parent = process.Parent(server, count=2)
+    parent.wait()
@@ -3,16 +3,84 @@
 By now it is tested manually. Test case includes:
 1. Start my wsgi server on one side. Use curl to connect on another side.
    Curl should return the message and env information.
+2. The app is preloaded in the parent before fork. Memory usage of children is
+   logged after 5 seconds, pss should be well below rss.
+3. Send SIGHUP to the parent while running curl in a loop. New children should
+   be started, then old ones drained one by one. No curl should fail.
+4. Run curl in a loop, then curl localhost:9100/metrics. Requests should be
+   counted per worker, and restarts counted after killing a child.
+5. Run ``ab -n 100000 http://localhost:1234/``. Each child should ask to be
+   recycled after 10000 to 11000 requests, its replacement be started, then
+   it drained. No request should fail, at most one child recycled at a time.
+6. ``curl localhost:1234/block`` blocks its child for 0.5 seconds without
+   yielding. The watchdog should log the stack of the app at ``time.sleep``
+   and ``GET /block``, and report its blocking time every minute.
+7. Access log lines are JSON, written to stderr in batches: with curl in a
+   loop they show up once a second, with ``ab`` up to 256 at a time.
+8. ``curl localhost:1234/file`` returns this file, sent with sendfile (see
+   ``strace -e sendfile -fp <child pid>``). ``curl -r 0-99`` returns its first
+   100 bytes with 206 Partial Content, ``curl -r 100000-`` gets 416.
+9. ``ab -n 20000 -c 2000 http://localhost:1234/block`` overloads the children.
+   Requests beyond the pool and wait queue should be answered 503 with
+   Retry-After at once, and counted by requests_shed_total in /metrics.
+10. ``curl localhost:1234/spin`` computes for 0.5 seconds in an offload worker
+    process. Meanwhile ``curl localhost:1234/`` of the same child should answer
+    right away, and the watchdog log no stall.
+11. ``nc localhost 1234`` without sending anything is closed after 5 seconds,
+    ``(printf 'GET / HTTP/1.1\r\n'; sleep 10) | nc localhost 1234`` after 2,
+    and so is a request line sent a byte a second, like
+    ``(printf G; sleep 1; printf E; sleep 1; printf T; sleep 5) | nc ...``.
+    Opening 300 idle connections to one child, e.g. with reuse_port, closes
+    the oldest beyond 256. connections_reaped_total in /metrics counts them.
+12. ``taskset -cp <child pid>`` shows each child pinned to a CPU of its own, in
+    slot order. A child killed with SIGKILL is replaced by one pinned to the
+    same CPU.
+13. ``curl --unix-socket /tmp/test_wsgi_server.sock http://localhost/`` is
+    answered like over TCP, with ``unix`` as REMOTE_ADDR. Killing the parent
+    with SIGKILL leaves the socket file, which the next start removes.
+14. With metrics on, as here, ``curl -r 0-99 localhost:1234/file`` still gets
+    206 sent with sendfile, and /metrics counts it in requests_total with
+    requests_in_flight back to 0.
 """
 
 import pprint
+import time
+
+import eventlet
 
 from pyacc.common import config
+from pyacc.server import accesslog
+from pyacc.server import admission
+from pyacc.server import listeners
+from pyacc.server import metrics
+from pyacc.server import offload
+from pyacc.server import placement
 from pyacc.server import process
+from pyacc.server import watchdog
 from pyacc.server import wsgi
 
+# not monkey patched, blocks the hub
+_sleep = time.sleep
+
+OFFLOAD = offload.ProcessPool(size=2, timeout=5)
+
+
+@offload.offloaded(OFFLOAD)
+def spin(seconds):
+    start = time.time()
+    while time.time() - start < seconds:
+        pass
+    return seconds
+
 
 def wsgi_app(env, start_response):
+    if env['PATH_INFO'] == '/block':
+        _sleep(0.5)
+    if env['PATH_INFO'] == '/spin':
+        spin(0.5)
+    if env['PATH_INFO'] == '/file':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return env['wsgi.file_wrapper'](open(__file__, 'rb'))
     start_response('200 OK', [('Content-Type', 'text/json')])
     message = {
         'message': 'hello world',
@@ -23,6 +91,24 @@ def wsgi_app(env, start_response):
 
 if __name__ == '__main__':
     config.setup_logging()
-    server = wsgi.Server(name=__name__, app=wsgi_app)
-    parent = process.Parent(server, count=4)
+    server_metrics = metrics.Metrics()
+    server_metrics.serve(port=9100)
+    server = wsgi.Server(name=__name__, app=wsgi_app, metrics=server_metrics,
+                         max_requests=10000, max_requests_jitter=1000,
+                         access_log=accesslog.AccessLog(json=True),
+                         admission=admission.Admission(
+                             max_waiting=128, wait_timeout=0.5,
+                             metrics=server_metrics),
+                         keepalive_timeout=5, max_idle_connections=256,
+                         header_timeout=2, body_timeout=30,
+                         listeners=[
+                             eventlet.listen(('0.0.0.0', 1234)),
+                             listeners.unix('/tmp/test_wsgi_server.sock',
+                                            mode=0o666)])
+    parent = process.Parent(server, count=4, preload=True,
+                            metrics=server_metrics,
+                            max_rss_bytes=512 * 1024 * 1024,
+                            watchdog=watchdog.Watchdog(threshold=0.1),
+                            placement=placement.Placement())
+    eventlet.spawn_after(5, parent.report_memory)
     parent.wait()
\ No newline at end of file